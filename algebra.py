@@ -0,0 +1,305 @@
+"""
+Band math and QA bitmask tests on downloaded multi-band GeoTIFFs, evaluated
+locally rather than as Earth Engine expressions, so each variant of a product
+(other QA bits, other indices) doesn't need another request and download.
+
+Expressions are Python expression syntax over band names:
+
+    evaluate('scene.tif', 'ndvi.tif',
+             {'ndvi': '(nir - red) / (nir + red)'},
+             mask='clear(pixel_qa, 3, 5)') # as `satellite.maskClouds`
+
+Bands are named by the GeoTIFF's band descriptions (as written by
+`util.save_cog` with `names`), or `b1`, `b2`, ... Expressions are evaluated
+in order, so later ones can use earlier ones' results by name.
+
+Each expression is parsed and checked once (only arithmetic, comparison and
+bitwise operators, numbers, band names and the functions in `FUNCTIONS` are
+allowed) and compiled, then evaluated block by block across a process pool,
+so intermediates are only ever block-sized and each block's bands are read once
+for all expressions.
+"""
+
+import ast
+import math
+import rasterio
+import numpy as np
+from tqdm import tqdm
+from functools import lru_cache
+from multiprocessing import Pool
+from rasterio.windows import Window
+
+
+def _as_int(x):
+    # Bands are passed as integers, but the
+    # argument can be a (float) expression
+    x = np.asarray(x)
+    return x.astype('int64') if x.dtype.kind == 'f' else x
+
+
+def bit(x, n):
+    """If bit `n` of the (integer) band `x` is set"""
+    return (_as_int(x) & (1 << n)) != 0
+
+
+def clear(x, *bits):
+    """If all of `bits` of the (integer) band `x` are unset,
+    e.g. `clear(pixel_qa, 3, 5)` for no cloud shadow or cloud"""
+    return (_as_int(x) & sum(1 << n for n in bits)) == 0
+
+
+FUNCTIONS = {
+    'bit': bit,
+    'clear': clear,
+    'where': np.where,
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'log': np.log,
+    'exp': np.exp,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'clip': np.clip,
+    'isnan': np.isnan,
+}
+
+CONSTANTS = {
+    'nan': np.nan,
+    'pi': np.pi,
+}
+
+ALLOWED = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load, ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift,
+    ast.Invert, ast.USub, ast.UAdd,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+BITWISE = (ast.BitAnd, ast.BitOr, ast.BitXor, ast.LShift, ast.RShift)
+
+
+def int_name(name):
+    """The name a band (or result) is looked up by where it's used
+    as a bitmask, as its original integer values; it can't clash with
+    a band name, which has to be an identifier"""
+    return name + ':int'
+
+
+class Expression:
+    """A checked, compiled expression. `names` are the
+    bands (or earlier results) it uses, and `bitwise`
+    those it only uses as bitmasks. Where a name is used
+    as a bitmask, it's looked up by its `int_name`"""
+    def __init__(self, source):
+        self.source = source
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as e:
+            raise ValueError('Invalid expression "{}": {}'.format(source, e.msg))
+
+        parents = {}
+        for node in ast.walk(tree):
+            if not isinstance(node, ALLOWED):
+                raise ValueError('"{}" isn\'t allowed in expressions: "{}"'.format(
+                    type(node).__name__, source))
+            for child in ast.iter_child_nodes(node):
+                parents[child] = node
+            if isinstance(node, ast.Compare) and len(node.ops) > 1:
+                # E.g. `a > 0 & b > 0`, which is `a > (0 & b) > 0`
+                raise ValueError('Chained comparisons aren\'t supported, '
+                                 'parenthesize them: "{}"'.format(source))
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+                    raise ValueError('Unknown function in "{}"; functions are {}'.format(
+                        source, ', '.join(FUNCTIONS)))
+                if node.keywords:
+                    raise ValueError('Keyword arguments aren\'t supported: "{}"'.format(source))
+            if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+                raise ValueError('Only numbers are allowed as constants: "{}"'.format(source))
+
+        self.names, numeric, bitmasks = set(), set(), []
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Name) or node.id in CONSTANTS:
+                continue
+            parent = parents.get(node)
+            if isinstance(parent, ast.Call) and parent.func is node:
+                continue
+            self.names.add(node.id)
+            as_bitmask = (isinstance(parent, ast.BinOp) and isinstance(parent.op, BITWISE)) or \
+                (isinstance(parent, ast.UnaryOp) and isinstance(parent.op, ast.Invert)) or \
+                (isinstance(parent, ast.Call) and parent.func.id in ('bit', 'clear') and parent.args[0] is node)
+            if as_bitmask:
+                bitmasks.append(node)
+            else:
+                numeric.add(node.id)
+        self.bitwise = self.names - numeric
+        for node in bitmasks:
+            node.id = int_name(node.id)
+        self.code = compile(tree, '<expression>', 'eval')
+
+    def __call__(self, values):
+        return eval(self.code, {'__builtins__': {}}, dict(FUNCTIONS, **CONSTANTS, **values))
+
+    def __repr__(self):
+        return 'Expression({!r})'.format(self.source)
+
+
+@lru_cache(maxsize=256)
+def compile_expression(source):
+    return Expression(source)
+
+
+def _check_nodata(dtype, nodata):
+    """If `dtype` is an integer type, in which
+    case `nodata` can't be NaN (or infinite)"""
+    integer = not np.issubdtype(np.dtype(dtype), np.floating)
+    if integer and not np.isfinite(nodata):
+        raise ValueError('An integer dtype ({}) needs an integer nodata, not {}'.format(dtype, nodata))
+    return integer
+
+
+class Algebra:
+    """Named expressions, evaluated in order, and an optional
+    mask expression (pixels where it's false get `nodata`).
+
+    Bands (and results) are converted to float32 (so e.g. `nir - red`
+    can't wrap around), except where they're used as bitmasks (in `bit`,
+    `clear` or bitwise operators), which get their integer values"""
+    def __init__(self, expressions, mask=None):
+        if isinstance(expressions, str):
+            expressions = {'value': expressions}
+        self.names = list(expressions)
+        self.expressions = [compile_expression(e) for e in expressions.values()]
+        self.mask = compile_expression(mask) if mask is not None else None
+
+        bands, bitwise, results = [], set(), set()
+        for name, expr in zip(self.names + [None], self.expressions + [self.mask]):
+            if expr is None:
+                continue
+            for band in sorted(expr.names - results):
+                if band not in bands:
+                    bands.append(band)
+                    bitwise.add(band)
+                if band not in expr.bitwise:
+                    bitwise.discard(band)
+            results.add(name)
+        self.bands = bands
+        self.bitwise = bitwise
+
+    def __call__(self, bands, dtype='float32', nodata=np.nan):
+        """Evaluate over a dict of same-shaped band arrays,
+        returning a `(len(names), ...)` array. For an integer
+        `dtype`, non-finite results (e.g. from dividing by zero)
+        get `nodata`, which then has to be an integer too"""
+        integer = _check_nodata(dtype, nodata)
+        values = {}
+        for name in self.bands:
+            values[int_name(name)] = bands[name]
+            if name not in self.bitwise:
+                values[name] = np.asarray(bands[name], dtype='float32')
+        shape = np.shape(bands[self.bands[0]]) if self.bands else ()
+
+        out = np.empty((len(self.names),) + shape, dtype=dtype)
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for i, (name, expr) in enumerate(zip(self.names, self.expressions)):
+                result = expr(values)
+                values[int_name(name)] = result
+                values[name] = np.asarray(result, dtype='float32')
+                out[i] = result
+                if integer:
+                    out[i, ~np.broadcast_to(np.isfinite(result), shape)] = nodata
+            if self.mask is not None:
+                out[:, ~np.broadcast_to(self.mask(values), shape)] = nodata
+        return out
+
+
+def band_names(dataset, bands=None):
+    """`{name: index}` for a dataset's bands: `bands` (a list of
+    names, in band order), its band descriptions, or `b1`, `b2`, ..."""
+    if bands is None:
+        descriptions = dataset.descriptions
+        if all(descriptions):
+            bands = descriptions
+        else:
+            bands = ['b{}'.format(i+1) for i in range(dataset.count)]
+    return {name: i+1 for i, name in enumerate(bands)}
+
+
+# Per-process state for the pool workers
+_worker = {}
+
+
+def _init_worker(path, expressions, mask, names, dtype, nodata):
+    _worker.update({
+        'dataset': rasterio.open(path),
+        'algebra': Algebra(expressions, mask),
+        'names': names,
+        'dtype': dtype,
+        'nodata': nodata,
+    })
+
+
+def _evaluate_block(window):
+    dataset, algebra = _worker['dataset'], _worker['algebra']
+    window = Window(*window)
+    indexes = [_worker['names'][band] for band in algebra.bands]
+    data = dataset.read(indexes, window=window) if indexes else np.empty((0, window.height, window.width))
+    out = algebra(dict(zip(algebra.bands, data)), _worker['dtype'], _worker['nodata'])
+
+    # Pixels that are nodata in any input band are nodata
+    nd = dataset.nodata
+    if nd is not None and len(data):
+        invalid = np.isnan(data) if np.isnan(nd) else data == nd
+        out[:, invalid.any(axis=0)] = _worker['nodata']
+    return window, out
+
+
+def evaluate(path, out_path, expressions, mask=None, bands=None, dtype='float32', nodata=None,
+             block_size=512, processes=None, progress=True):
+    """Evaluate `expressions` (a dict of `{name: expression}`, or one expression)
+    over the GeoTIFF at `path`, writing one band per expression to a tiled,
+    compressed GeoTIFF at `out_path`, with the same georeferencing.
+    Pixels where `mask` is false, or that are nodata in the source, get
+    `nodata` (by default NaN, or 0 for integer `dtype`s). See `band_names`
+    for `bands`. Returns `out_path`"""
+    if isinstance(expressions, str):
+        expressions = {'value': expressions}
+    if nodata is None:
+        nodata = np.nan if np.issubdtype(np.dtype(dtype), np.floating) else 0
+    _check_nodata(dtype, nodata)
+    algebra = Algebra(expressions, mask)
+
+    with rasterio.open(path) as src:
+        names = band_names(src, bands)
+        unknown = [band for band in algebra.bands if band not in names]
+        if unknown:
+            raise ValueError('Unknown bands {}; bands are {}'.format(
+                ', '.join(unknown), ', '.join(names)))
+        width, height = src.width, src.height
+        profile = {
+            'driver': 'GTiff',
+            'width': width,
+            'height': height,
+            'count': len(algebra.names),
+            'dtype': dtype,
+            'crs': src.crs,
+            'transform': src.transform,
+            'nodata': nodata,
+            'tiled': True,
+            'blockxsize': block_size,
+            'blockysize': block_size,
+            'compress': 'deflate',
+            'BIGTIFF': 'IF_SAFER',
+        }
+
+    windows = [(col, row, min(block_size, width - col), min(block_size, height - row))
+               for row in range(0, height, block_size)
+               for col in range(0, width, block_size)]
+    args = (path, expressions, mask, names, dtype, nodata)
+    with rasterio.open(out_path, 'w', **profile) as dst:
+        dst.descriptions = tuple(algebra.names)
+        with Pool(processes, initializer=_init_worker, initargs=args) as p:
+            blocks = p.imap_unordered(_evaluate_block, windows, chunksize=max(1, math.ceil(len(windows) / 256)))
+            for window, data in tqdm(blocks, total=len(windows), desc='Evaluating', disable=not progress):
+                dst.write(data, window=window)
+    return out_path
@@ -0,0 +1,334 @@
+"""
+Local stand-ins for benchmarks: synthetic GeoTIFFs, Earth Engine
+style zip downloads served over HTTP, and a fake `ee` module
+that counts round trips instead of making them.
+"""
+
+import io
+import os
+import sys
+import json
+import types
+import zipfile
+import threading
+import time
+import numpy as np
+from PIL import Image
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIZES = {
+    'small': 512,
+    'medium': 2048,
+    'large': 8192,
+}
+
+
+def make_geotiff(path, size, count=3, dtype='uint16', nodata=0, tiled=True, seed=0):
+    """Write a synthetic `size` x `size` GeoTIFF in Web Mercator:
+    smooth gradients plus noise, with a nodata border"""
+    import rasterio
+    from rasterio.transform import from_origin
+    profile = {
+        'driver': 'GTiff',
+        'width': size,
+        'height': size,
+        'count': count,
+        'dtype': dtype,
+        'crs': 'EPSG:3857',
+        'transform': from_origin(-5000000, 1000000, 30, 30),
+        'nodata': nodata,
+        'compress': 'deflate',
+    }
+    if tiled:
+        profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    rng = np.random.default_rng(seed)
+    border = size // 16
+    rows = min(size, 1024)
+    with rasterio.open(path, 'w', **profile) as dst:
+        # Written in strips so large fixtures don't need much memory
+        for row in range(0, size, rows):
+            h = min(rows, size - row)
+            y, x = np.mgrid[row:row+h, 0:size]
+            for band in range(count):
+                data = (np.sin(x / (50 + 10*band)) + np.cos(y / 70) + 2) * 700
+                data += rng.normal(0, 50, data.shape)
+                data = np.clip(data, 1, 3000)
+                data[:, :border] = nodata
+                data[:, -border:] = nodata
+                if row < border:
+                    data[:border-row] = nodata
+                if row + h > size - border:
+                    data[max(0, size - border - row):] = nodata
+                dst.write(data.astype(dtype), band+1, window=((row, row+h), (0, size)))
+    return path
+
+
+def make_mask(path, size, seed=0):
+    """Write a synthetic `size` x `size` GeoTIFF of scattered
+    blobs on nodata, for polygonizing its data mask"""
+    import rasterio
+    from rasterio.transform import from_origin
+    rng = np.random.default_rng(seed)
+    n = max(1, size // 16)
+    y, x = np.ogrid[0:size, 0:size]
+    mask = np.zeros((size, size), dtype='uint8')
+    for cx, cy, r in zip(rng.uniform(0, size, n), rng.uniform(0, size, n), rng.uniform(4, 32, n)):
+        r0, r1 = int(max(cy - r, 0)), int(min(cy + r + 1, size))
+        c0, c1 = int(max(cx - r, 0)), int(min(cx + r + 1, size))
+        blob = (x[:, c0:c1] - cx)**2 + (y[r0:r1] - cy)**2 <= r**2
+        mask[r0:r1, c0:c1] |= blob.astype('uint8')
+    with rasterio.open(path, 'w', driver='GTiff', width=size, height=size, count=1,
+                       dtype='uint8', nodata=0, crs='EPSG:3857', compress='deflate',
+                       transform=from_origin(-5000000, 1000000, 30, 30),
+                       tiled=True, blockxsize=256, blockysize=256) as dst:
+        dst.write(mask, 1)
+    return path
+
+
+def make_ee_zip(size, seed=0):
+    """Zip bytes laid out like an Earth Engine visualization
+    download: one georeferenced 8-bit GeoTIFF per channel"""
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[0:size, 0:size]
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for i, chan in enumerate(['red', 'green', 'blue']):
+            band = (np.sin(x / (20 + 5*i)) + np.cos(y / 30) + 2) * 60 + rng.normal(0, 4, (size, size))
+            with MemoryFile() as mem:
+                with mem.open(driver='GTiff', width=size, height=size, count=1, dtype='uint8',
+                              crs='EPSG:4326', transform=from_origin(-60, -10, 0.00027, 0.00027)) as dst:
+                    dst.write(np.clip(band, 0, 255).astype('uint8'), 1)
+                zf.writestr('download.vis-{}.tif'.format(chan), mem.read())
+    return buf.getvalue()
+
+
+# Stand-in for the Google Earth web app, with the elements
+# `earth.EarthWeb` scripts against. It "loads" (adds the app
+# elements) after a short delay, then "renders" for `render_ms`,
+# hiding its loading indicator (`earth-view-status`) when done
+EARTH_PAGE = b'''<!doctype html>
+<html><body style="margin:0">
+<canvas id="map" width="400" height="300"></canvas>
+<script>
+var params = new URLSearchParams(location.search);
+var renderMs = parseInt(params.get('render_ms') || '1000');
+function shadow(el, html) { el.attachShadow({mode: 'open'}).innerHTML = html; return el; }
+setTimeout(function() {
+  var app = document.createElement('earth-app');
+  var root = app.attachShadow({mode: 'open'});
+  root.innerHTML = '<div id="toolbar">toolbar</div><div id="earthNavigationElements"></div>' +
+    '<earth-toolbar></earth-toolbar><earth-drawer></earth-drawer>' +
+    '<earth-drawing-tools></earth-drawing-tools><earth-view-status>loading</earth-view-status>';
+  shadow(root.querySelector('earth-toolbar'), '<button id="mapStyle"></button>');
+  var drawer = shadow(root.querySelector('earth-drawer'),
+    '<div id="mapstyle"></div><earth-map-styles-view></earth-map-styles-view>');
+  shadow(drawer.shadowRoot.querySelector('#mapstyle'), '<aside><earth-radio-card></earth-radio-card></aside>');
+  shadow(drawer.shadowRoot.querySelector('earth-map-styles-view'), '<button id="backButton"></button>');
+  document.body.appendChild(app);
+
+  var ctx = document.getElementById('map').getContext('2d');
+  var start = Date.now();
+  (function draw() {
+    var t = Date.now() - start;
+    ctx.fillStyle = 'rgb(' + (t % 255) + ',120,60)';
+    ctx.fillRect(Math.random() * 400, Math.random() * 300, 40, 40);
+    if (t < renderMs) requestAnimationFrame(draw);
+    else root.querySelector('earth-view-status').hidden = true;
+  })();
+}, 300);
+</script>
+</body></html>'''
+
+
+class FakeEEServer:
+    """Serves fake EE zips over local HTTP: `/zip/<size>` returns
+    a zip of `size` pixel bands, `/flaky/<size>` fails with a 503
+    every other request and `/slow/<size>` takes `delay` seconds
+    (`max_active` is the most requests in flight at once).
+    `/earth` serves `EARTH_PAGE`, e.g. for
+    `EarthWeb(..., url_tmpl=server.url('earth?lat={lat}&lng={lng}&alt={alt}'))`.
+
+        with FakeEEServer() as server:
+            download_ee_image(server.url('zip/256'), id, path)
+    """
+    def __init__(self, delay=0.05):
+        self.zips = {}
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    n = server.requests
+                try:
+                    self.respond(n)
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def respond(self, n):
+                kind, _, size = self.path.split('?')[0].strip('/').partition('/')
+                if kind == 'earth':
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/html')
+                    self.send_header('Content-Length', str(len(EARTH_PAGE)))
+                    self.end_headers()
+                    self.wfile.write(EARTH_PAGE)
+                    return
+                if kind == 'flaky' and n % 2:
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if kind == 'slow':
+                    time.sleep(server.delay)
+                body = server.zip(int(size))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/zip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+
+    def zip(self, size):
+        with self._lock:
+            if size not in self.zips:
+                self.zips[size] = make_ee_zip(size)
+            return self.zips[size]
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}/{}'.format(self.httpd.server_port, path)
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fake_ee(download_url=None, n_features=100):
+    """A stand-in `ee` module covering what `satellite` uses.
+    Round trips (`getInfo`, `getDownloadURL`, task calls) are counted
+    in `ee.calls`; `getDownloadURL` returns `download_url`."""
+    ee = types.ModuleType('ee')
+    ee.calls = {}
+
+    def count(name):
+        ee.calls[name] = ee.calls.get(name, 0) + 1
+
+    class Computed:
+        """Records the expression it was built from, like an
+        `ee.ComputedObject`, so `serialize()` is deterministic"""
+        def __init__(self, *args, **kwargs):
+            self.expr = [type(self).__name__, _encode(args), _encode(kwargs)]
+
+        def _call(self, name, *args, **kwargs):
+            obj = Computed.__new__(type(self))
+            obj.expr = [self.expr, name, _encode(args), _encode(kwargs)]
+            return obj
+
+        def __getattr__(self, name):
+            if name.startswith('_'):
+                raise AttributeError(name)
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+
+        def serialize(self):
+            return json.dumps(self.expr, sort_keys=True)
+
+        def getInfo(self):
+            count('getInfo')
+            return _evaluate(self.expr, n_features)
+
+        def getDownloadURL(self, params=None):
+            count('getDownloadURL')
+            return download_url
+
+    def _encode(obj):
+        if isinstance(obj, Computed):
+            return obj.expr
+        if isinstance(obj, (list, tuple)):
+            return [_encode(o) for o in obj]
+        if isinstance(obj, dict):
+            return {k: _encode(v) for k, v in obj.items()}
+        if callable(obj):
+            return getattr(obj, '__name__', 'fn')
+        return obj
+
+    for name in ['Image', 'ImageCollection', 'Feature', 'FeatureCollection', 'List', 'Geometry']:
+        setattr(ee, name, type(name, (Computed,), {}))
+
+    ee.Filter = types.SimpleNamespace(geometry=lambda geom: ['Filter.geometry', _encode(geom)])
+    ee.Initialize = lambda *args, **kwargs: count('Initialize')
+
+    tasks = []
+    def start(id, config):
+        count('exportImage')
+        tasks.append({'id': id, 'description': config.get('description'), 'state': 'READY'})
+    def task_status(ids):
+        count('getTaskStatus')
+        for t in tasks:
+            if t['id'] in ids:
+                t['state'] = 'COMPLETED'
+        return [dict(t) for t in tasks if t['id'] in ids]
+    def cancel(id):
+        count('cancelTask')
+
+    ee.data = types.SimpleNamespace(
+        getTaskList=lambda: count('getTaskList') or [dict(t) for t in tasks],
+        getTaskStatus=task_status,
+        cancelTask=cancel,
+        newTaskId=lambda n=1: ['task-{}'.format(len(tasks) + i) for i in range(n)])
+
+    def to_drive(image, **config):
+        return types.SimpleNamespace(id='task-{}'.format(len(tasks)), config=config)
+    ee.batch = types.SimpleNamespace(
+        Export=types.SimpleNamespace(image=types.SimpleNamespace(toDrive=to_drive)),
+        data=types.SimpleNamespace(exportImage=start))
+    return ee
+
+
+def _evaluate(expr, n_features):
+    """Results for the few `getInfo` calls `satellite` makes"""
+    if expr[-3:-2] == ['size']:
+        return n_features
+    if len(expr) == 4 and expr[1] == 'map':
+        # Geometries of a `toList(count, offset)` chunk
+        count, offset = expr[0][2]
+        return [_point(i) for i in range(offset, min(offset + count, n_features))]
+    if expr[0] == 'Feature':
+        geom = expr[1][0]
+        if isinstance(geom, dict):
+            return {'type': 'Feature', 'geometry': geom}
+        return {'type': 'Feature', 'geometry': _point(0)}
+    return None
+
+
+def _point(i):
+    return {'type': 'Point', 'coordinates': [-60 + (i % 100) * 0.1, -10 + (i // 100) * 0.1]}
+
+
+def install_fake_ee(**kwargs):
+    """Install `fake_ee` as the `ee` module; must happen
+    before `satellite` is imported"""
+    ee = fake_ee(**kwargs)
+    sys.modules['ee'] = ee
+    return ee
@@ -0,0 +1,108 @@
+"""
+Import-time benchmark.
+
+Imports each module in a fresh interpreter and checks that it doesn't
+initialize Earth Engine, doesn't pull in modules that should only be
+imported on use, and doesn't get much slower than the recorded baseline.
+
+    python -m peng.bench.imports          # check against the baseline
+    python -m peng.bench.imports --save   # record a new baseline
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+PKG = __package__.split('.')[0]
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BASELINE = os.path.join(os.path.dirname(__file__), 'baselines', 'imports.json')
+
+MODULES = ['util', 'cache', 'client', 'downloader', 'scheduler', 'satellite', 'tasks', 'raster', 'tiles']
+
+# Should only be imported when they're actually used
+DEFERRED = ['matplotlib', 'pyproj', 'rasterio.plot']
+
+# Allowed slowdown relative to the baseline,
+# plus some slack for timer noise
+TOLERANCE = 1.5
+SLACK = 0.05
+
+SCRIPT = '''
+import sys, time, json, importlib
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+try:
+    import ee
+    def fail(*args, **kwargs):
+        raise RuntimeError('Earth Engine was initialized at import time')
+    ee.Initialize = fail
+    ee.data.getTaskList = fail
+except ImportError:
+    pass
+importlib.import_module({module!r})
+print(json.dumps({{
+    'elapsed': time.perf_counter() - start,
+    'modules': sorted(sys.modules)
+}}))
+'''
+
+
+def measure(module, runs=5):
+    """Best-of-`runs` import time of `module`, in seconds,
+    and the modules it imported"""
+    best, modules = None, None
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-c', SCRIPT.format(root=ROOT, module=module)],
+            capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+        result = json.loads(proc.stdout)
+        if best is None or result['elapsed'] < best:
+            best = result['elapsed']
+        modules = result['modules']
+    return best, modules
+
+
+def run(save=False):
+    try:
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+
+    results, failures = {}, []
+    for name in MODULES:
+        module = '{}.{}'.format(PKG, name)
+        try:
+            elapsed, modules = measure(module)
+        except RuntimeError as e:
+            print('{:<12} skipped ({})'.format(name, e))
+            if 'initialized at import time' in str(e):
+                failures.append(name)
+            continue
+        results[name] = elapsed
+
+        eager = [m for m in DEFERRED if m in modules]
+        limit = baseline[name] * TOLERANCE + SLACK if name in baseline else None
+        slow = limit is not None and elapsed > limit
+        print('{:<12} {:>7.1f}ms{}{}'.format(
+            name, elapsed*1000,
+            ' (baseline {:.1f}ms)'.format(baseline[name]*1000) if name in baseline else '',
+            ' eagerly imports {}'.format(', '.join(eager)) if eager else ''))
+        if eager or slow:
+            failures.append(name)
+
+    if save:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        with open(BASELINE, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return failures
+
+
+if __name__ == '__main__':
+    failures = run(save='--save' in sys.argv)
+    if failures:
+        print('Import regressions:', ', '.join(failures))
+        sys.exit(1)
@@ -0,0 +1,199 @@
+"""
+Benchmark suite.
+
+Each benchmark runs in a fresh interpreter against local fixtures
+(synthetic GeoTIFFs, a local HTTP stand-in for Earth Engine downloads,
+and a fake `ee` module that counts round trips), and records wall time,
+peak RSS and I/O bytes for the operation.
+
+    python -m peng.bench.run                      # run, compare to the latest baseline
+    python -m peng.bench.run --save               # run and save a baseline for this commit
+    python -m peng.bench.run --compare abc1234    # compare to a specific commit's baseline
+    python -m peng.bench.run --sizes small,medium --only raster
+
+Baselines are stored in `bench/baselines/<commit>.json`.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from .fixtures import SIZES, install_fake_ee, make_geotiff, make_mask
+
+PKG = __package__.split('.')[0]
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines')
+
+# A benchmark is slower than its baseline
+# past this ratio (plus some timer slack)
+TOLERANCE = 1.2
+SLACK = 0.01
+
+class Fixtures:
+    """Lazily generated, cached fixture files"""
+    def __init__(self, root, size):
+        self.root = root
+        self.size = size
+        self.px = SIZES[size]
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def geotiff(self, count=3, dtype='uint16'):
+        path = self.path('{}-{}-{}.tif'.format(self.size, count, dtype))
+        if not os.path.exists(path):
+            make_geotiff(path, self.px, count=count, dtype=dtype)
+        return path
+
+    def mask(self):
+        path = self.path('{}-mask.tif'.format(self.size))
+        if not os.path.exists(path):
+            make_mask(path, self.px)
+        return path
+
+    def tmpdir(self):
+        return tempfile.mkdtemp(dir=self.root)
+
+
+def read_io():
+    """bytes read and written by this process so far (syscall level,
+    so it includes page-cache hits and sockets), where available"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            stats = dict(line.split(': ') for line in f.read().splitlines())
+        return int(stats['rchar']), int(stats['wchar'])
+    except (OSError, KeyError):
+        return None, None
+
+
+def measure(name, size, fixtures_dir):
+    """Run one benchmark in this process and return its metrics"""
+    ee = install_fake_ee()
+    from .suite import BENCHMARKS
+    fn, _ = BENCHMARKS[name]
+    fixtures = Fixtures(fixtures_dir, size)
+    op = fn(fixtures)
+
+    ee.calls.clear()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    read0, write0 = read_io()
+    start = time.perf_counter()
+    extra = op()
+    elapsed = time.perf_counter() - start
+    read1, write1 = read_io()
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = {
+        'seconds': elapsed,
+        'peak_rss_mb': rss_peak / 1024,
+        'rss_growth_mb': (rss_peak - rss_before) / 1024,
+        'read_mb': None if read0 is None else (read1 - read0) / 1e6,
+        'write_mb': None if write0 is None else (write1 - write0) / 1e6,
+        'ee_calls': sum(ee.calls.values()),
+    }
+    if isinstance(extra, dict):
+        result.update(extra)
+    return result
+
+
+def run_isolated(name, size, fixtures_dir):
+    proc = subprocess.run(
+        [sys.executable, '-m', '{}.bench.run'.format(PKG),
+         '--one', name, '--size', size or '', '--fixtures', fixtures_dir],
+        cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else 'exited with {}'.format(proc.returncode))
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'local'
+
+
+def load_baseline(name=None):
+    if not os.path.isdir(BASELINES):
+        return None, {}
+    if name is None:
+        files = [os.path.join(BASELINES, f) for f in os.listdir(BASELINES) if f.endswith('.json')]
+        if not files:
+            return None, {}
+        path = max(files, key=os.path.getmtime)
+    else:
+        path = os.path.join(BASELINES, '{}.json'.format(name))
+    with open(path, 'r') as f:
+        return os.path.basename(path)[:-5], json.load(f)
+
+
+def main(args):
+    from .suite import BENCHMARKS
+    sizes = args.sizes.split(',')
+    names = [n for n in sorted(BENCHMARKS) if args.only is None or n.startswith(args.only)]
+    baseline_name, baseline = load_baseline(args.compare)
+    if baseline_name:
+        print('Comparing to baseline', baseline_name)
+
+    results, regressions = {}, []
+    print('{:<32} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+        'benchmark', 'seconds', 'rss MB', 'read MB', 'write MB', 'ee'))
+    for name in names:
+        _, sized = BENCHMARKS[name]
+        for size in (sizes if sized else [None]):
+            key = name if size is None else '{}[{}]'.format(name, size)
+            try:
+                result = run_isolated(name, size, args.fixtures)
+            except RuntimeError as e:
+                print('{:<32} failed: {}'.format(key, e))
+                continue
+            results[key] = result
+
+            note = ''
+            if key in baseline:
+                ratio = result['seconds'] / max(baseline[key]['seconds'], 1e-9)
+                note = '{:.2f}x'.format(ratio)
+                if result['seconds'] > baseline[key]['seconds'] * TOLERANCE + SLACK:
+                    regressions.append(key)
+                    note += ' REGRESSION'
+            fmt = lambda v: '-' if v is None else '{:.1f}'.format(v)
+            print('{:<32} {:>9.3f} {:>9} {:>9} {:>9} {:>6} {}'.format(
+                key, result['seconds'], fmt(result['peak_rss_mb']),
+                fmt(result['read_mb']), fmt(result['write_mb']),
+                result['ee_calls'], note))
+
+    if args.save:
+        os.makedirs(BASELINES, exist_ok=True)
+        path = os.path.join(BASELINES, '{}.json'.format(commit()))
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to', path)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='small,medium')
+    parser.add_argument('--only', default=None, help='only run benchmarks with this prefix')
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--compare', default=None, help='baseline to compare to (default: latest)')
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'peng-bench'))
+    parser.add_argument('--one', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--size', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        print(json.dumps(measure(args.one, args.size or 'small', args.fixtures)))
+    else:
+        regressions = main(args)
+        if regressions:
+            print('Regressions:', ', '.join(regressions))
+            sys.exit(1)
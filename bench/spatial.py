@@ -0,0 +1,67 @@
+"""
+Compares `spatial` against the `util` bounding-box helpers.
+
+    python -m peng.bench.spatial [n_polygons] [n_queries]
+"""
+
+import sys
+import time
+import numpy as np
+from ..util import get_bounds, intersects
+from ..spatial import RTree, bounds_array, bounds_from_coords
+
+
+def random_polygons(n, n_coords=32, seed=0):
+    """Random single-ring polygons scattered over lng/lat space"""
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform([-180, -60], [180, 60], size=(n, 2))
+    radii = rng.uniform(0.01, 0.5, size=(n, 1, 1))
+    angles = np.linspace(0, 2*np.pi, n_coords)
+    ring = np.stack([np.cos(angles), np.sin(angles)], axis=-1)
+    coords = centers[:, None, :] + ring[None] * radii
+    return [[c.tolist()] for c in coords]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run(n_polygons=200000, n_queries=1000):
+    polygons = random_polygons(n_polygons)
+    queries = bounds_array(random_polygons(n_queries, seed=1))
+    queries[:, 2:] += 2 # Scene-sized footprints
+
+    loop_bounds, t_loop = timed(lambda: [get_bounds(p) for p in polygons])
+    boxes, t_vec = timed(bounds_array, polygons)
+    assert np.allclose(np.array(loop_bounds), boxes)
+    print('bounds        loop {:>8.3f}s   vectorized {:>8.3f}s'.format(t_loop, t_vec))
+
+    # Most of the above is converting Python lists to an array;
+    # this is the cost when the coordinates are already packed
+    coords = np.array(polygons).reshape(-1, 2)
+    lengths = np.full(len(polygons), len(polygons[0][0]))
+    _, t_packed = timed(bounds_from_coords, coords, lengths)
+    print('bounds                         packed     {:>8.3f}s'.format(t_packed))
+
+    tree, t_build = timed(RTree, boxes)
+    print('rtree build                      {:>8.3f}s'.format(t_build))
+
+    # The pairwise loop is quadratic, so time it on a sample of queries
+    # and extrapolate to the full set
+    sample = queries[:max(1, n_queries // 100)]
+    _, t_pairs = timed(lambda: [[i for i, b in enumerate(loop_bounds) if intersects(b, q)] for q in sample])
+    t_pairs *= len(queries) / len(sample)
+    (q_idx, i_idx), t_query = timed(tree.query_many, queries)
+    print('intersects    loop {:>8.3f}s*  rtree      {:>8.3f}s   ({} matches)'.format(t_pairs, t_query, len(q_idx)))
+
+    points = (queries[:, :2] + queries[:, 2:]) / 2
+    _, t_nearest = timed(tree.nearest, points, 5)
+    print('nearest (k=5)                    {:>8.3f}s'.format(t_nearest))
+    print('* extrapolated from {} queries'.format(len(sample)))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    run(*args)
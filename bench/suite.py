@@ -0,0 +1,358 @@
+"""
+The benchmarks run by `bench.run`. Each takes the `Fixtures` for a size,
+does its setup and returns the operation to measure, as a zero-argument
+callable (which may return a dict of extra metrics to record).
+Package imports happen inside them so the fake `ee` is installed first.
+"""
+
+import os
+import shutil
+import numpy as np
+from .fixtures import FakeEEServer
+
+BENCHMARKS = {}
+
+
+def benchmark(name, sized=True):
+    """Register a benchmark; `sized` ones run once per fixture size"""
+    def decorator(fn):
+        BENCHMARKS[name] = (fn, sized)
+        return fn
+    return decorator
+
+
+def _lat_lon_bounds(path, frac=0.25):
+    """(lat0, lon0, lat1, lon1) of a centered box covering `frac` of each side"""
+    import rasterio
+    from pyproj import Transformer
+    with rasterio.open(path) as dataset:
+        b = dataset.bounds
+        crs = dataset.crs.to_string()
+    t = Transformer.from_crs(crs, 'epsg:4326')
+    pad_x = (b.right - b.left) * (1 - frac) / 2
+    pad_y = (b.top - b.bottom) * (1 - frac) / 2
+    lat0, lon0 = t.transform(b.left + pad_x, b.top - pad_y)
+    lat1, lon1 = t.transform(b.right - pad_x, b.bottom + pad_y)
+    return lat0, lon0, lat1, lon1
+
+
+# Raster
+
+@benchmark('raster.open')
+def raster_open(fx):
+    from ..raster import GeoTIFF
+    path = fx.geotiff()
+    return lambda: GeoTIFF(path)
+
+
+@benchmark('raster.to_image')
+def raster_to_image(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.geotiff())
+    return lambda: geotiff.to_image()
+
+
+@benchmark('raster.to_image_colormap')
+def raster_to_image_colormap(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.geotiff(count=1))
+    return lambda: geotiff.to_image(colormap='viridis')
+
+
+@benchmark('raster.write_image')
+def raster_write_image(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.geotiff())
+    out = os.path.join(fx.tmpdir(), 'out.tif')
+    return lambda: geotiff.write_image(out, block_size=512)
+
+
+@benchmark('raster.stats')
+def raster_stats(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.geotiff())
+    return lambda: geotiff.stats()
+
+
+@benchmark('raster.apply_chain')
+def raster_apply_chain(fx):
+    from ..raster import GeoTIFF
+    path = fx.geotiff()
+    bounds = _lat_lon_bounds(path, 0.5)
+    def op():
+        geotiff = GeoTIFF(path)
+        geotiff.apply_bounds(bounds)
+        geotiff.apply_scale(0.5)
+        geotiff.materialize()
+    return op
+
+
+@benchmark('raster.data_for_scale')
+def raster_data_for_scale(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.geotiff())
+    return lambda: geotiff.data_for_scale(0.1)
+
+
+@benchmark('raster.preview_overviews')
+def raster_preview_overviews(fx):
+    """Decimated preview of a copy of the fixture with overviews built"""
+    import shutil
+    from ..raster import GeoTIFF
+    path = os.path.join(fx.tmpdir(), 'overviews.tif')
+    shutil.copyfile(fx.geotiff(), path)
+    geotiff = GeoTIFF(path)
+    geotiff.build_overviews()
+    return lambda: geotiff.preview(512)
+
+
+@benchmark('raster.chunk_cache_reads')
+def raster_chunk_cache_reads(fx):
+    """Repeated windowed reads from a fresh handle (as
+    another process would), decoded vs. from the chunk cache"""
+    import time
+    import rasterio
+    from rasterio.windows import Window
+    from ..chunks import ChunkCache
+    path = fx.geotiff()
+    chunks = ChunkCache(os.path.join(fx.tmpdir(), 'chunks'))
+    window = Window(fx.px//4, fx.px//4, fx.px//2, fx.px//2)
+
+    def timed(fn):
+        start = time.perf_counter()
+        with rasterio.open(path) as src:
+            fn(src)
+        return time.perf_counter() - start
+
+    # Warm the cache
+    timed(lambda src: chunks.read(src, window=window))
+
+    def op():
+        return {
+            'decoded_s': timed(lambda src: src.read(window=window)),
+            'cached_s': timed(lambda src: chunks.read(src, window=window)),
+        }
+    return op
+
+
+@benchmark('algebra.evaluate')
+def algebra_evaluate(fx):
+    """A normalized difference and a bitmask test,
+    written to a new GeoTIFF block by block"""
+    from ..algebra import evaluate
+    path = fx.geotiff()
+    out = os.path.join(fx.tmpdir(), 'index.tif')
+    return lambda: evaluate(path, out, {'nd': '(b2 - b1) / (b2 + b1)'},
+                            mask='clear(b3, 3, 5)', progress=False)
+
+
+@benchmark('raster.points_to_indices')
+def raster_points(fx):
+    from ..raster import GeoTIFF
+    path = fx.geotiff()
+    geotiff = GeoTIFF(path)
+    lat0, lon0, lat1, lon1 = _lat_lon_bounds(path, 1)
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(lat1, lat0, 100000)
+    lons = rng.uniform(lon0, lon1, 100000)
+    return lambda: geotiff.points_to_indices(lats, lons, sample=True)
+
+
+@benchmark('raster.to_features')
+def raster_to_features(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.mask())
+    return lambda: {'features': len(geotiff.to_features())}
+
+
+@benchmark('raster.write_features')
+def raster_write_features(fx):
+    from ..raster import GeoTIFF
+    geotiff = GeoTIFF(fx.mask())
+    out = os.path.join(fx.tmpdir(), 'feats.ndjson')
+    return lambda: {'features': geotiff.write_features(out, block_size=512)}
+
+
+@benchmark('clips.extract_clips')
+def clips_extract(fx):
+    import rasterio
+    from ..clips import extract_clips
+    path = fx.geotiff()
+    with rasterio.open(path) as dataset:
+        b = dataset.bounds
+    rng = np.random.default_rng(0)
+    feats = []
+    for i in range(500):
+        x = rng.uniform(b.left, b.right)
+        y = rng.uniform(b.bottom, b.top)
+        r = rng.uniform(100, 2000)
+        feats.append({'geometry': {'type': 'Polygon', 'coordinates': [[
+            (x-r, y-r), (x+r, y-r), (x+r, y+r), (x-r, y+r), (x-r, y-r)]]}})
+    return lambda: extract_clips(path, feats, processes=4)
+
+
+@benchmark('tiles.generate_tiles')
+def tiles_generate(fx):
+    from ..tiles import generate_tiles
+    path = fx.geotiff()
+    out = fx.tmpdir()
+    def op():
+        shutil.rmtree(out, ignore_errors=True)
+        generate_tiles(path, out, processes=4)
+    return op
+
+
+# Downloads
+
+@benchmark('util.download_ee_image')
+def util_download_ee_image(fx):
+    from ..util import download_ee_image
+    server = FakeEEServer().__enter__()
+    url = server.url('zip/{}'.format(fx.px))
+    # Not via `stats`, which would trace memory and slow the download
+    download_mb = len(server.zip(fx.px)) / 1e6
+    out = os.path.join(fx.tmpdir(), 'out.png')
+    def op():
+        download_ee_image(url, 'bench', out, working_dir=fx.tmpdir())
+        return {'download_mb': download_mb}
+    return op
+
+
+@benchmark('util.download_ee_image_cog')
+def util_download_ee_image_cog(fx):
+    from ..util import download_ee_image
+    server = FakeEEServer().__enter__()
+    url = server.url('zip/{}'.format(fx.px))
+    # Not via `stats`, which would trace memory and slow the download
+    download_mb = len(server.zip(fx.px)) / 1e6
+    out = os.path.join(fx.tmpdir(), 'out.tif')
+    def op():
+        download_ee_image(url, 'bench', out, working_dir=fx.tmpdir(), cog=True)
+        return {'download_mb': download_mb}
+    return op
+
+
+@benchmark('util.png_vs_cog_reads')
+def util_png_vs_cog_reads(fx):
+    """Storage size and read latency of the two
+    `download_ee_image` output formats"""
+    import time
+    import rasterio
+    from PIL import Image
+    from ..util import download_ee_image
+    server = FakeEEServer().__enter__()
+    url = server.url('zip/{}'.format(fx.px))
+    tmpdir = fx.tmpdir()
+    png, cog = os.path.join(tmpdir, 'out.png'), os.path.join(tmpdir, 'out.tif')
+    download_ee_image(url, 'bench', png, working_dir=tmpdir)
+    download_ee_image(url, 'bench', cog, working_dir=tmpdir, cog=True)
+    side, size = fx.px // 8, fx.px
+
+    def timed(fn):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    def png_window():
+        with Image.open(png) as im:
+            np.asarray(im.crop((size//2, size//2, size//2 + side, size//2 + side)))
+    def cog_window():
+        with rasterio.open(cog) as src:
+            src.read(window=((size//2, size//2 + side), (size//2, size//2 + side)))
+    def png_preview():
+        with Image.open(png) as im:
+            np.asarray(im.reduce(8))
+    def cog_preview():
+        with rasterio.open(cog) as src:
+            src.read(out_shape=(3, side, side))
+
+    def op():
+        return {
+            'png_mb': os.path.getsize(png) / 1e6,
+            'cog_mb': os.path.getsize(cog) / 1e6,
+            'png_window_s': timed(png_window),
+            'cog_window_s': timed(cog_window),
+            'png_preview_s': timed(png_preview),
+            'cog_preview_s': timed(cog_preview),
+        }
+    return op
+
+
+@benchmark('downloader.download_all', sized=False)
+def downloader_download_all(fx):
+    from ..downloader import Downloader
+    server = FakeEEServer().__enter__()
+    server.zip(256)
+    outdir = fx.tmpdir()
+    jobs = [(server.url('zip/256'), os.path.join(outdir, '{}.zip'.format(i))) for i in range(200)]
+    downloader = Downloader(workers=16, progress=False)
+    return lambda: downloader.download_all(jobs)
+
+
+# Satellite (against the fake `ee`)
+
+@benchmark('satellite.get_feature_image', sized=False)
+def satellite_get_feature_image(fx):
+    from ..satellite import Satellite
+    sat = Satellite()
+    geom = {'type': 'Point', 'coordinates': [-60, -10]}
+    return lambda: [sat.get_feature_image(geom) for _ in range(100)]
+
+
+@benchmark('satellite.get_feature_images', sized=False)
+def satellite_get_feature_images(fx):
+    import ee
+    from ..satellite import Satellite
+    sat = Satellite()
+    fc = ee.FeatureCollection('features')
+    return lambda: sat.get_feature_images(fc, chunk_size=50)
+
+
+@benchmark('satellite.download_images', sized=False)
+def satellite_download_images(fx):
+    import ee
+    from ..satellite import Satellite
+    from ..downloader import Downloader
+    server = FakeEEServer().__enter__()
+    sat = Satellite()
+    geom = {'type': 'Point', 'coordinates': [-60, -10]}
+    image, params = sat.get_feature_image(geom)
+    server.zip(256)
+    image.__class__.getDownloadURL = lambda self, params=None: server.url('zip/256')
+    outdir = fx.tmpdir()
+    jobs = [(image, params, os.path.join(outdir, '{}.png'.format(i))) for i in range(100)]
+    return lambda: sat.download_images(jobs, downloader=Downloader(workers=16, progress=False))
+
+
+@benchmark('satellite.cached_rerun', sized=False)
+def satellite_cached_rerun(fx):
+    """A repeated run that should be served entirely from the cache"""
+    from ..cache import Cache
+    from ..satellite import Satellite
+    server = FakeEEServer().__enter__()
+    server.zip(256)
+    sat = Satellite(cache=Cache(fx.tmpdir()))
+    geoms = [{'type': 'Point', 'coordinates': [-60 + i*0.1, -10]} for i in range(50)]
+    outdir = fx.tmpdir()
+    def run():
+        for i, geom in enumerate(geoms):
+            image, params = sat.get_feature_image(geom)
+            image.__class__.getDownloadURL = lambda self, params=None: server.url('zip/256')
+            sat.download_image(image, params, os.path.join(outdir, '{}.png'.format(i)))
+    run()
+    return lambda: run() or {'hit_rate': sat.cache.hit_rate()}
+
+
+# Spatial
+
+@benchmark('spatial.rtree_query', sized=False)
+def spatial_rtree_query(fx):
+    from ..spatial import RTree, bounds_array
+    from .spatial import random_polygons
+    boxes = bounds_array(random_polygons(100000))
+    queries = bounds_array(random_polygons(1000, seed=1))
+    queries[:, 2:] += 2
+    def op():
+        tree = RTree(boxes)
+        tree.query_many(queries)
+    return op
@@ -0,0 +1,111 @@
+"""
+Load test for `tileserver`: requests tiles over several keep-alive
+connections, with some tiles much hotter than others (as when many
+viewers look at the same area), and reports tiles per second and
+latency percentiles, first with a cold cache and then a warm one.
+
+    python -m peng.bench.tileserver                     # against a synthetic fixture
+    python -m peng.bench.tileserver --path mosaic.tif --requests 5000 --overviews
+"""
+
+import os
+import asyncio
+import argparse
+import tempfile
+import numpy as np
+from time import perf_counter
+from .fixtures import make_geotiff
+from ..tileserver import TileServer
+
+
+def tile_paths(server, n, zooms=3, seed=0):
+    """`n` tile paths from the `zooms` most detailed levels,
+    picked with a Zipf-like skew towards a few hot tiles"""
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for z in range(max(0, server.z_max - zooms + 1), server.z_max + 1):
+        f = server.tile_size * 2**(server.z_max - z)
+        tiles += [(z, x, y) for x in range(-(-server.width // f)) for y in range(-(-server.height // f))]
+    rng.shuffle(tiles)
+    weights = 1 / np.arange(1, len(tiles) + 1)
+    picks = rng.choice(len(tiles), size=n, p=weights / weights.sum())
+    return ['/{}/{}/{}.png'.format(*tiles[i]) for i in picks]
+
+
+async def fetch(reader, writer, path):
+    writer.write('GET {} HTTP/1.1\r\nHost: bench\r\n\r\n'.format(path).encode('latin1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line == b'\r\n':
+            break
+        name, _, value = line.decode('latin1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def load(host, port, paths, connections):
+    """Request `paths` across `connections` clients,
+    returning the elapsed time and each request's latency"""
+    todo = iter(paths)
+    latencies, statuses = [], {}
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        for path in todo:
+            start = perf_counter()
+            status = await fetch(reader, writer, path)
+            latencies.append(perf_counter() - start)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+        await writer.wait_closed()
+
+    start = perf_counter()
+    await asyncio.gather(*[client() for _ in range(connections)])
+    return perf_counter() - start, np.array(latencies), statuses
+
+
+async def run(path, requests, connections, processes, port, overviews=False):
+    server = TileServer(path, processes=processes, overviews=overviews)
+    listener = await server.start('127.0.0.1', port)
+    port = listener.sockets[0].getsockname()[1]
+    paths = tile_paths(server, requests)
+    print('{}x{} raster, zooms 0-{}, {} requests over {} connections'.format(
+        server.width, server.height, server.z_max, requests, connections))
+    print('{:<6} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8}'.format(
+        'cache', 'tiles/s', 'p50 ms', 'p99 ms', 'renders', 'shared', 'hits'))
+    try:
+        for label in ['cold', 'warm']:
+            before = dict(server.stats)
+            elapsed, latencies, _ = await load('127.0.0.1', port, paths, connections)
+            stats = {k: v - before[k] for k, v in server.stats.items()}
+            print('{:<6} {:>9.1f} {:>9.2f} {:>9.2f} {:>8} {:>8} {:>8}'.format(
+                label, len(latencies) / elapsed,
+                np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000,
+                stats['renders'], stats['shared'], stats['hits']))
+    finally:
+        # Let the server see the clients hang up
+        await asyncio.sleep(0.1)
+        listener.close()
+        await listener.wait_closed()
+        server.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default=None, help='GeoTIFF to serve (default: a synthetic one)')
+    parser.add_argument('--size', type=int, default=4096, help='side of the synthetic GeoTIFF')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--connections', type=int, default=32)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--overviews', action='store_true', help='build missing overviews first')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = args.path or make_geotiff(os.path.join(tmpdir, 'tiles.tif'), args.size)
+        asyncio.run(run(path, args.requests, args.connections, args.processes, args.port, args.overviews))
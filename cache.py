@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from .metrics import metrics
+
+TMP_PREFIX = '.tmp-'
+
+
+def request_key(*parts):
+    """canonical hash of a request;
+    `parts` must be JSON-serializable"""
+    blob = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(blob.encode('utf8')).hexdigest()
+
+
+def scan(root, stale_after=3600):
+    """list (mtime, size, path) for every cached file,
+    removing temp files abandoned by crashed writers"""
+    entries = []
+    now = time.time()
+    for dirpath, _, fnames in os.walk(root):
+        for fname in fnames:
+            path = os.path.join(dirpath, fname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue # Removed by another process
+            if fname.startswith(TMP_PREFIX):
+                if now - st.st_mtime > stale_after:
+                    remove(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def _read_json(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def evict(root, max_bytes):
+    """remove least-recently-used files until `root` fits
+    in `max_bytes`; returns the number of files removed.
+    Recency is the file mtime, which is bumped on each hit"""
+    entries = scan(root)
+    total = sum(size for _, size, _ in entries)
+    n_evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if remove(path):
+            n_evicted += 1
+        total -= size
+    return n_evicted, total
+
+
+class Cache:
+    """Persistent, content-addressed file cache.
+
+    Files are stored under `root` by key and written atomically
+    (to a temp file, then renamed into place), so several processes
+    can share the same cache directory. When it grows past
+    `max_bytes` the least-recently-used files are evicted.
+
+        cache = Cache('/data/cache', max_bytes=50<<30)
+        key = request_key('image', image.serialize(), params)
+        path = cache.get(key, '.png')
+        if path is None:
+            with cache.write(key, '.png') as tmp:
+                download_ee_image(url, id, tmp)
+
+    Another process may evict a file between `get` and using it;
+    `load` (and `copy`) only count a hit once the file was read.
+    """
+    def __init__(self, root, max_bytes=10<<30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key, ext=''):
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def get(self, key, ext=''):
+        """path to the cached file, or `None` on a miss"""
+        path = self.path(key, ext)
+        try:
+            # Mark as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            self._count('misses')
+            metrics.count('cache_misses', ext=ext)
+            return None
+        self._count('hits')
+        metrics.count('cache_hits', ext=ext)
+        return path
+
+    def load(self, key, read, ext='', errors=(FileNotFoundError,)):
+        """`read(path)` of the cached file, or `None` on a miss;
+        `errors` raised by `read` (e.g. as the file was evicted
+        in the meantime) are also misses"""
+        path = self.path(key, ext)
+        try:
+            os.utime(path)
+            data = read(path)
+        except errors:
+            self._count('misses')
+            metrics.count('cache_misses', ext=ext)
+            return None
+        self._count('hits')
+        metrics.count('cache_hits', ext=ext)
+        return data
+
+    def copy(self, key, dst, ext=''):
+        """copy the cached file to `dst`; returns
+        `dst`, or `None` on a miss"""
+        return self.load(key, lambda path: shutil.copyfile(path, dst), ext)
+
+    def _count(self, stat, n=1):
+        # Several downloader threads may share the cache
+        with self._lock:
+            self.stats[stat] += n
+
+    @contextmanager
+    def write(self, key, ext=''):
+        """yields a temp path to write to, which is
+        moved into the cache if the block succeeds"""
+        path = self.path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX, suffix=ext)
+        os.close(fd)
+        try:
+            yield tmp
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            remove(tmp)
+            raise
+        self._count('writes')
+        self._added(size)
+
+    def put(self, key, src, ext=''):
+        """copy `src` into the cache"""
+        with self.write(key, ext) as tmp:
+            shutil.copyfile(src, tmp)
+        return self.path(key, ext)
+
+    def get_json(self, key):
+        return self.load(key, _read_json, '.json')
+
+    def put_json(self, key, data):
+        with self.write(key, '.json') as tmp:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+
+    def _added(self, size):
+        # Other processes may be writing too, so the running
+        # total is only an estimate; rescan before evicting
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in scan(self.root))
+            else:
+                self._size += size
+            if self._size <= self.max_bytes:
+                return
+            n_evicted, self._size = evict(self.root, self.max_bytes)
+        self._count('evictions', n_evicted)
+        metrics.count('cache_evictions', n_evicted)
+
+    def hit_rate(self):
+        with self._lock:
+            hits, misses = self.stats['hits'], self.stats['misses']
+        total = hits + misses
+        return hits/total if total else 0.
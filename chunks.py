@@ -0,0 +1,94 @@
+"""
+Cache of decoded raster chunks, so repeated windowed reads of
+the same (compressed) GeoTIFFs cost a memory copy instead of a decode.
+
+Chunks are stored as `.npy` files in a `cache.Cache` (so writes are
+atomic and the cache is size-bounded, evicting least-recently-used
+chunks) and are memory-mapped when read, so processes sharing a
+cache directory share the decoded data through the page cache.
+Chunks are keyed by the source's path, size and mtime, so changing
+a file invalidates its chunks.
+
+    chunks = ChunkCache('/data/chunk-cache', max_bytes=20<<30)
+    geotiff = GeoTIFF('mosaic.tif', chunk_cache=chunks)
+    data = geotiff.read(1, window=Window(1000, 1000, 512, 512))
+"""
+
+import os
+import numpy as np
+from rasterio.windows import Window
+from .cache import Cache, request_key
+
+
+def _load(path):
+    return np.load(path, mmap_mode='r')
+
+
+class ChunkCache:
+    def __init__(self, root, max_bytes=10<<30, chunk_size=512):
+        self.cache = Cache(root, max_bytes)
+        self.chunk_size = chunk_size
+
+    def source_key(self, dataset):
+        """Identifies the dataset's file as it is now,
+        or `None` if it isn't a plain file"""
+        try:
+            st = os.stat(dataset.name)
+        except (OSError, ValueError):
+            return None
+        return request_key('chunks', os.path.abspath(dataset.name),
+                           st.st_size, st.st_mtime_ns, self.chunk_size)
+
+    def chunk(self, dataset, source, row, col):
+        """The `(band, row, col)` data of one chunk (all bands),
+        memory-mapped from the cache or read and cached"""
+        key = request_key(source, row, col)
+        # Evicted or being replaced counts as a miss; read it again
+        data = self.cache.load(key, _load, '.npy', errors=(FileNotFoundError, ValueError))
+        if data is not None:
+            return data
+
+        size = self.chunk_size
+        window = Window(col*size, row*size,
+                        min(size, dataset.width - col*size),
+                        min(size, dataset.height - row*size))
+        data = dataset.read(window=window)
+        with self.cache.write(key, '.npy') as tmp:
+            with open(tmp, 'wb') as f:
+                np.save(f, data)
+        return data
+
+    def read(self, dataset, indexes=None, window=None):
+        """Like `dataset.read(indexes, window=window)`, through the
+        cache. Windows that aren't whole pixels inside the dataset
+        (and datasets that aren't files) are read directly"""
+        source = self.source_key(dataset)
+        if window is None:
+            window = Window(0, 0, dataset.width, dataset.height)
+        col0, row0, width, height = [getattr(window, a) for a in ['col_off', 'row_off', 'width', 'height']]
+        whole = all(float(v).is_integer() for v in [col0, row0, width, height])
+        inside = col0 >= 0 and row0 >= 0 and col0 + width <= dataset.width and row0 + height <= dataset.height
+        if source is None or not whole or not inside:
+            return dataset.read(indexes, window=window)
+        col0, row0, width, height = int(col0), int(row0), int(width), int(height)
+
+        bands = indexes if indexes is not None else list(range(1, dataset.count + 1))
+        band_idx = np.atleast_1d(bands) - 1
+        if np.array_equal(band_idx, np.arange(band_idx[0], band_idx[-1] + 1)):
+            # Contiguous bands can be sliced, saving a copy
+            band_idx = slice(band_idx[0], band_idx[-1] + 1)
+        out = np.empty((len(np.atleast_1d(bands)), height, width), dtype=dataset.dtypes[np.atleast_1d(bands)[0] - 1])
+
+        size = self.chunk_size
+        for row in range(row0 // size, (row0 + height - 1) // size + 1):
+            for col in range(col0 // size, (col0 + width - 1) // size + 1):
+                data = self.chunk(dataset, source, row, col)
+
+                # Overlap of the chunk and the window, in dataset pixels
+                r0, r1 = max(row0, row*size), min(row0 + height, (row+1)*size)
+                c0, c1 = max(col0, col*size), min(col0 + width, (col+1)*size)
+                out[:, r0-row0:r1-row0, c0-col0:c1-col0] = \
+                    data[band_idx, r0-row*size:r1-row*size, c0-col*size:c1-col*size]
+
+        # A single band index gives a 2D array, as with rasterio
+        return out[0] if np.ndim(bands) == 0 else out
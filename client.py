@@ -0,0 +1,38 @@
+import threading
+
+
+class Client:
+    """Earth Engine session, initialized on first use
+    rather than at import time.
+
+        client = Client(project='my-project')
+        ee = client.ee # Initializes here
+    """
+    def __init__(self, **kwargs):
+        # Passed to `ee.Initialize`
+        self.kwargs = kwargs
+        self._ee = None
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        """initialize Earth Engine, if it isn't already;
+        returns the `ee` module"""
+        if self._ee is None:
+            with self._lock:
+                if self._ee is None:
+                    import ee
+                    ee.Initialize(**self.kwargs)
+                    self._ee = ee
+        return self._ee
+
+    @property
+    def ee(self):
+        return self.initialize()
+
+    @property
+    def initialized(self):
+        return self._ee is not None
+
+
+# Shared by everything that isn't given its own client
+default_client = Client()
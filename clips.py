@@ -0,0 +1,150 @@
+"""
+Extract one masked clip per feature from a GeoTIFF,
+reading only the windows the features cover.
+
+Features close to each other are grouped so they share a single read,
+and groups are processed across a process pool. Each worker only holds
+one group's window in memory at a time. A group's features start in the
+same `group_size` cell and are at most `group_size` across, so its window
+is under `2*group_size` pixels on a side (or the size of the single clip,
+for features bigger than that).
+
+    clips = extract_clips('mosaic.tif', feats)
+    paths = extract_clips('mosaic.tif', feats, outdir='clips/')
+"""
+
+import os
+import re
+import rasterio
+import numpy as np
+from tqdm import tqdm
+from multiprocessing import Pool
+from rasterio.windows import Window
+from rasterio.features import geometry_mask, bounds as geometry_bounds
+
+# Per-process state for the pool workers
+_worker = {}
+
+
+def feature_windows(transform, width, height, geoms):
+    """Pixel windows `(col0, row0, col1, row1)` covering each geometry,
+    clipped to the raster; empty windows have col1 <= col0 or row1 <= row0"""
+    boxes = np.array([geometry_bounds(geom) for geom in geoms], dtype='float64').reshape(-1, 4)
+    corners_x = np.concatenate([boxes[:, 0], boxes[:, 2], boxes[:, 0], boxes[:, 2]])
+    corners_y = np.concatenate([boxes[:, 1], boxes[:, 3], boxes[:, 3], boxes[:, 1]])
+    cols, rows = ~transform * (corners_x, corners_y)
+    cols, rows = cols.reshape(4, -1), rows.reshape(4, -1)
+    col0 = np.clip(np.floor(cols.min(axis=0)), 0, width).astype('int64')
+    row0 = np.clip(np.floor(rows.min(axis=0)), 0, height).astype('int64')
+    col1 = np.clip(np.ceil(cols.max(axis=0)), 0, width).astype('int64')
+    row1 = np.clip(np.ceil(rows.max(axis=0)), 0, height).astype('int64')
+    return np.column_stack([col0, row0, col1, row1])
+
+
+def group_windows(windows, group_size):
+    """Group features whose windows start in the same `group_size`
+    grid cell, so they can share a read (of under `2*group_size`
+    pixels on a side, as they can extend past the cell). Features
+    bigger than a cell are read on their own. Returns lists of
+    feature indices"""
+    valid = (windows[:, 2] > windows[:, 0]) & (windows[:, 3] > windows[:, 1])
+    big = ((windows[:, 2] - windows[:, 0]) > group_size) | ((windows[:, 3] - windows[:, 1]) > group_size)
+
+    groups = [[i] for i in np.flatnonzero(valid & big).tolist()]
+    small = np.flatnonzero(valid & ~big)
+    cells = np.column_stack([windows[small, 0] // group_size, windows[small, 1] // group_size])
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+    small, cells = small[order], cells[order]
+    starts = np.flatnonzero(np.r_[True, np.any(cells[1:] != cells[:-1], axis=1)])
+    for start, end in zip(starts, np.r_[starts[1:], len(small)]):
+        groups.append(small[start:end].tolist())
+    return groups
+
+
+def clip_names(ids):
+    """File names (without extension) for feature ids: characters
+    other than letters, digits, `-`, `_` and `.` are replaced, so
+    an id can't point outside the output folder, and names that
+    end up the same are made unique by appending the feature index"""
+    names, seen = [], set()
+    for i, id in enumerate(ids):
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', str(id)).lstrip('.') or '_'
+        if name in seen:
+            name = '{}-{}'.format(name, i)
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _init_worker(path, outdir, all_touched):
+    _worker.update({
+        'dataset': rasterio.open(path),
+        'outdir': outdir,
+        'all_touched': all_touched,
+    })
+
+
+def _clip_group(members):
+    """read a group's window once and clip each of its features from it"""
+    dataset = _worker['dataset']
+    outdir = _worker['outdir']
+    nodata = dataset.nodata or 0
+
+    col0 = min(w[0] for _, _, _, w in members)
+    row0 = min(w[1] for _, _, _, w in members)
+    col1 = max(w[2] for _, _, _, w in members)
+    row1 = max(w[3] for _, _, _, w in members)
+    data = dataset.read(window=Window(col0, row0, col1 - col0, row1 - row0))
+
+    results = []
+    for idx, name, geom, (c0, r0, c1, r1) in members:
+        window = Window(c0, r0, c1 - c0, r1 - r0)
+        transform = dataset.window_transform(window)
+        clip = data[:, r0-row0:r1-row0, c0-col0:c1-col0].copy()
+        mask = geometry_mask([geom], out_shape=clip.shape[1:], transform=transform,
+                             all_touched=_worker['all_touched'])
+        clip[:, mask] = nodata
+
+        if outdir is None:
+            results.append((idx, (clip, transform)))
+        else:
+            path = os.path.join(outdir, '{}.tif'.format(name))
+            profile = dataset.profile.copy()
+            profile.update(driver='GTiff', height=clip.shape[1], width=clip.shape[2],
+                           transform=transform, nodata=nodata)
+            profile.pop('blockxsize', None)
+            profile.pop('blockysize', None)
+            profile.pop('tiled', None)
+            with rasterio.open(path, 'w', **profile) as dst:
+                dst.write(clip)
+            results.append((idx, path))
+    return results
+
+
+def extract_clips(path, feats, outdir=None, processes=None, group_size=512, all_touched=False):
+    """Clip the GeoTIFF at `path` to each feature's geometry
+    (in the raster's CRS), masking pixels outside it with nodata.
+
+    Returns, in feature order, `(data, transform)` for each feature,
+    or, if `outdir` is given, the path of each clip written there
+    (named by the feature's `id`, if it has one; see `clip_names`).
+    Features that don't overlap the raster get `None`"""
+    geoms = [feat['geometry'] for feat in feats]
+    names = clip_names([feat.get('id', i) for i, feat in enumerate(feats)])
+    with rasterio.open(path) as dataset:
+        windows = feature_windows(dataset.transform, dataset.width, dataset.height, geoms)
+
+    jobs = [[(i, names[i], geoms[i], tuple(windows[i].tolist())) for i in group]
+            for group in group_windows(windows, group_size)]
+
+    if outdir is not None:
+        os.makedirs(outdir, exist_ok=True)
+
+    results = [None for _ in feats]
+    with Pool(processes, initializer=_init_worker, initargs=(path, outdir, all_touched)) as p:
+        with tqdm(total=sum(len(job) for job in jobs), desc='Clipping') as bar:
+            for group in p.imap_unordered(_clip_group, jobs):
+                for idx, result in group:
+                    results[idx] = result
+                bar.update(len(group))
+    return results
@@ -0,0 +1,157 @@
+"""
+An on-disk `(time, band, row, col)` array, memory-mapped so that
+reading a pixel's (or a window's) time series only touches the
+pages it needs, and that grows along time as periods are added.
+
+A cube is a directory with the raw array (`data.bin`, C order)
+and its metadata (`meta.json`: shape, dtype, period labels, which
+periods are still pending and, optionally, the georeferencing
+of the rows and columns).
+
+    cube = Cube.create('cube/', bands=['red', 'green', 'blue'], height=512, width=512)
+    cube.append('2020-01', data)     # (band, row, col)
+    cube.pixel(100, 200)             # (time, band)
+"""
+
+import os
+import json
+import tempfile
+import threading
+import numpy as np
+
+META = 'meta.json'
+DATA = 'data.bin'
+
+
+class Cube:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META), 'r') as f:
+            self.meta = json.load(f)
+        self._data = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, bands, height, width, dtype='uint8', transform=None, crs=None):
+        """Create an empty cube at `path`"""
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META)):
+            raise FileExistsError('A cube already exists at {}'.format(path))
+        open(os.path.join(path, DATA), 'wb').close()
+        _write_meta(path, {
+            'bands': list(bands),
+            'height': height,
+            'width': width,
+            'dtype': np.dtype(dtype).str,
+            'transform': None if transform is None else list(transform)[:6],
+            'crs': None if crs is None else str(crs),
+            'times': [],
+            'pending': [],
+        })
+        return cls(path)
+
+    @classmethod
+    def open_or_create(cls, path, **kwargs):
+        if os.path.exists(os.path.join(path, META)):
+            return cls(path)
+        return cls.create(path, **kwargs)
+
+    @property
+    def times(self):
+        return self.meta['times']
+
+    @property
+    def bands(self):
+        return self.meta['bands']
+
+    @property
+    def shape(self):
+        return (len(self.times), len(self.bands), self.meta['height'], self.meta['width'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self.meta['dtype'])
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def data(self):
+        """The whole cube as a (writable) memory map"""
+        data = self._data
+        if data is None or data.shape != self.shape:
+            if not len(self):
+                return np.zeros(self.shape, dtype=self.dtype)
+            data = self._data = np.memmap(os.path.join(self.path, DATA), dtype=self.dtype,
+                                          mode='r+', shape=self.shape)
+        return data
+
+    @property
+    def pending(self):
+        """Periods added with `extend` that haven't been marked done"""
+        return self.meta['pending']
+
+    def extend(self, times):
+        """Add empty (zeroed) periods, returning their indices
+        so they can be filled in with `write`, in any order
+        and from any thread. They're pending until marked `done`"""
+        with self._lock:
+            start = len(self)
+            _, n_bands, height, width = self.shape
+            slice_bytes = n_bands * height * width * self.dtype.itemsize
+
+            # Grow the file first, so the metadata never
+            # describes more data than there is
+            with open(os.path.join(self.path, DATA), 'r+b') as f:
+                f.truncate((start + len(times)) * slice_bytes)
+            self.meta['times'] = self.times + list(times)
+            self.meta['pending'] = self.pending + list(times)
+            _write_meta(self.path, self.meta)
+            self._data = None
+        return list(range(start, start + len(times)))
+
+    def write(self, i, data):
+        """Write `(band, row, col)` data for the `i`th period.
+        Data that's off by a few pixels (as downloads can be)
+        is cropped or written into the top-left"""
+        data = np.asarray(data)
+        height, width = min(data.shape[-2], self.shape[2]), min(data.shape[-1], self.shape[3])
+        self.data[i, :, :height, :width] = data[:, :height, :width]
+
+    def done(self, times):
+        """Mark periods as filled in"""
+        self.flush()
+        with self._lock:
+            self.meta['pending'] = [t for t in self.pending if t not in times]
+            _write_meta(self.path, self.meta)
+
+    def append(self, time, data):
+        """Add a period's `(band, row, col)` data"""
+        i, = self.extend([time])
+        self.write(i, data)
+        self.done([time])
+        return i
+
+    def flush(self):
+        if self._data is not None:
+            self._data.flush()
+
+    def pixel(self, row, col, bands=None):
+        """A pixel's time series, as `(time, band)`"""
+        series = self.data[:, :, row, col]
+        return np.array(series if bands is None else series[:, bands])
+
+    def window(self, row0, col0, height, width, times=None):
+        """A window's time series, as `(time, band, row, col)`"""
+        data = self.data[..., row0:row0+height, col0:col0+width]
+        return np.array(data if times is None else data[times])
+
+    def index(self, time):
+        return self.times.index(time)
+
+
+def _write_meta(path, meta):
+    fd, tmp = tempfile.mkstemp(dir=path, prefix='.tmp-', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(path, META))
@@ -0,0 +1,91 @@
+import time
+import requests
+import threading
+from tqdm import tqdm
+from urllib.parse import urlparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .util import make_session, download, backoff_delay, should_retry, RETRY_STATUSES
+from .metrics import metrics
+
+class Downloader:
+    """Runs many download jobs through a bounded thread pool
+    that shares one keep-alive connection pool.
+
+        downloader = Downloader(workers=16, per_host=8)
+        downloader.download_all([(url, '/tmp/a.zip'), (url2, '/tmp/b.zip')])
+
+    Transient errors (see `util.should_retry`) are retried up to
+    `retries` times; anything else fails the job straight away.
+    Errors that were retried are collected in `retried` (as
+    `(attempt, exception)`) and jobs that failed for good in
+    `errors` (as `(job index, exception)`)
+    """
+    def __init__(self, workers=8, per_host=4, retries=5, backoff=0.5, max_backoff=30.,
+                 timeout=60, progress=True, callback=None):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.progress = progress
+
+        # Called as `callback(n_done, n_total, result)`
+        # after each job finishes
+        self.callback = callback
+
+        self.session = make_session(pool_size=workers)
+        self._hosts = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+        self._lock = threading.Lock()
+        self.retried = []
+        self.errors = []
+
+    def host_slot(self, url):
+        """semaphore limiting concurrent requests to this url's host"""
+        host = urlparse(url).netloc
+        with self._lock:
+            return self._hosts[host]
+
+    def retry(self, fn, *args, **kwargs):
+        """call `fn`, retrying with backoff on transient errors"""
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not should_retry(e):
+                    raise
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                metrics.count('retries', error=type(e).__name__)
+                with self._lock:
+                    self.retried.append((attempt+1, e))
+                time.sleep(delay)
+
+    def fetch(self, url, outfile):
+        """download a single url into `outfile`"""
+        with self.host_slot(url), metrics.span('download'):
+            return download(url, outfile, session=self.session, timeout=self.timeout)
+
+    def run(self, fn, jobs, desc='Downloading'):
+        """run `fn(*job)` for each job across the pool.
+        Results are returned in job order;
+        failed jobs hold their exception instead"""
+        jobs = list(jobs)
+        results = [None for _ in jobs]
+        with ThreadPoolExecutor(self.workers) as pool:
+            futs = {pool.submit(self.retry, fn, *job): i for i, job in enumerate(jobs)}
+            done = as_completed(futs)
+            for n, fut in enumerate(tqdm(done, total=len(futs), desc=desc, disable=not self.progress)):
+                i = futs[fut]
+                try:
+                    results[i] = fut.result()
+                except Exception as e:
+                    metrics.count('failed_jobs', error=type(e).__name__)
+                    self.errors.append((i, e))
+                    results[i] = e
+                if self.callback is not None:
+                    self.callback(n+1, len(jobs), results[i])
+        return results
+
+    def download_all(self, jobs):
+        """download many (url, outfile) jobs"""
+        return self.run(self.fetch, jobs)
@@ -29,50 +29,218 @@ Usage:
 
     # Sometimes this doesn't work with the virtual display.
     earth = EarthWeb('path/to/cookies.txt', virtual_display=False)
-    earth.screenshot({'lat': 40.7188, 'lng': -73.8052}, '/tmp/shot.png')
+    earth.screenshot({'lat': 40.7188, 'lng': -73.8052}, 1000, '/tmp/shot.png')
     earth.close()
 
+    # Or, for many points, across several browsers:
+    pool = CapturePool('path/to/cookies.txt', workers=4)
+    paths = pool.run([(point, 1000, '/tmp/{}.png'.format(i)) for i, point in enumerate(points)])
+
+Instead of sleeping for a fixed time, each step waits for the page
+to be ready (the elements it needs exist) and for rendering to finish
+(the loading indicator is hidden and consecutive screenshots stop
+changing), up to a timeout.
+
 Note on cookies: it seems many cookie prefixed with '__' don't load correctly, so I deleted them from cookies.txt.
 """
 
-from time import sleep
-from browser import Browser
+import os
+import queue
+import hashlib
+import tempfile
+import warnings
+import threading
+from time import sleep, monotonic
+from tqdm import tqdm
 
 URL_TMPL = 'https://earth.google.com/web/@{lat},{lng},{alt}a,1350.77250487d,35y,124.67647195h,0t,0r/data=CigiJgokCcwv6r_SvDVAEcov6r_SvDXAGdVXxIMUsEdAIcVzI_96RUzA'
 
+APP = "document.querySelector('earth-app')"
+
+# The page is ready once the elements the scripts below use exist
+READY_SCRIPT = '''
+    var app = ''' + APP + ''';
+    return document.readyState === 'complete' && !!app && !!app.shadowRoot &&
+        !!app.shadowRoot.querySelector('earth-toolbar') &&
+        !!app.shadowRoot.querySelector('earth-toolbar').shadowRoot &&
+        !!app.shadowRoot.querySelector('earth-drawer') &&
+        !!app.shadowRoot.querySelector('earth-drawer').shadowRoot
+'''
+
+CLEAN_VIEW_SCRIPT = '''
+    document.querySelector('earth-app').shadowRoot.querySelector('earth-toolbar').shadowRoot.querySelector('#mapStyle').click()
+    document.querySelector('earth-app').shadowRoot.querySelector('earth-drawer').shadowRoot.querySelector('#mapstyle').shadowRoot.querySelector('aside earth-radio-card').click()
+    document.querySelector('earth-app').shadowRoot.querySelector('earth-drawer').shadowRoot.querySelector('earth-map-styles-view').shadowRoot.querySelector('#backButton').click()
+'''
+
+# Imagery is still loading while the view status (which
+# shows loading progress) isn't hidden. `HIDE_UI_SCRIPT` only
+# hides it from screenshots, with its style, so that doesn't count
+LOADED_SCRIPT = '''
+    var status = ''' + APP + '''.shadowRoot.querySelector('earth-view-status');
+    return !status || status.hidden
+'''
+
+HIDE_UI_SCRIPT = '''
+    document.querySelector('earth-app').shadowRoot.querySelector('#toolbar').style.display = 'none';
+    document.querySelector('earth-app').shadowRoot.querySelector('#earthNavigationElements').style.display = 'none';
+    document.querySelector('earth-app').shadowRoot.querySelector('earth-drawing-tools').style.display = 'none';
+    document.querySelector('earth-app').shadowRoot.querySelector('earth-view-status').style.display = 'none'
+'''
+
+
+def default_browser(virtual_display=True):
+    from browser import Browser
+    return Browser(virtual_display=virtual_display)
+
+
 class EarthWeb:
-    def __init__(self, cookies_path, virtual_display=True, sleep=10):
+    def __init__(self, cookies_path, virtual_display=True, sleep=None, timeout=60, interval=0.5, settle=2,
+                 browser=None, url_tmpl=URL_TMPL, home='https://google.com'):
+        """`timeout` is how long to wait at most for the page
+        to be ready or to finish rendering; readiness is polled
+        every `interval` seconds, and rendering is done once
+        `settle` consecutive screenshots are identical.
+
+        `sleep` (a fixed wait before each screenshot) is deprecated;
+        if it's given, it's used as the `timeout`"""
+        if sleep is not None:
+            warnings.warn('EarthWeb(sleep=...) is deprecated, use timeout=... instead; '
+                          'screenshots are taken as soon as the page has rendered',
+                          DeprecationWarning, stacklevel=2)
+            timeout = sleep
+        self.browser = browser or default_browser(virtual_display)
+        self.timeout = timeout
+        self.interval = interval
+        self.settle = settle
+        self.url_tmpl = url_tmpl
+
         # Need to load the cookies
-        self.browser = Browser(virtual_display=virtual_display)
-        self.browser.visit('https://google.com')
+        self.browser.visit(home)
         self.browser.load_cookies(cookies_path)
 
-        # How long to pause between actions
-        self.sleep = sleep
+    def wait_for(self, script, timeout=None, what='the page'):
+        """Wait for `script` to return something truthy"""
+        deadline = monotonic() + (timeout or self.timeout)
+        while True:
+            if self.browser.execute_script(script):
+                return
+            if monotonic() >= deadline:
+                raise TimeoutError('Timed out waiting for {}'.format(what))
+            sleep(self.interval)
+
+    def wait_for_render(self, fname, timeout=None):
+        """Wait for the loading indicator to be hidden, then take
+        screenshots into `fname` until `settle` consecutive ones
+        are identical, within one `timeout`"""
+        deadline = monotonic() + (timeout or self.timeout)
+        self.wait_for(LOADED_SCRIPT, timeout, 'imagery to load')
+        prev, stable = None, 0
+        while True:
+            self.browser.screenshot(fname)
+            with open(fname, 'rb') as f:
+                digest = hashlib.sha1(f.read()).digest()
+            stable = stable + 1 if digest == prev else 0
+            if stable >= self.settle - 1:
+                return fname
+            if monotonic() >= deadline:
+                raise TimeoutError('Timed out waiting for rendering to finish')
+            prev = digest
+            sleep(self.interval)
 
     def screenshot(self, point, altitude, fname):
-        url = URL_TMPL.format(alt=altitude, **point)
+        url = self.url_tmpl.format(alt=altitude, **point)
         self.browser.visit(url)
-        sleep(self.sleep)
+        self.wait_for(READY_SCRIPT)
 
         # Set to clean view
-        self.browser.execute_script('''
-            document.querySelector('earth-app').shadowRoot.querySelector('earth-toolbar').shadowRoot.querySelector('#mapStyle').click()
-            document.querySelector('earth-app').shadowRoot.querySelector('earth-drawer').shadowRoot.querySelector('#mapstyle').shadowRoot.querySelector('aside earth-radio-card').click()
-            document.querySelector('earth-app').shadowRoot.querySelector('earth-drawer').shadowRoot.querySelector('earth-map-styles-view').shadowRoot.querySelector('#backButton').click()
-        ''')
-
-        sleep(self.sleep)
+        self.browser.execute_script(CLEAN_VIEW_SCRIPT)
 
         # Hide toolbar UI
-        self.browser.execute_script('''
-            document.querySelector('earth-app').shadowRoot.querySelector('#toolbar').style.display = 'none';
-            document.querySelector('earth-app').shadowRoot.querySelector('#earthNavigationElements').style.display = 'none';
-            document.querySelector('earth-app').shadowRoot.querySelector('earth-drawing-tools').style.display = 'none';
-            document.querySelector('earth-app').shadowRoot.querySelector('earth-view-status').style.display = 'none'
-        ''')
-
-        self.browser.screenshot(fname)
+        self.browser.execute_script(HIDE_UI_SCRIPT)
+
+        # Render into a temp file, so a failed
+        # capture doesn't leave a partial one behind
+        dirname = os.path.dirname(os.path.abspath(fname))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-', suffix=os.path.splitext(fname)[1])
+        os.close(fd)
+        try:
+            self.wait_for_render(tmp)
+            os.replace(tmp, fname)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return fname
 
     def close(self):
-        self.browser.quit()
\ No newline at end of file
+        self.browser.quit()
+
+
+class CapturePool:
+    """Captures screenshots across `workers` browsers, each set up
+    (with cookies loaded) once and reused for many points.
+    Failed captures are retried up to `retries` times; a browser
+    that fails is replaced before its next job. Jobs that failed for
+    good are collected in `errors` (as `(job index, exception)`)"""
+    def __init__(self, cookies_path, workers=4, retries=2, make_browser=None, **kwargs):
+        self.cookies_path = cookies_path
+        self.workers = workers
+        self.retries = retries
+        self.make_browser = make_browser
+
+        # Passed to each `EarthWeb`
+        self.kwargs = kwargs
+        self.errors = []
+
+    def _earth(self):
+        browser = self.make_browser() if self.make_browser is not None else None
+        return EarthWeb(self.cookies_path, browser=browser, **self.kwargs)
+
+    def run(self, jobs, progress=True):
+        """Capture `(point, altitude, fname)` jobs.
+        Returns paths in job order; failed jobs hold their exception"""
+        jobs = list(jobs)
+        results = [None for _ in jobs]
+        todo = queue.Queue()
+        for i, job in enumerate(jobs):
+            todo.put((i, job, 0))
+        bar = tqdm(total=len(jobs), desc='Capturing', disable=not progress)
+        lock = threading.Lock()
+
+        def work():
+            earth = None
+            while True:
+                try:
+                    i, job, attempt = todo.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if earth is None:
+                        earth = self._earth()
+                    results[i] = earth.screenshot(*job)
+                except Exception as e:
+                    # Start over with a fresh browser
+                    if earth is not None:
+                        try:
+                            earth.close()
+                        except Exception:
+                            pass
+                        earth = None
+                    if attempt < self.retries:
+                        todo.put((i, job, attempt + 1))
+                        continue
+                    results[i] = e
+                    with lock:
+                        self.errors.append((i, e))
+                with lock:
+                    bar.update(1)
+            if earth is not None:
+                earth.close()
+
+        threads = [threading.Thread(target=work) for _ in range(min(self.workers, len(jobs)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        bar.close()
+        return results
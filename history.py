@@ -10,141 +10,333 @@ Usage:
 4. Run this script and then click on the Google Earth Pro window.
 
 __You can't interact with your computer while this is running, otherwise things will go wrong!__
+
+Rather than sleeping for fixed amounts of time, the capture loop waits
+for the screen to settle (by diffing small regions of it) and for saved
+files to be complete. Pasting the imagery date onto each saved image
+happens on a background thread, so the loop can move on to the next tick.
+
+`xdo`, the screenshot function (`grab(bbox=...)`, as `pyscreenshot.grab`),
+`sleep` and `clock` can all be swapped out, e.g. for fakes when testing.
 """
 
 import os
-from xdo import Xdo
+import queue
+import threading
+import numpy as np
 from PIL import Image
-from time import sleep
+from time import sleep, monotonic
 from tqdm import tqdm
-import pyscreenshot as ImageGrab
 
-SAVE_IMAGE_MODE = False
+# Imagery date at the bottom of the window, as
+# (left, top, right, bottom) offsets from its bottom-right corner
+DATE_STRIP = (1025, 35, 765, 10)
 
-xdo = Xdo()
-win_id = xdo.select_window_with_click()
 
+def connect():
+    """Connect to Xdo and have the user click
+    the Google Earth Pro window"""
+    from xdo import Xdo
+    xdo = Xdo()
+    win_id = xdo.select_window_with_click()
+    return xdo, win_id
+
+
+def is_complete_jpeg(path):
+    """If the file ends with the JPEG end-of-image marker"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-2, os.SEEK_END)
+            return f.read(2) == b'\xff\xd9'
+    except OSError:
+        return False
 
-def go_to(lat, lng):
-    """Go to a lat, lng by entering it into the search field"""
-    text = '{},{}'.format(lat, lng)
-
-    # Click on text input
-    xdo.move_mouse(150, 125)
-    xdo.click_window(win_id, 1)
-    xdo.enter_text_window(win_id, text.encode('utf8'))
-
-    sleep(0.5)
-
-    # Click search button
-    # move_reulative segfaults for some reason
-    # xdo.move_mouse_relative_to_window(win_id, 50, 50)
-    xdo.move_mouse(350, 125)
-    sleep(0.25)
-    xdo.click_window(win_id, 1)
-
-    # Hide yellow pin
-    xdo.move_mouse(375, 400)
-    xdo.click_window(win_id, 1)
-    xdo.move_mouse(375, 450)
-    xdo.click_window(win_id, 1)
-
-
-def clear_search():
-    """Clear search field"""
-    # Click on text input
-    xdo.move_mouse(150, 125)
-    xdo.click_window(win_id, 1)
-    xdo.send_keysequence_window(win_id, b'ctrl+a')
-    xdo.send_keysequence_window(win_id, b'Delete')
-
-
-def toggle_save_image_mode():
-    # There isn't (as far as I can tell)
-    # a way to track if the save image mode is active
-    # through the interface/Xdo.
-    # Try to keep track of it manually, though
-    # if the user toggles it manually through the UI
-    # then this will be out-of-sync.
-    SAVE_IMAGE_MODE = !SAVE_IMAGE_MODE
-
-    # For some reason this doesn't work
-    # xdo.send_keysequence_window(win_id, b'Control_L+Alt_L+s')
-
-    # Click "Save Image" icon
-    xdo.move_mouse(1250, 50)
-    xdo.click_window(win_id, 1)
-
-    sleep(0.25)
-
-
-def save_image(path):
-    # Ensure save image mode is active
-    if !SAVE_IMAGE_MODE:
-        toggle_save_image_mode()
-
-    filename = os.path.basename(path)
-
-    # Move to "Save Image..."
-    xdo.move_mouse(1000, 100)
-    xdo.click_window(win_id, 1)
-    sleep(2)
-
-    # Click "Save" button to open save dialog
-    save_dialog_id = xdo.get_active_window()
-    xdo.send_keysequence_window(save_dialog_id, b'ctrl+a')
-    xdo.send_keysequence_window(save_dialog_id, b'Delete')
-    sleep(1)
-    xdo.enter_text_window(save_dialog_id, filename.strip('.jpg').encode('utf8'))
-    sleep(1)
-
-    # Manually click "Save" button.
-    # Sending the 'Return' key causes libxdo to spam Return
-    # for some reason, breaking everything
-    xdo.move_mouse(1400, 850)
-    sleep(0.5)
-    xdo.click_window(save_dialog_id, 1)
-    sleep(8)
-
-    # Move to specified location
-    os.rename('/tmp/{}'.format(filename), path)
-
-    # Turn off save image mode
-    toggle_save_image_mode()
-
-
-def save_historical(ticks, dir):
-    """Save historical images
-    - ticks: how many images to save, starting from most recent to oldest"""
-
-    # Historical imagery must already be enabled
-    for i in tqdm(range(ticks)):
-        # Click back on historical timeline
-        # If save image bar is not active, this is the correct y position
-        xdo.move_mouse(480, 175)
-        # Otherwise, use:
-        # xdo.move_mouse(480, 225)
-        sleep(0.5)
-        xdo.click_window(win_id, 1)
-        sleep(3)
-
-        # Save the image
-        name = '{}'.format(ticks-i).zfill(4)
-        path = os.path.join(dir, '{}.jpg'.format(name))
-        save_image(path)
 
-        # Extract the imagery date
-        size = xdo.get_window_size(win_id)
-        shot = ImageGrab.grab(bbox=(0, 0, size.width, size.height))
-        bar_size = (1025, 50)
-        shot = shot.crop((size.width-bar_size[0], size.height-bar_size[1], size.width, size.height))
-        shot = shot.crop((0, 15, 260, 40))
+def file_state(path):
+    """What identifies a version of a file (inode,
+    mtime and size), or `None` if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def frames_differ(a, b, threshold=1.):
+    """If two frames' mean absolute pixel difference is over `threshold`"""
+    if a.shape != b.shape:
+        return True
+    return np.abs(a.astype('int16') - b.astype('int16')).mean() > threshold
+
+
+class PostProcessor:
+    """Background worker that moves saved images into place and
+    pastes their imagery date onto them, so the UI loop doesn't wait"""
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, src, path, strip):
+        # Blocks if the worker falls too far behind
+        self.queue.put((src, path, strip))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                self.process(*job)
+            except Exception as e:
+                print('Failed to process', job[1], e)
+                self.errors.append((job[1], e))
+            finally:
+                self.queue.task_done()
+
+    def process(self, src, path, strip):
+        os.replace(src, path)
 
         # Paste imagery date onto extracted image
-        im = Image.open(path)
-        im.paste(shot, (im.width-260, im.height-40))
+        with Image.open(path) as im:
+            im.load()
+        im.paste(strip, (im.width-260, im.height-40))
         im.save(path)
 
+    def close(self):
+        """wait for queued jobs to finish"""
+        self.queue.put(None)
+        self.thread.join()
+
+
+class EarthHistory:
+    def __init__(self, xdo, win_id, grab=None, save_dir='/tmp',
+                 sleep=sleep, clock=monotonic, timeout=30):
+        if grab is None:
+            import pyscreenshot
+            grab = pyscreenshot.grab
+        self.xdo = xdo
+        self.win_id = win_id
+        self.grab = grab
+        self.save_dir = save_dir
+        self.sleep = sleep
+        self.clock = clock
+        self.timeout = timeout
+
+        # There isn't (as far as I can tell)
+        # a way to track if the save image mode is active
+        # through the interface/Xdo.
+        # Try to keep track of it manually, though
+        # if the user toggles it manually through the UI
+        # then this will be out-of-sync.
+        self.save_image_mode = False
+
+    def go_to(self, lat, lng):
+        """Go to a lat, lng by entering it into the search field"""
+        xdo, win_id = self.xdo, self.win_id
+        text = '{},{}'.format(lat, lng)
+
+        # Click on text input
+        xdo.move_mouse(150, 125)
+        xdo.click_window(win_id, 1)
+        xdo.enter_text_window(win_id, text.encode('utf8'))
+
+        self.sleep(0.5)
+
+        # Click search button
+        # move_reulative segfaults for some reason
+        # xdo.move_mouse_relative_to_window(win_id, 50, 50)
+        xdo.move_mouse(350, 125)
+        self.sleep(0.25)
+        frames = self.frames()
+        xdo.click_window(win_id, 1)
+
+        # Hide yellow pin
+        xdo.move_mouse(375, 400)
+        xdo.click_window(win_id, 1)
+        xdo.move_mouse(375, 450)
+        xdo.click_window(win_id, 1)
+
+        # Wait for the fly-to animation to complete
+        self.wait_until_settled(changed_from=frames, timeout=15)
+
+    def clear_search(self):
+        """Clear search field"""
+        xdo, win_id = self.xdo, self.win_id
+
+        # Click on text input
+        xdo.move_mouse(150, 125)
+        xdo.click_window(win_id, 1)
+        xdo.send_keysequence_window(win_id, b'ctrl+a')
+        xdo.send_keysequence_window(win_id, b'Delete')
+
+    def toggle_save_image_mode(self):
+        self.save_image_mode = not self.save_image_mode
+
+        # For some reason this doesn't work
+        # xdo.send_keysequence_window(win_id, b'Control_L+Alt_L+s')
+
+        # Click "Save Image" icon
+        self.xdo.move_mouse(1250, 50)
+        self.xdo.click_window(self.win_id, 1)
+
+        self.sleep(0.25)
+
+    def regions(self):
+        """Screen regions watched for changes:
+        the imagery date and the middle of the map"""
+        size = self.xdo.get_window_size(self.win_id)
+        w, h = size.width, size.height
+        x0, y0, x1, y1 = DATE_STRIP
+        return [
+            (w-x0, h-y0, w-x1, h-y1),
+            (w//2-50, h//2-50, w//2+50, h//2+50),
+        ]
+
+    def frames(self, regions=None):
+        """Grab the watched regions"""
+        return [np.asarray(self.grab(bbox=r)) for r in (regions or self.regions())]
+
+    def wait_until_settled(self, changed_from=None, timeout=10, interval=0.1, settle=3, threshold=1.):
+        """Wait until the watched regions stop changing, i.e.
+        `settle` consecutive grabs within `threshold` of each other.
+        With `changed_from` (frames from before an action), first
+        wait for them to differ from those. Returns `(frames, settled)`:
+        the settled frames, or the latest ones (and `settled` false)
+        if it times out"""
+        regions = self.regions()
+        deadline = self.clock() + timeout
+        before, prev, stable = changed_from, None, 0
+        while True:
+            frames = self.frames(regions)
+
+            # Until this differs, it's still showing
+            # what was there before the action
+            if before is not None and any(
+                    frames_differ(a, b, threshold) for a, b in zip(frames, before)):
+                before = None
+
+            if before is None:
+                if prev is not None and not any(
+                        frames_differ(a, b, threshold) for a, b in zip(frames, prev)):
+                    stable += 1
+                    if stable >= settle:
+                        return frames, True
+                else:
+                    stable = 0
+                prev = frames
+
+            if self.clock() >= deadline:
+                return frames, False
+            self.sleep(interval)
+
+    def wait_for_window(self, timeout=10, interval=0.1):
+        """Wait for a window other than the main one
+        (e.g. a dialog) to become active, and return its id"""
+        deadline = self.clock() + timeout
+        while self.clock() < deadline:
+            active = self.xdo.get_active_window()
+            if active != self.win_id:
+                return active
+            self.sleep(interval)
+        raise TimeoutError('No dialog opened')
+
+    def wait_for_file(self, path, timeout=None, interval=0.1, previous=None):
+        """Wait until `path` exists and is completely written:
+        a JPEG end marker, or otherwise a size that stops changing.
+        With `previous` (its `file_state` from before saving), an
+        existing file only counts once it's been replaced or changed"""
+        deadline = self.clock() + (timeout or self.timeout)
+        last_size = None
+        while self.clock() < deadline:
+            state = file_state(path)
+            size = state[2] if state is not None and state != previous else None
+            if size:
+                if path.lower().endswith(('.jpg', '.jpeg')):
+                    if is_complete_jpeg(path):
+                        return path
+                elif size == last_size:
+                    return path
+            last_size = size
+            self.sleep(interval)
+        raise TimeoutError('{} was never saved'.format(path))
+
+    def save_image(self, filename):
+        """Save the current view to `filename` in the save directory,
+        returning the path once the file has been written"""
+        # Ensure save image mode is active
+        if not self.save_image_mode:
+            self.toggle_save_image_mode()
+
+        # Move to "Save Image..."
+        self.xdo.move_mouse(1000, 100)
+        self.xdo.click_window(self.win_id, 1)
+
+        # Click "Save" button to open save dialog
+        save_dialog_id = self.wait_for_window()
+        self.xdo.send_keysequence_window(save_dialog_id, b'ctrl+a')
+        self.xdo.send_keysequence_window(save_dialog_id, b'Delete')
+        self.sleep(0.25)
+        self.xdo.enter_text_window(save_dialog_id, os.path.splitext(filename)[0].encode('utf8'))
+        self.sleep(0.25)
+
+        # A file left over from an earlier save
+        # doesn't mean this one has been written
+        path = os.path.join(self.save_dir, filename)
+        previous = file_state(path)
+
+        # Manually click "Save" button.
+        # Sending the 'Return' key causes libxdo to spam Return
+        # for some reason, breaking everything
+        self.xdo.move_mouse(1400, 850)
+        self.sleep(0.25)
+        self.xdo.click_window(save_dialog_id, 1)
+
+        path = self.wait_for_file(path, previous=previous)
+
+        # Turn off save image mode
+        self.toggle_save_image_mode()
+        return path
+
+    def grab_date(self):
+        """Screenshot of just the imagery date"""
+        return self.grab(bbox=self.regions()[0])
+
+    def save_historical(self, ticks, dir):
+        """Save historical images
+        - ticks: how many images to save, starting from most recent to oldest"""
+        os.makedirs(dir, exist_ok=True)
+        worker = PostProcessor()
+        frames = self.frames()
+        try:
+            # Historical imagery must already be enabled
+            for i in tqdm(range(ticks)):
+                # Click back on historical timeline
+                # If save image bar is not active, this is the correct y position
+                self.xdo.move_mouse(480, 175)
+                # Otherwise, use:
+                # xdo.move_mouse(480, 225)
+                self.sleep(0.25)
+                self.xdo.click_window(self.win_id, 1)
+
+                # Wait for the previous imagery to be replaced
+                # and for the new imagery to finish loading
+                # If it never settles, save whatever it's showing
+                frames, _ = self.wait_until_settled(changed_from=frames)
+
+                # Save the image
+                name = '{}'.format(ticks-i).zfill(4)
+                saved = self.save_image('{}.jpg'.format(name))
+
+                # Extract the imagery date; the rest
+                # is done while the next tick loads
+                strip = self.grab_date()
+                worker.submit(saved, os.path.join(dir, '{}.jpg'.format(name)), strip)
+        finally:
+            worker.close()
+        return worker.errors
+
 
 if __name__ == '__main__':
     import sys
@@ -152,14 +344,11 @@ if __name__ == '__main__':
         coords = [
                 (8.9492814, 38.7928534)
         ]
+        history = EarthHistory(*connect())
         for c in coords:
-            clear_search()
-            go_to(*c)
-
-            # Wait for animation to complete
-            sleep(5)
-
-            save_historical(80, '/tmp/testing')
+            history.clear_search()
+            history.go_to(*c)
+            history.save_historical(80, '/tmp/testing')
     except Exception as e:
         print(e)
         sys.exit(1)
@@ -0,0 +1,296 @@
+"""
+Counters, latency histograms and tracing spans for
+Earth Engine round trips, downloads and raster operations.
+
+Recording is off by default, and then costs one attribute check
+per call. Turn it on in code or with `PENG_METRICS=1`
+(`PENG_METRICS=trace` also keeps spans):
+
+    from peng.metrics import metrics
+    metrics.enable(tracing=True)
+    sat.download_images(jobs)
+    metrics.write('metrics.json')    # or metrics.to_prometheus()
+
+Instrumenting:
+
+    metrics.count('download_bytes', n_bytes)
+    with metrics.span('ee_get_info'):
+        data = obj.getInfo()
+
+    @metrics.timed('raster_to_image')
+    def to_image(self): ...
+"""
+
+import os
+import json
+import time
+import bisect
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+# Latency buckets (seconds), upper bounds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+
+# Spans beyond this many are dropped,
+# so long runs don't grow without bound
+MAX_SPANS = 100000
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0 for _ in range(len(buckets) + 1)]
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """approximate quantile, as the upper bound
+        of the bucket it falls in"""
+        if not self.count:
+            return None
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum/self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class _NoSpan:
+    """what `span` returns when recording is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **labels):
+        pass
+
+NO_SPAN = _NoSpan()
+
+
+class Span:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def set(self, **labels):
+        """add labels once they're known, e.g. a response size"""
+        self.labels.update(labels)
+
+    def __enter__(self):
+        stack = self.metrics._stack()
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._t0
+        self.metrics._stack().pop()
+        error = exc_type.__name__ if exc_type is not None else None
+        self.metrics.observe('{}_seconds'.format(self.name), elapsed, **self.labels)
+        if error is not None:
+            self.metrics.count('{}_errors'.format(self.name), error=error)
+        if self.metrics.tracing:
+            self.metrics._add_span({
+                'name': self.name,
+                'parent': None if self.parent is None else self.parent.name,
+                'start': self.start,
+                'seconds': elapsed,
+                'thread': threading.current_thread().name,
+                'labels': self.labels,
+                'error': error,
+            })
+        return False
+
+
+class Metrics:
+    def __init__(self, enabled=False, tracing=False):
+        self.enabled = enabled
+        self.tracing = tracing
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def enable(self, tracing=False):
+        self.enabled = True
+        self.tracing = tracing
+
+    def disable(self):
+        self.enabled = False
+        self.tracing = False
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.spans = []
+            self.dropped_spans = 0
+
+    def count(self, name, n=1, **labels):
+        """add `n` to a counter"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        """record a value (usually a duration, in seconds) in a histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def span(self, name, **labels):
+        """context manager timing a stage into the `<name>_seconds`
+        histogram and, if tracing, recording it as a span
+        (nested under whatever span is open in this thread)"""
+        if not self.enabled:
+            return NO_SPAN
+        return Span(self, name, labels)
+
+    def timed(self, name):
+        """decorator wrapping each call in a span"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with Span(self, name, {}):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _add_span(self, span):
+        with self._lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.dropped_spans += 1
+
+    def to_dict(self):
+        def entries(metrics, fn):
+            return [{'name': name, 'labels': dict(labels), **fn(v)}
+                    for (name, labels), v in sorted(metrics.items(), key=lambda kv: repr(kv[0]))]
+        with self._lock:
+            return {
+                'counters': entries(self.counters, lambda v: {'value': v}),
+                'histograms': entries(self.histograms, lambda h: h.to_dict()),
+                'spans': list(self.spans),
+                'dropped_spans': self.dropped_spans,
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='peng_'):
+        """metrics in the Prometheus text exposition format"""
+        def fmt_labels(labels, **extra):
+            labels = list(labels) + list(extra.items())
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for k, v in labels) + '}'
+
+        lines, typed = [], set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items(), key=lambda kv: repr(kv[0])):
+                name = prefix + name + '_total'
+                if name not in typed:
+                    lines.append('# TYPE {} counter'.format(name))
+                    typed.add(name)
+                lines.append('{}{} {}'.format(name, fmt_labels(labels), value))
+
+            for (name, labels), hist in sorted(self.histograms.items(), key=lambda kv: repr(kv[0])):
+                name = prefix + name
+                if name not in typed:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    typed.add(name)
+                cumulative = 0
+                for bound, n in zip(hist.buckets, hist.counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, le=bound), cumulative))
+                lines.append('{}_bucket{} {}'.format(name, fmt_labels(labels, le='+Inf'), hist.count))
+                lines.append('{}_sum{} {}'.format(name, fmt_labels(labels), hist.sum))
+                lines.append('{}_count{} {}'.format(name, fmt_labels(labels), hist.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """write metrics to `path`, as Prometheus
+        text if it ends in `.prom`, otherwise JSON"""
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+_env = os.environ.get('PENG_METRICS', '').lower()
+
+# Shared by the whole package
+metrics = Metrics(enabled=_env not in ('', '0', 'false'), tracing=_env == 'trace')
+
+
+_traced = {'users': 0, 'started': False}
+_traced_lock = threading.Lock()
+
+
+@contextmanager
+def traced_peak():
+    """Measure peak memory over a block with `tracemalloc`, yielding a dict
+    that gets `peak_bytes` (above what was allocated on entry) on exit.
+
+    Only allocations `tracemalloc` sees are counted: Python objects and
+    NumPy arrays, but not native buffers (e.g. PIL's or GDAL's). Tracing is
+    process-wide, so blocks that overlap (in other threads) share one peak"""
+    with _traced_lock:
+        if not _traced['users']:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _traced['started'] = True
+            tracemalloc.reset_peak()
+        _traced['users'] += 1
+        base = tracemalloc.get_traced_memory()[0]
+    result = {}
+    try:
+        yield result
+    finally:
+        with _traced_lock:
+            result['peak_bytes'] = max(0, tracemalloc.get_traced_memory()[1] - base)
+            _traced['users'] -= 1
+            if not _traced['users'] and _traced['started']:
+                tracemalloc.stop()
+                _traced['started'] = False
@@ -0,0 +1,154 @@
+"""
+Split areas too large for a single Earth Engine download
+into a grid of pieces, and mosaic the downloaded pieces
+back into one georeferenced GeoTIFF.
+
+The grid is aligned to EPSG:4326 pixels of `scale` meters
+(at the equator), so pieces line up exactly without resampling.
+Finished pieces are recorded in a JSON progress file next to
+the output, so an interrupted download picks up where it left off.
+
+    sat.download_area((lat0, lon0, lat1, lon1), 'area.tif', scale=30)
+"""
+
+import os
+import math
+import json
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+
+# Meters per degree of latitude (and of longitude at the equator)
+METERS_PER_DEGREE = 111320
+
+# Side of each piece, in pixels. Visualized RGB downloads
+# are 3 bytes/pixel, so this stays well under EE's
+# per-request size limit (32MB) and grid dimension limit
+TILE_SIZE = 2048
+
+
+def area_grid(bounds, scale=30, tile_size=TILE_SIZE):
+    """Pixel grid covering `bounds` (`(lat0, lon0, lat1, lon1)`,
+    as for `Satellite.get_area_image`), split into pieces of at
+    most `tile_size` pixels square. Returns the grid spec: the
+    mosaic's size and transform, and each piece's `[row, col]`
+    index and `[col_off, row_off, width, height]` window"""
+    lat0, lon0, lat1, lon1 = bounds
+    res = scale / METERS_PER_DEGREE
+
+    # Snap to the global pixel grid, so the same area
+    # at the same scale always gets the same grid
+    x0 = math.floor(min(lon0, lon1) / res) * res
+    y0 = math.ceil(max(lat0, lat1) / res) * res
+    width = max(1, math.ceil((max(lon0, lon1) - x0) / res))
+    height = max(1, math.ceil((y0 - min(lat0, lat1)) / res))
+
+    pieces = []
+    for row, row_off in enumerate(range(0, height, tile_size)):
+        for col, col_off in enumerate(range(0, width, tile_size)):
+            pieces.append({
+                'index': [row, col],
+                'window': [col_off, row_off,
+                           min(tile_size, width - col_off),
+                           min(tile_size, height - row_off)],
+            })
+    return {
+        'width': width,
+        'height': height,
+        'transform': [res, 0, x0, 0, -res, y0],
+        'pieces': pieces,
+    }
+
+
+def piece_params(grid, piece):
+    """`getDownloadURL` params for a piece, pinned to the grid"""
+    res, _, x0, _, _, y0 = grid['transform']
+    col_off, row_off, width, height = piece['window']
+    return {
+        'crs': 'EPSG:4326',
+        'crs_transform': [res, 0, x0 + col_off * res, 0, -res, y0 - row_off * res],
+        'dimensions': '{}x{}'.format(width, height),
+    }
+
+
+class Progress:
+    """Completed pieces of a grid, persisted as JSON
+    (written atomically, so a crash can't corrupt it).
+    A saved progress file for a different grid is ignored.
+    Pieces' paths are saved relative to the progress file,
+    so it can be resumed from any working directory"""
+    def __init__(self, path, grid):
+        self.path = path
+        self.grid = grid
+        self.done = {}
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+            if saved['grid'] == grid:
+                self.done = saved['done']
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    @staticmethod
+    def key(piece):
+        return '{}_{}'.format(*piece['index'])
+
+    def is_done(self, piece):
+        return self.key(piece) in self.done and os.path.exists(self.piece_path(piece))
+
+    def mark(self, piece, path):
+        with self._lock:
+            self.done[self.key(piece)] = os.path.relpath(path, self._dir)
+            self._save()
+
+    def piece_path(self, piece):
+        """Where a completed piece was saved"""
+        return os.path.join(self._dir, self.done[self.key(piece)])
+
+    @property
+    def _dir(self):
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=self._dir, prefix='.tmp-', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'grid': self.grid, 'done': self.done}, f)
+        os.replace(tmp, self.path)
+
+
+def write_mosaic(grid, pieces, path):
+    """Write downloaded RGB pieces, given as `(piece, image path)`,
+    into a tiled GeoTIFF at `path`, one piece's window at a time"""
+    # Imported here so `satellite` doesn't pay for rasterio on import
+    import rasterio
+    from affine import Affine
+    from rasterio.windows import Window
+
+    profile = {
+        'driver': 'GTiff',
+        'width': grid['width'],
+        'height': grid['height'],
+        'count': 3,
+        'dtype': 'uint8',
+        'crs': 'EPSG:4326',
+        'transform': Affine(*grid['transform']),
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+        'photometric': 'RGB',
+        'BIGTIFF': 'IF_SAFER',
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        for piece, impath in pieces:
+            col_off, row_off, width, height = piece['window']
+            with Image.open(impath) as im:
+                data = np.asarray(im.convert('RGB'))
+
+            # Pieces should match their window exactly,
+            # but don't trust EE to the pixel
+            h, w = min(height, data.shape[0]), min(width, data.shape[1])
+            dst.write(np.moveaxis(data[:h, :w], -1, 0), window=Window(col_off, row_off, w, h))
+    return path
@@ -1,21 +1,204 @@
+import json
 import rasterio
-import tempfile
-import matplotlib
+import threading
 import rasterio.warp
 import rasterio.features
 import numpy as np
-import matplotlib.pyplot as plt
+from affine import Affine
+from rasterio.io import MemoryFile
 from rasterio.windows import Window
+from rasterio.features import geometry_mask
+from rasterio.transform import rowcol
 from rasterio.enums import Resampling
-from rasterio.plot import show, reshape_as_image
-from pyproj import CRS, Transformer
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from .metrics import metrics
 
-# For X11 forwarding
-matplotlib.use('TkAgg')
+# matplotlib, pyproj and rasterio.plot are slow to import,
+# so they're only imported where they're needed
+
+
+def reshape_as_image(arr):
+    """(bands, rows, cols) -> (rows, cols, bands),
+    as `rasterio.plot.reshape_as_image`"""
+    return np.moveaxis(arr, 0, -1)
+
+
+def colormap_lut(colormap):
+    """A matplotlib colormap as a `(256, 4)` uint8 RGBA lookup table"""
+    if colormap not in _luts:
+        import matplotlib.pyplot as plt
+        cm = plt.get_cmap(colormap)
+        _luts[colormap] = (cm(np.arange(cm.N)) * 255).astype('uint8')
+    return _luts[colormap]
+
+_luts = {}
+
+
+def to_rgba(data, mn, mx, colormap=None, out=None):
+    """Normalize image-shaped `(rows, cols, bands)` data
+    to an RGBA uint8 array, given per-band min/max.
+
+    Works one band at a time through a single float32 buffer and
+    writes into `out` (allocated if not given, otherwise any
+    `(rows, cols, 4)` uint8 array or view), so rendering doesn't
+    make full-size float copies of the data. Colormaps are
+    applied through a lookup table"""
+    rows, cols, bands = data.shape
+    if out is None:
+        out = np.empty((rows, cols, 4), dtype='uint8')
+    mn = np.asarray(mn, dtype='float64').reshape(-1)
+    mx = np.asarray(mx, dtype='float64').reshape(-1)
+    buf = np.empty((rows, cols), dtype='float32')
+
+    # Colormaps have 256 bins, as matplotlib indexes them,
+    # otherwise [0, 1] is stretched to [0, 255]
+    lut = colormap_lut(colormap) if bands == 1 and colormap is not None else None
+    levels = len(lut) if lut is not None else 255
+
+    for i in range(min(bands, 4)):
+        span = mx[i] - mn[i] if mx[i] > mn[i] else 1
+        np.subtract(data[..., i], mn[i], out=buf, casting='unsafe')
+        buf *= levels / span
+        np.clip(buf, 0, levels - 1 if lut is not None else 255, out=buf)
+        if lut is not None:
+            np.take(lut, buf.astype('uint8'), axis=0, out=out, mode='clip')
+            return out
+        out[..., i] = buf
+
+    # Grayscale; a missing blue band is zero (`out` may be reused)
+    if bands == 1:
+        out[..., 1] = out[..., 0]
+        out[..., 2] = out[..., 0]
+    elif bands == 2:
+        out[..., 2] = 0
+    if bands < 4:
+        out[..., 3] = 255
+    return out
+
+
+class Batch:
+    """Collects shapes in pixel coordinates and reprojects them
+    to EPSG:4326 in batches, with one vectorized transform call
+    for all the coordinates in a batch"""
+    def __init__(self, transform, crs, batch_size=100000, precision=6, min_area=None):
+        self.transform = transform
+        self.crs = crs
+        self.batch_size = batch_size
+        self.precision = precision
+        self.min_area = min_area
+        self.shapes = []
+        self.n_coords = 0
+
+    def add(self, geom, val):
+        """add a shape, returning any features that are ready"""
+        self.shapes.append((geom, val))
+        self.n_coords += sum(len(ring) for ring in geom['coordinates'])
+        if self.n_coords >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        if not self.shapes:
+            return []
+        shapes, self.shapes, self.n_coords = self.shapes, [], 0
+
+        rings = [ring for geom, _ in shapes for ring in geom['coordinates']]
+        n_rings = [len(geom['coordinates']) for geom, _ in shapes]
+        lengths = np.array([len(ring) for ring in rings])
+        starts = np.r_[0, np.cumsum(lengths)[:-1]]
+        coords = np.array([xy for ring in rings for xy in ring], dtype='float64')
+
+        if self.min_area:
+            # Shoelace areas of all rings at once;
+            # holes are subtracted from their exterior
+            xs, ys = coords[:, 0], coords[:, 1]
+            cross = np.r_[xs[:-1]*ys[1:] - xs[1:]*ys[:-1], 0]
+            cross[starts + lengths - 1] = 0 # Don't wrap into the next ring
+            areas = np.abs(np.add.reduceat(cross, starts)) / 2
+            ring_starts = np.r_[0, np.cumsum(n_rings)[:-1]]
+            exteriors = areas[ring_starts]
+            areas = 2*exteriors - np.add.reduceat(areas, ring_starts)
+            keep = areas >= self.min_area
+        else:
+            keep = np.ones(len(shapes), dtype=bool)
+
+        xs, ys = self.transform * (coords[:, 0], coords[:, 1])
+        xs, ys = rasterio.warp.transform(self.crs, 'EPSG:4326', xs, ys)
+        coords = np.round(np.column_stack([xs, ys]), self.precision).tolist()
+
+        feats, ring = [], 0
+        for (geom, val), n, k in zip(shapes, n_rings, keep):
+            if k:
+                feats.append(({
+                    'type': 'Polygon',
+                    'coordinates': [coords[starts[r]:starts[r]+lengths[r]]
+                                    for r in range(ring, ring+n)]
+                }, val))
+            ring += n
+        return feats
+
+
+def _simplified(shapes, tolerance):
+    if not tolerance:
+        yield from shapes
+        return
+    from shapely.geometry import shape, mapping
+    for geom, val in shapes:
+        geom = shape(geom).simplify(tolerance, preserve_topology=True)
+        if not geom.is_empty:
+            yield mapping(geom), val
+
+
+def _merge_shapes(shapes):
+    """Merge shapes of the same value that were
+    split across block seams"""
+    from shapely.geometry import shape, mapping
+    from shapely.ops import unary_union
+    by_value = {}
+    for geom, val in shapes:
+        by_value.setdefault(val, []).append(shape(geom))
+    for val, geoms in by_value.items():
+        merged = unary_union(geoms)
+        for geom in getattr(merged, 'geoms', [merged]):
+            yield mapping(geom), val
+
+
+def map_blocks(fn, windows, workers=None):
+    """Yield `(window, fn(window))` in order, running
+    `fn` across a thread pool if `workers` is set.
+    Only a few blocks are in flight at once, so memory
+    stays bounded by the block size"""
+    if not workers:
+        for window in windows:
+            yield window, fn(window)
+        return
+
+    with ThreadPoolExecutor(workers) as pool:
+        pending = []
+        for window in windows:
+            pending.append((window, pool.submit(fn, window)))
+            if len(pending) >= 2*workers:
+                window, fut = pending.pop(0)
+                yield window, fut.result()
+        for window, fut in pending:
+            yield window, fut.result()
 
 class GeoTIFF:
-    def __init__(self, path):
+    """Wraps a rasterio dataset.
+
+    The `apply_*` methods are lazy: they're recorded and then
+    fused into a single windowed, resampled read the next time
+    `dataset` is accessed (or on `materialize()`), so a chain like
+    crop -> rescale -> mask reads only the pixels the result needs.
+
+    With a `chunks.ChunkCache`, windowed reads of the file
+    (`read`, `blocks`, `data_for_bounds`, `sample`) go through the cache."""
+    def __init__(self, path, chunk_cache=None):
+        self._memfile = None
+        self._pending = None
+        self.chunk_cache = chunk_cache
         self.dataset = rasterio.open(path)
         print('width', self.dataset.width)
         print('height', self.dataset.height)
@@ -23,14 +206,158 @@ class GeoTIFF:
 
     @property
     def dataset(self):
+        if self._pending is not None:
+            self.materialize()
         return self._dataset
 
     @dataset.setter
     def dataset(self, dataset):
         self._dataset = dataset
-        self.proj = CRS(dataset.crs.to_string())
+        self._pending = None
+        self._proj = None
         self.transformers = {}
 
+    @property
+    def proj(self):
+        if self._proj is None:
+            from pyproj import CRS
+            self._proj = CRS(self._dataset.crs.to_string())
+        return self._proj
+
+    @contextmanager
+    def _readers(self):
+        """Yields a function returning a handle on the dataset for
+        the current thread, since GDAL handles can't be shared across
+        threads. The handles are closed on exit, so scope this to
+        the thread pool's lifetime"""
+        local, handles, lock = threading.local(), [], threading.Lock()
+        name = self.dataset.name
+
+        def reader():
+            if not hasattr(local, 'dataset'):
+                local.dataset = rasterio.open(name)
+                with lock:
+                    handles.append(local.dataset)
+            return local.dataset
+
+        try:
+            yield reader
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def windows(self, block_size=None):
+        """Iterate over windows covering the dataset, either
+        `block_size` pixels square or, by default, following
+        the dataset's internal blocks"""
+        if block_size is None:
+            for _, window in self.dataset.block_windows(1):
+                yield window
+            return
+
+        height, width = self.dataset.height, self.dataset.width
+        for row in range(0, height, block_size):
+            for col in range(0, width, block_size):
+                yield Window(col, row,
+                             min(block_size, width - col),
+                             min(block_size, height - row))
+
+    def blocks(self, indexes=None, block_size=None, workers=None):
+        """Iterate over `(window, data)` blocks,
+        optionally reading them across a thread pool"""
+        with self._block_reader(indexes, workers) as read:
+            yield from map_blocks(read, self.windows(block_size), workers)
+
+    @contextmanager
+    def _block_reader(self, indexes, workers):
+        if not workers:
+            yield lambda window: self.read(indexes, window=window)
+            return
+        with self._readers() as reader:
+            yield lambda window: self.read(indexes, window=window, dataset=reader())
+
+    def read(self, indexes=None, window=None, dataset=None):
+        """Read from the dataset, through the chunk cache if there is one.
+        In-memory datasets (after `apply_*`) aren't cached"""
+        dataset = dataset or self.dataset
+        if self.chunk_cache is not None:
+            return self.chunk_cache.read(dataset, indexes, window=window)
+        return dataset.read(indexes, window=window)
+
+    @metrics.timed('raster_stats')
+    def stats(self, block_size=None, workers=None):
+        """Per-band min and max of the valid (non-nodata)
+        pixels, computed block by block"""
+        nodata = self.dataset.nodata
+        mn = np.full(self.dataset.count, np.inf)
+        mx = np.full(self.dataset.count, -np.inf)
+        for _, data in self.blocks(block_size=block_size, workers=workers):
+            if nodata is not None:
+                valid = ~np.isnan(data) if np.isnan(nodata) else data != nodata
+                mn = np.minimum(mn, np.where(valid, data, np.inf).min(axis=(1, 2)))
+                mx = np.maximum(mx, np.where(valid, data, -np.inf).max(axis=(1, 2)))
+            else:
+                mn = np.minimum(mn, data.min(axis=(1, 2)))
+                mx = np.maximum(mx, data.max(axis=(1, 2)))
+
+        # Bands without valid pixels, as in `stretch`
+        empty = mn > mx
+        mn[empty], mx[empty] = 0, 0
+        return mn, mx
+
+    def _pipeline(self):
+        """The pending operations, starting from the full dataset"""
+        if self._pending is None:
+            self._pending = {
+                'window': Window(0, 0, self._dataset.width, self._dataset.height),
+                'shape': (self._dataset.height, self._dataset.width),
+                'resampling': Resampling.nearest,
+                'masks': [],
+            }
+        return self._pending
+
+    @property
+    def transform(self):
+        """The transform, including any pending operations"""
+        if self._pending is None:
+            return self._dataset.transform
+        window, (height, width) = self._pending['window'], self._pending['shape']
+        return self._dataset.window_transform(window) * Affine.scale(
+            window.width / width, window.height / height)
+
+    @property
+    def shape(self):
+        """(height, width), including any pending operations"""
+        if self._pending is None:
+            return self._dataset.height, self._dataset.width
+        return self._pending['shape']
+
+    @metrics.timed('raster_materialize')
+    def materialize(self):
+        """Run any pending operations as one read
+        into an in-memory dataset"""
+        if self._pending is None:
+            return
+        ops = self._pending
+        transform = self.transform
+        height, width = ops['shape']
+        data = self._read_scaled((height, width), window=ops['window'],
+                                 resampling=ops['resampling'])
+        metrics.count('raster_read_bytes', data.nbytes)
+
+        # Masks are applied at the output resolution
+        nodata = self._dataset.nodata or 0
+        for shapes, invert in ops['masks']:
+            mask = geometry_mask(shapes, out_shape=(height, width),
+                                 transform=transform, invert=invert)
+            data[:, mask] = nodata
+
+        self._apply(data, {
+            'height': height,
+            'width': width,
+            'transform': transform
+        })
+
     def _window_for_bounds(self, bounds, from_proj='epsg:4326'):
         """Calculate the correct window based on the specified bounds
         Helpful reference: <https://epsg.io/transform>"""
@@ -41,122 +368,381 @@ class GeoTIFF:
         h = pr1 - pr0
         return Window(pc0, pr0, w, h)
 
+    @metrics.timed('raster_data_for_bounds')
     def data_for_bounds(self, index, bounds, from_proj):
         """Retrieve data for the specified bounds"""
         window = self._window_for_bounds(bounds, from_proj)
-        return self.dataset.read(index, window=window)
+        return self.read(index, window=window)
 
     def _apply(self, data, meta):
         # Don't see a way to apply in-place,
-        # so mock it by saving to a temp file
+        # so mock it by writing to an in-memory file
         # and then loading that.
-        kwargs = self.dataset.meta.copy()
+        kwargs = self._dataset.meta.copy()
         kwargs.update(meta)
-        with tempfile.NamedTemporaryFile(suffix='.tif') as tf:
-            with rasterio.open(tf.name, 'w', **kwargs) as dst:
-                dst.write(data)
-            self.dataset = rasterio.open(tf.name)
+        memfile = MemoryFile()
+        with memfile.open(**kwargs) as dst:
+            dst.write(data)
+        if self._memfile is not None:
+            self._memfile.close()
+        self._memfile = memfile
+        self.dataset = memfile.open()
 
     def apply_bounds(self, bounds, from_proj='epsg:4326'):
         """Apply bounds in-place"""
+        ops = self._pipeline()
         window = self._window_for_bounds(bounds, from_proj)
-        self._apply(self.dataset.read(window=window), {
-            'height': window.height,
-            'width': window.width,
-            'transform': self.dataset.window_transform(window)
-        })
 
+        # Map the window back onto the source pixels
+        src = ops['window']
+        height, width = ops['shape']
+        sx, sy = src.width / width, src.height / height
+        ops['window'] = Window(
+            src.col_off + window.col_off * sx,
+            src.row_off + window.row_off * sy,
+            window.width * sx, window.height * sy)
+        ops['shape'] = (window.height, window.width)
+
+    def overviews(self):
+        """Decimation factors of the file's overviews
+        (internal or in a `.ovr` sidecar), finest first"""
+        return self._dataset.overviews(1)
+
+    def overview_level(self, scale):
+        """Index of the coarsest overview that's still at least
+        as fine as `scale`, or `None` for full resolution"""
+        level = None
+        for i, factor in enumerate(self.overviews()):
+            if factor <= 1 / scale:
+                level = i
+        return level
+
+    def _read_scaled(self, out_shape, window=None, resampling=Resampling.nearest, **kwargs):
+        """Read `window` resampled to `out_shape` (`(height, width)`),
+        from the overview picked by `overview_level`, so small
+        outputs don't decode every source pixel"""
+        dataset = self._dataset
+        height, width = out_shape
+        window = window or Window(0, 0, dataset.width, dataset.height)
+        level = self.overview_level(max(height / window.height, width / window.width))
+        if level is None:
+            return dataset.read(window=window, out_shape=(dataset.count, height, width),
+                                resampling=resampling, **kwargs)
+
+        metrics.count('raster_overview_reads', level=level)
+        with rasterio.open(dataset.name, overview_level=level) as overview:
+            # Overview sizes are rounded, so scale
+            # the window by the actual size ratio
+            fy, fx = overview.height / dataset.height, overview.width / dataset.width
+            window = Window(window.col_off * fx, window.row_off * fy,
+                            window.width * fx, window.height * fy)
+            return overview.read(window=window, out_shape=(dataset.count, height, width),
+                                 resampling=resampling, **kwargs)
+
+    @metrics.timed('raster_build_overviews')
+    def build_overviews(self, factors=None, resampling=Resampling.average, external=False,
+                        threads='ALL_CPUS'):
+        """Build and save the overviews the file is missing, by default
+        halving until they're about a block (256px) across. With
+        `external` they're written to a `.ovr` sidecar instead, leaving
+        the file itself untouched (e.g. to keep a COG's layout).
+        `threads` is passed on as `GDAL_NUM_THREADS`.
+        Returns the factors that were built"""
+        dataset = self.dataset
+        if self._memfile is not None:
+            raise ValueError('Overviews can only be built for files, not after `apply_*`')
+        if factors is None:
+            factors, factor = [], 2
+            while min(dataset.height, dataset.width) / factor >= 256:
+                factors.append(factor)
+                factor *= 2
+        missing = [f for f in factors if f not in dataset.overviews(1)]
+        if not missing:
+            return missing
+
+        path = dataset.name
+        dataset.close()
+        with rasterio.Env(GDAL_NUM_THREADS=str(threads), TIFF_USE_OVR=external):
+            with rasterio.open(path, 'r+') as dst:
+                dst.build_overviews(missing, resampling)
+        self.dataset = rasterio.open(path)
+        return missing
+
+    @metrics.timed('raster_data_for_scale')
     def data_for_scale(self, scale, resampling=Resampling.bilinear):
-        """Retrieve data scaled by the specified amount"""
+        """Retrieve data scaled by the specified amount,
+        reading from overviews where the file has them"""
         # Resampling methods: <https://rasterio.readthedocs.io/en/latest/api/rasterio.enums.html#rasterio.enums.Resampling>
         # More details: <https://desktop.arcgis.com/en/arcmap/latest/manage-data/raster-and-images/resample-function.htm>
-        data = self.dataset.read(
-            out_shape=(
-                int(self.dataset.height * scale),
-                int(self.dataset.width * scale)
-            ),
-            resampling=resampling
-        )
+        dataset = self.dataset
+        data = self._read_scaled(
+            (max(1, int(dataset.height * scale)), max(1, int(dataset.width * scale))),
+            resampling=resampling)
 
-        transform = self.dataset.transform * self.dataset.transform.scale(
-            (self.dataset.width / data.shape[-1]),
-            (self.dataset.height / data.shape[-2])
+        transform = dataset.transform * dataset.transform.scale(
+            (dataset.width / data.shape[-1]),
+            (dataset.height / data.shape[-2])
         )
         return data, transform
 
-    def apply_scale(self, scale):
+    def preview(self, max_size=1024):
+        """Decimated (nearest neighbour) read of at most
+        `max_size` pixels on a side, and its transform.
+        With overviews this costs about as much as the output;
+        see `build_overviews`"""
+        height, width = self.shape
+        return self.data_for_scale(min(1, max_size / max(height, width)), Resampling.nearest)
+
+    def apply_scale(self, scale, resampling=Resampling.bilinear):
         """Apply scale in-place"""
-        data, transform = self.data_for_scale(scale)
-        self._apply(data, {
-            'height': self.dataset.height * scale,
-            'width': self.dataset.width * scale,
-            'transform': transform
-        })
+        ops = self._pipeline()
+        height, width = ops['shape']
+        ops['shape'] = (int(height * scale), int(width * scale))
+        ops['resampling'] = resampling
 
-    def to_features(self):
-        """Generate geojson features"""
-        # Mask out no data areas
-        mask = self.dataset.dataset_mask()
+    def to_features(self, block_size=None):
+        """Generate geojson features.
+        See `iter_features` for `block_size`"""
+        return list(self.iter_features(block_size=block_size))
 
-        # Extract feature shapes and values from the array.
-        feats = []
-        for geom, val in rasterio.features.shapes(
-                mask, transform=self.dataset.transform):
+    def iter_features(self, block_size=None, workers=None, simplify=None, min_area=None,
+                      batch_size=100000, precision=6, with_values=False):
+        """Generate geojson features as they're polygonized.
 
-            # Transform shapes from the dataset's own coordinate
-            # reference system to CRS84 (EPSG:4326).
-            geom = rasterio.warp.transform_geom(
-                self.dataset.crs, 'EPSG:4326', geom, precision=6)
-            feats.append(geom)
+        Shapes are reprojected to EPSG:4326 in batches of about
+        `batch_size` coordinates. `simplify` (a tolerance) and
+        `min_area` are in pixels; `simplify` requires shapely.
 
-        return feats
+        With `block_size` the mask is polygonized block by block,
+        optionally across `workers` threads. Shapes that touch a
+        seam between blocks are merged once all blocks are done,
+        which also requires shapely.
 
-    def to_image(self, colormap=None):
-        data = reshape_as_image(self.dataset.read())
+        With `with_values`, yields `(geometry, mask value)` pairs"""
+        batch = Batch(self.dataset.transform, self.dataset.crs,
+                      batch_size, precision, min_area)
+
+        if block_size is None:
+            # Mask out no data areas
+            mask = self.dataset.dataset_mask()
+            shapes = rasterio.features.shapes(mask)
+            seams = []
+        else:
+            shapes, seams = self._block_shapes(block_size, workers)
+
+        for geom, val in _simplified(shapes, simplify):
+            for feat in batch.add(geom, val):
+                yield feat if with_values else feat[0]
+
+        if seams:
+            for geom, val in _simplified(_merge_shapes(seams), simplify):
+                for feat in batch.add(geom, val):
+                    yield feat if with_values else feat[0]
+
+        for feat in batch.flush():
+            yield feat if with_values else feat[0]
+
+    def _block_shapes(self, block_size, workers):
+        """Polygonize the mask block by block (in dataset pixel coordinates),
+        returning a generator of shapes that are entirely within a block,
+        and a list that's filled with the shapes that touch block seams"""
+        height, width = self.dataset.height, self.dataset.width
+        seams = []
 
-        # Normalize
-        mn = data.min(axis=(0, 1), keepdims=True)
-        mx = data.max(axis=(0, 1), keepdims=True)
-        data = (data - mn)/(mx - mn)
+        def polygonize(read, window):
+            mask = read().dataset_mask(window=window)
+            col0, row0 = window.col_off, window.row_off
+            col1, row1 = col0 + window.width, row0 + window.height
 
-        # Grayscale
-        if data.shape[-1] == 1:
-            # Use colormap, if specified
-            if colormap is not None:
-                cm = plt.get_cmap(colormap)
-                data = cm(data)
+            # Edges shared with another block
+            edges = (col0 > 0, row0 > 0, col1 < width, row1 < height)
+            inner, outer = [], []
+            transform = Affine.translation(col0, row0)
+            for geom, val in rasterio.features.shapes(mask, transform=transform):
+                ring = np.asarray(geom['coordinates'][0])
+                touches = (edges[0] and ring[:, 0].min() <= col0) or \
+                    (edges[1] and ring[:, 1].min() <= row0) or \
+                    (edges[2] and ring[:, 0].max() >= col1) or \
+                    (edges[3] and ring[:, 1].max() >= row1)
+                (outer if touches else inner).append((geom, val))
+            return inner, outer
 
-            # Otherwise, just convert to RGB
+        def shapes():
+            with self._readers() as reader:
+                read = reader if workers else lambda: self.dataset
+                for _, (inner, outer) in map_blocks(lambda window: polygonize(read, window),
+                                                    self.windows(block_size), workers):
+                    seams.extend(outer)
+                    yield from inner
+        return shapes(), seams
+
+    @metrics.timed('raster_write_features')
+    def write_features(self, path, **kwargs):
+        """Write features to `path` as newline-delimited geojson,
+        one feature at a time. Takes the same arguments as `iter_features`;
+        each feature's mask value is in its `value` property.
+        Returns the number of features written"""
+        n = 0
+        with open(path, 'w') as f:
+            for geom, val in self.iter_features(with_values=True, **kwargs):
+                f.write(json.dumps({
+                    'type': 'Feature',
+                    'geometry': geom,
+                    'properties': {'value': val}
+                }))
+                f.write('\n')
+                n += 1
+        return n
+
+    def stretch(self, percentiles=None, max_pixels=None):
+        """Per-band `(low, high)` limits to normalize by.
+
+        With `max_pixels`, they're computed from a decimated read
+        of about that many pixels per band, served from
+        overviews when the file has them. With `percentiles`
+        (e.g. `(2, 98)`) they're those percentiles of the valid
+        (non-nodata) pixels instead of the min and max"""
+        height, width = self.dataset.height, self.dataset.width
+        scale = 1 if max_pixels is None else min(1, np.sqrt(max_pixels / (height * width)))
+        data = self._read_scaled((max(1, int(height * scale)), max(1, int(width * scale))),
+                                 resampling=Resampling.nearest, masked=True)
+
+        lo = np.zeros(self.dataset.count)
+        hi = np.zeros(self.dataset.count)
+        for i, band in enumerate(data):
+            valid = band.compressed()
+            if not valid.size:
+                continue
+            if percentiles is None:
+                lo[i], hi[i] = valid.min(), valid.max()
             else:
-                data = np.concatenate((data,)*3, axis=-1)
+                lo[i], hi[i] = np.percentile(valid, percentiles)
+        return lo, hi
+
+    @metrics.timed('raster_to_image')
+    def to_image(self, colormap=None, percentiles=None, max_pixels=None):
+        """Render to an RGBA image, normalizing each band
+        by its min and max or, if `percentiles` or `max_pixels`
+        are given, by `stretch(percentiles, max_pixels)`"""
+        data = reshape_as_image(self.dataset.read())
+        if percentiles is None and max_pixels is None:
+            mn = data.min(axis=(0, 1))
+            mx = data.max(axis=(0, 1))
+        else:
+            mn, mx = self.stretch(percentiles, max_pixels)
 
-        # Convert to RGBA
-        if data.shape[-1] == 3:
-            data = np.dstack((data, np.full(data.shape[:2], 1.)))
+        # The image shares the array's memory
+        return Image.fromarray(to_rgba(data, mn, mx, colormap), 'RGBA')
 
-        return Image.fromarray((data*255).astype('uint8'), 'RGBA')
+    @metrics.timed('raster_write_image')
+    def write_image(self, path, colormap=None, block_size=1024, workers=None,
+                    percentiles=None, max_pixels=None):
+        """Like `to_image`, but for rasters too big for memory.
+        Makes two passes over the dataset, one for the
+        normalization stats and one to render, writing
+        each block to an RGBA GeoTIFF at `path` as it goes.
+        With `percentiles` the stats come from a read of at most
+        `max_pixels` (default 4M) pixels per band instead"""
+        if percentiles is None and max_pixels is None:
+            mn, mx = self.stats(block_size=block_size, workers=workers)
+        else:
+            mn, mx = self.stretch(percentiles, max_pixels or 1<<22)
+
+        profile = {
+            'driver': 'GTiff',
+            'width': self.dataset.width,
+            'height': self.dataset.height,
+            'count': 4,
+            'dtype': 'uint8',
+            'crs': self.dataset.crs,
+            'transform': self.dataset.transform,
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256,
+            'photometric': 'RGB',
+            'alpha': 'YES',
+        }
+
+        with self._block_reader(None, workers) as read, rasterio.open(path, 'w', **profile) as dst:
+            def render(window):
+                data = reshape_as_image(read(window))
+                return to_rgba(data, mn, mx, colormap)
+
+            for window, data in map_blocks(render, self.windows(block_size), workers):
+                dst.write(np.moveaxis(data, -1, 0), window=window)
+        return path
 
     def show(self, cmap='viridis'):
+        import matplotlib
+        from rasterio.plot import show
+
+        # For X11 forwarding
+        matplotlib.use('TkAgg')
         show(self.dataset, transform=self.dataset.transform, cmap=cmap)
 
-    def point_to_index(self, point, from_proj='epsg:4326'):
-        """EPSG:4326 is eqiuvalent to WGS:84.
-        `point` is expected to be (lat, lon)"""
+    def _transformer(self, from_proj):
         if from_proj not in self.transformers:
+            from pyproj import CRS, Transformer
             self.transformers[from_proj] = Transformer.from_crs(CRS(from_proj), self.proj)
+        return self.transformers[from_proj]
 
-        x, y = self.transformers[from_proj].transform(*point)
-        row, col = self.dataset.index(x, y)
-        print('row, col:', row, col)
+    def point_to_index(self, point, from_proj='epsg:4326'):
+        """EPSG:4326 is eqiuvalent to WGS:84.
+        `point` is expected to be (lat, lon)"""
+        x, y = self._transformer(from_proj).transform(*point)
+        row, col = rowcol(self.transform, x, y)
         return row, col
 
+    def points_to_indices(self, lats, lons, from_proj='epsg:4326', sample=False, indexes=None):
+        """Batch version of `point_to_index` for arrays of points.
+        Returns `(rows, cols, valid)`, where `valid` marks the points
+        that fall within the raster. With `sample=True` the pixel values
+        are returned too, as a `(bands, points)` masked array"""
+        xs, ys = self._transformer(from_proj).transform(
+            np.asarray(lats, dtype='float64'), np.asarray(lons, dtype='float64'))
+
+        # Invert the affine transform for all points at once
+        cols, rows = ~self.transform * (xs, ys)
+        finite = np.isfinite(rows) & np.isfinite(cols)
+        rows = np.floor(np.where(finite, rows, -1)).astype('int64')
+        cols = np.floor(np.where(finite, cols, -1)).astype('int64')
+
+        height, width = self.shape
+        valid = finite & (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+        if not sample:
+            return rows, cols, valid
+        return rows, cols, valid, self.sample(rows, cols, valid, indexes)
+
+    @metrics.timed('raster_sample')
+    def sample(self, rows, cols, valid=None, indexes=None):
+        """Pixel values at arrays of row/col indices,
+        reading each internal block that has points only once"""
+        dataset = self.dataset
+        if indexes is None:
+            indexes = list(range(1, dataset.count + 1))
+        if valid is None:
+            valid = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+
+        values = np.zeros((len(indexes), len(rows)), dtype=dataset.dtypes[0])
+        idx = np.flatnonzero(valid)
+        bh, bw = dataset.block_shapes[0]
+        block_ids = (rows[idx] // bh) * ((dataset.width + bw - 1) // bw) + cols[idx] // bw
+        order = np.argsort(block_ids, kind='stable')
+        idx, block_ids = idx[order], block_ids[order]
+        starts = np.flatnonzero(np.r_[True, block_ids[1:] != block_ids[:-1]])
+        for start, end in zip(starts, np.r_[starts[1:], len(idx)]):
+            pts = idx[start:end]
+            row0 = (rows[pts[0]] // bh) * bh
+            col0 = (cols[pts[0]] // bw) * bw
+            window = Window(col0, row0,
+                            min(bw, dataset.width - col0),
+                            min(bh, dataset.height - row0))
+            block = self.read(indexes, window=window, dataset=dataset)
+            values[:, pts] = block[:, rows[pts] - row0, cols[pts] - col0]
+        return np.ma.masked_array(values, mask=np.broadcast_to(~valid, values.shape))
+
     def apply_features_mask(self, feats, invert=False):
         """Mask feature shapes
         <https://rasterio.readthedocs.io/en/latest/topics/masking-by-shapefile.html>"""
         shapes = [feat['geometry'] for feat in feats]
-        data, transform = rasterio.mask.mask(self.dataset, shapes, invert=invert)
-        self._apply(data, {
-            'height': data.shape[1],
-            'width': data.shape[2],
-            'transform': transform
-        })
+        self._pipeline()['masks'].append((shapes, invert))
@@ -1,8 +1,20 @@
+import os
 import ee
-from .util import download_ee_image, get_bounds, uuid
+import shutil
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .util import EE_CHANNELS, download_ee_image, download_ee_bands, get_bounds, uuid
+from .downloader import Downloader
+from .cache import request_key
+from .client import default_client
+from .metrics import metrics
+from .mosaic import TILE_SIZE, Progress, area_grid, piece_params, write_mosaic
+from .cube import Cube
 
 def maskClouds(image):
     # Bits 3 and 5 are cloud shadow and cloud, respectively.
+    # For downloaded bands, the same test is `clear(pixel_qa, 3, 5)`
+    # with `algebra.evaluate`.
     cloudShadowBitMask = (1 << 3)
     cloudsBitMask = (1 << 5)
 
@@ -13,8 +25,52 @@ def maskClouds(image):
     mask = qa.bitwiseAnd(cloudShadowBitMask).eq(0).And(qa.bitwiseAnd(cloudsBitMask).eq(0))
     return image.updateMask(mask)
 
-ee.Initialize()
-tasks = ee.data.getTaskList()
+
+def geometry_bounds(geometry, radius=0.02):
+    """Region to download for a geojson geometry;
+    points are expanded to a box `radius` degrees out"""
+    type = geometry['type']
+    coords = geometry['coordinates']
+    if type == 'Point':
+        moves = [(radius, radius), (radius, -radius), (-radius, -radius), (-radius, radius)]
+        return [[coords[0]+r0, coords[1]+r1] for r0, r1 in moves]
+    elif type == 'Polygon':
+        return coords
+    else:
+        xmin, ymin, xmax, ymax = get_bounds([c[0] for c in coords])
+        return [
+            [xmin, ymax],
+            [xmax, ymax],
+            [xmax, ymin],
+            [xmin, ymin]
+        ]
+
+def bounds_geometry(bounds):
+    """Polygon for `(lat0, lon0, lat1, lon1)` bounds"""
+    y0, x0, y1, x1 = bounds
+    return {
+        'type': 'Polygon',
+        'coordinates': [[
+            [x0, y0],
+            [x0, y1],
+            [x1, y1],
+            [x1, y0],
+            [x0, y0],
+        ]]
+    }
+
+def date_bins(start, end, months=1):
+    """Consecutive `(start, end)` ISO date ranges of `months`
+    months each (end exclusive), covering `start` to `end`"""
+    start = datetime.date.fromisoformat(start)
+    end = datetime.date.fromisoformat(end)
+    bins = []
+    while start < end:
+        month = start.month - 1 + months
+        nxt = datetime.date(start.year + month // 12, month % 12 + 1, 1)
+        bins.append((start.isoformat(), min(nxt, end).isoformat()))
+        start = nxt
+    return bins
 
 # Using Landsat 8 Surface Reflectance Tier 1
 # Resolution of 30m^2
@@ -50,8 +106,16 @@ default_source =  {
 }
 
 class Satellite:
-    def __init__(self, img_source=default_source):
+    def __init__(self, img_source=default_source, cache=None, client=None):
+        """If a `cache.Cache` is given, feature info and
+        downloaded images are cached by request.
+        Earth Engine is initialized through `client`
+        (by default, the shared `client.default_client`)"""
+        self.client = client or default_client
+        self.client.initialize()
+
         self.src = img_source
+        self.cache = cache
         self.range = self.src['range']
         self.imgcol = ee.ImageCollection(img_source['name'])
 
@@ -61,89 +125,248 @@ class Satellite:
         if 'process' in img_source:
             self.imgcol = img_source['process'](self.imgcol)
 
-    def get_image_region(self, feat):
+    def get_image_region(self, feat, start=None, end=None):
         """Get RGB bands for image region intersecting
-        w/ this feature's geometry"""
-        return self.imgcol.filter(ee.Filter.geometry(ee.Feature(feat).geometry())).median()\
+        w/ this feature's geometry, optionally only
+        from images between the `start` and `end` dates"""
+        return self._collection(feat, start, end).median()\
             .visualize(min=self.range[0], max=self.range[1], bands=['red', 'green', 'blue'])
 
+    def _collection(self, feat, start=None, end=None):
+        imgcol = self.imgcol
+        if start is not None:
+            imgcol = imgcol.filterDate(start, end)
+        return imgcol.filter(ee.Filter.geometry(ee.Feature(feat).geometry()))
+
     # https://developers.google.com/earth-engine/scale
     # Smaller scale means more detail
     def get_feature_image(self, feat, radius=0.02, scale=30):
         feat = ee.Feature(feat)
         region = self.get_image_region(feat)
-        data = feat.getInfo()
-
-        type = data['geometry']['type']
-        coords = data['geometry']['coordinates']
-        if type == 'Point':
-            moves = [(radius, radius), (radius, -radius), (-radius, -radius), (-radius, radius)]
-            bounds = [[coords[0]+r0, coords[1]+r1] for r0, r1 in moves]
-        elif type == 'Polygon':
-            bounds = coords
-        else:
-            xmin, ymin, xmax, ymax = get_bounds([c[0] for c in data['geometry']['coordinates']])
-            bounds = [
-                [xmin, ymax],
-                [xmax, ymax],
-                [xmax, ymin],
-                [xmin, ymin]
-            ]
+        data = self._get_info(feat)
 
         image = ee.Image(region)
-        params = {'region': bounds, 'scale': scale}
+        params = {'region': geometry_bounds(data['geometry'], radius), 'scale': scale}
         return image, params
 
-    def get_feature_images(self, feature_collection, chunk_size=10, **kwargs):
+    def _get_info(self, obj):
+        """`getInfo()`, going through the cache if there is one"""
+        if self.cache is None:
+            with metrics.span('ee_get_info'):
+                return obj.getInfo()
+        key = request_key('info', obj.serialize())
+        data = self.cache.get_json(key)
+        if data is None:
+            with metrics.span('ee_get_info'):
+                data = obj.getInfo()
+            self.cache.put_json(key, data)
+        return data
+
+    def get_feature_images(self, feature_collection, chunk_size=10, prefetch=0, radius=0.02, scale=30):
+        """Get `(image, params)` for every feature in the collection.
+        The geometries of each chunk are fetched in one request;
+        with `prefetch` > 0 that many chunks are fetched concurrently"""
         images = []
-        n_feats = feature_collection.size().getInfo()
+        n_feats = self._get_info(feature_collection.size())
 
         # Process in chunks to avoid
         # exhausing EE memory
-        for i in range(n_feats//chunk_size + 1):
-            fs = feature_collection.toList(chunk_size, i*chunk_size)
+        def fetch(offset):
+            fs = feature_collection.toList(chunk_size, offset)
+            geoms = self._get_info(fs.map(lambda f: ee.Feature(f).geometry()))
+            return fs, geoms
 
-            # Need to do this to iterate over them
-            n_fs = fs.size().getInfo()
+        offsets = range(0, n_feats, chunk_size)
+        if prefetch:
+            pool = ThreadPoolExecutor(prefetch)
+            chunks = pool.map(fetch, offsets)
+        else:
+            pool = None
+            chunks = map(fetch, offsets)
 
-            for i in range(n_fs):
-                feat = ee.Feature(fs.get(i))
-                images.append(self.get_image(feat))
+        try:
+            for fs, geoms in chunks:
+                for i, geom in enumerate(geoms):
+                    feat = ee.Feature(fs.get(i))
+                    image = ee.Image(self.get_image_region(feat))
+                    params = {'region': geometry_bounds(geom, radius), 'scale': scale}
+                    images.append((image, params))
+        finally:
+            if pool is not None:
+                pool.shutdown()
         return images
 
     def get_area_image(self, bounds, scale=30):
-        y0, x0, y1, x1 = bounds
-        geom = {
-            'type': 'Polygon',
-            'coordinates': [[
-                [x0, y0],
-                [x0, y1],
-                [x1, y1],
-                [x1, y0],
-                [x0, y0],
-            ]]
-        }
-        return self.get_feature_image(geom, radius=0, scale=scale)
-
-    def download_image(self, image, params, path, id=None):
-        id = id or uuid()
-        url = image.getDownloadURL(params=params)
-        download_ee_image(url, id, path)
+        return self.get_feature_image(bounds_geometry(bounds), radius=0, scale=scale)
+
+    def download_area(self, bounds, path, scale=30, tile_size=TILE_SIZE,
+                      downloader=None, keep_pieces=False):
+        """Download an area of any size as one GeoTIFF at `path`.
+
+        The area is split into a grid of pieces small enough for
+        `getDownloadURL` (see `mosaic.area_grid`), which are downloaded
+        concurrently and then mosaicked. Progress is kept in
+        `<path>.progress.json`, so re-running after an interruption
+        (or after some pieces failed) only fetches what's missing"""
+        grid = area_grid(bounds, scale, tile_size)
+        image = ee.Image(self.get_image_region(bounds_geometry(bounds)))
+
+        piece_dir = '{}.pieces'.format(path)
+        os.makedirs(piece_dir, exist_ok=True)
+        progress = Progress('{}.progress.json'.format(path), grid)
+
+        def fetch(piece):
+            impath = os.path.join(piece_dir, '{}.png'.format(Progress.key(piece)))
+            tmp = os.path.join(piece_dir, '.tmp-{}.png'.format(Progress.key(piece)))
+            self.download_image(image, piece_params(grid, piece), tmp, downloader=downloader)
+            os.replace(tmp, impath)
+            progress.mark(piece, impath)
+
+        todo = [(piece,) for piece in grid['pieces'] if not progress.is_done(piece)]
+        if todo:
+            downloader = downloader or Downloader()
+            results = downloader.run(fetch, todo, desc='Downloading area')
+            n_failed = sum(isinstance(r, Exception) for r in results)
+            if n_failed:
+                raise RuntimeError('{}/{} pieces failed; run again to resume'.format(n_failed, len(todo)))
+
+        with metrics.span('write_mosaic'):
+            pieces = [(piece, progress.piece_path(piece)) for piece in grid['pieces']]
+            write_mosaic(grid, pieces, path)
+
+        if not keep_pieces:
+            shutil.rmtree(piece_dir)
+            os.remove(progress.path)
+        return path
+
+    def download_time_series(self, feat, bins, path, radius=0.02, scale=30,
+                             batch_size=12, downloader=None):
+        """Download a composite for each `(start, end)` date bin
+        (see `date_bins`) of the area around `feat` into the
+        memory-mapped `cube.Cube` at `path`, one period per bin.
+
+        Composites of `batch_size` bins are stacked into one image,
+        so each request downloads several periods. Bins with no
+        images are left empty (zeros) without a request.
+
+        Bins already in the cube are skipped, so it can be called
+        again with later bins to append new periods, or re-run
+        to fill in periods that failed"""
+        feat = ee.Feature(feat)
+        geom = self._get_info(feat)['geometry']
+        region = geometry_bounds(geom, radius)
+        xmin, ymin, xmax, ymax = get_bounds(region if geom['type'] == 'Polygon' else [region])
+
+        # Pin every period to the same pixel grid
+        grid = area_grid((ymin, xmin, ymax, xmax), scale, tile_size=1<<30)
+        params = piece_params(grid, grid['pieces'][0])
+        cube = Cube.open_or_create(path, bands=EE_CHANNELS,
+                                   height=grid['height'], width=grid['width'],
+                                   transform=grid['transform'], crs='EPSG:4326')
+        if cube.shape[2:] != (grid['height'], grid['width']) or cube.bands != EE_CHANNELS or \
+                cube.meta['transform'] != list(grid['transform'])[:6]:
+            raise ValueError('Existing cube at {} is for a different area, scale or bands'.format(path))
+
+        labels = ['{}/{}'.format(start, end) for start, end in bins]
+        new = [(label, b) for label, b in zip(labels, bins) if label not in cube.times]
+        indices = dict(zip(cube.times, range(len(cube))))
+        indices.update(zip([label for label, _ in new], cube.extend([label for label, _ in new])))
+        todo = [(label, b) for label, b in zip(labels, bins) if label in cube.pending]
+        if not todo:
+            return cube
+
+        # Image counts for all bins in one request
+        sizes = self._get_info(ee.List([
+            self._collection(feat, start, end).size() for _, (start, end) in todo]))
+        cube.done([label for (label, _), size in zip(todo, sizes) if not size])
+        todo = [t for t, size in zip(todo, sizes) if size]
+
+        def fetch(batch):
+            names, images = [], []
+            for j, (label, (start, end)) in enumerate(batch):
+                bands = ['t{}_{}'.format(j, chan) for chan in EE_CHANNELS]
+                images.append(self.get_image_region(feat, start, end).rename(bands))
+                names.append(bands)
+            with metrics.span('ee_download_url'):
+                url = ee.Image.cat(images).getDownloadURL(params=params)
+            # The downloader retries the whole job, so don't retry again within it
+            with downloader.host_slot(url), metrics.span('download_ee_bands'):
+                arrays = download_ee_bands(url, [b for bands in names for b in bands], retries=0,
+                                           session=downloader.session, timeout=downloader.timeout)
+            for j, (label, _) in enumerate(batch):
+                cube.write(indices[label], arrays[j*3:(j+1)*3])
+            cube.done([label for label, _ in batch])
+
+        batches = [(todo[i:i+batch_size],) for i in range(0, len(todo), batch_size)]
+        downloader = downloader or Downloader()
+        downloader.run(fetch, batches, desc='Downloading periods')
+        return cube
+
+    def download_image(self, image, params, path, id=None, downloader=None, cog=False):
+        """Download an image to `path`, as an RGB image in the format
+        of its extension or, with `cog`, as a Cloud-Optimized GeoTIFF
+        (see `util.save_cog`). Returns its id"""
+        if self.cache is None:
+            id = id or uuid()
+            self._download_image(image, params, path, id, downloader, cog)
+            return id
+
+        # Cached images are addressed by their request
+        key = request_key('cog' if cog else 'image', image.serialize(), params)
+        ext = os.path.splitext(path)[1]
+        id = id or key
+        # A miss if it was evicted by another process in the meantime
+        if self.cache.copy(key, path, ext) is not None:
+            return id
+
+        with self.cache.write(key, ext) as tmp:
+            self._download_image(image, params, tmp, id, downloader, cog)
+            shutil.copyfile(tmp, path)
         return id
 
-    def export_image_to_drive(self, image, params, folder, max_pixels=1e8, crs='EPSG:3857', id=None):
+    def _download_image(self, image, params, path, id, downloader, cog=False):
+        with metrics.span('ee_download_url'):
+            url = image.getDownloadURL(params=params)
+        if downloader is None:
+            with metrics.span('download_ee_image'):
+                download_ee_image(url, id, path, cog=cog)
+        else:
+            # The downloader retries the whole job, so don't retry again within it
+            with downloader.host_slot(url), metrics.span('download_ee_image'):
+                download_ee_image(url, id, path, cog=cog, retries=0,
+                                  session=downloader.session,
+                                  timeout=downloader.timeout)
+
+    def download_images(self, jobs, downloader=None, cog=False):
+        """Download many `(image, params, path)` or
+        `(image, params, path, id)` jobs concurrently
+        (see `download_image` for `cog`).
+        Returns ids in job order; failed jobs hold their exception"""
+        downloader = downloader or Downloader()
+        def fetch(image, params, path, id=None):
+            return self.download_image(image, params, path, id=id, downloader=downloader, cog=cog)
+        return downloader.run(fetch, jobs)
+
+    def export_image_to_drive(self, image, params, folder, max_pixels=1e8, crs='EPSG:3857', id=None, scheduler=None):
+        """If a `scheduler.TaskScheduler` is given, the export is queued
+        through it (and skipped if it already exists) instead of started"""
         # Note: EPSG:3857 is Web Mercator
         # View tasks with `earthengine task list`
         # Exports to the drive of the account authenticated with
         #   `earthengine authenticate`
         id = id or uuid()
 
-        # Check if task already running for this feature
-        # if any(t['description'] == id and t['state'] in ['READY', 'RUNNING', 'COMPLETED'] for t in tasks):
-        #     return
-
         params['description'] = id
         params['folder'] = folder
 
         task = ee.batch.Export.image.toDrive(image, crs=crs, maxPixels=max_pixels, **params)
-        ee.batch.data.exportImage(task.id, task.config)
\ No newline at end of file
+        def start():
+            with metrics.span('ee_export_image'):
+                ee.batch.data.exportImage(task.id, task.config)
+            return task.id
+
+        if scheduler is None:
+            start()
+        else:
+            scheduler.submit(id, start)
+        return id
\ No newline at end of file
@@ -0,0 +1,148 @@
+import time
+from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .client import default_client
+from .metrics import metrics
+
+ACTIVE_STATES = ['UNSUBMITTED', 'READY', 'RUNNING', 'CANCEL_REQUESTED']
+
+# Tasks in these states count as already exported
+DUPLICATE_STATES = ['READY', 'RUNNING', 'COMPLETED']
+
+
+class TaskScheduler:
+    """Queues Earth Engine export tasks, keeping at most
+    `max_running` of them running at once and skipping
+    exports that already exist (matched by description).
+
+    The account's task list is fetched in full at most every
+    `ttl` seconds; in between, only the unfinished tasks this
+    scheduler started are polled, in a single status request.
+    Other tasks on the account only matter for duplicates.
+
+        scheduler = TaskScheduler(max_running=20)
+        for feat in feats:
+            image, params = sat.get_feature_image(feat)
+            sat.export_image_to_drive(image, params, 'exports', id=feat_id, scheduler=scheduler)
+        scheduler.run()
+
+    `data` defaults to `ee.data` (initializing Earth Engine
+    through the default client); anything with the same
+    `getTaskList`, `getTaskStatus` and `cancelTask` will do.
+    """
+    def __init__(self, max_running=10, data=None, ttl=300,
+                 poll_interval=5, max_poll_interval=120, sleep=time.sleep):
+        self.max_running = max_running
+        self.data = data or default_client.ee.data
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.sleep = sleep
+
+        # Queued (description, start) pairs, where
+        # `start()` starts the task and returns its id
+        self.queue = deque()
+        self.queued = set()
+
+        # Descriptions of the tasks this scheduler started; other
+        # tasks on the account don't count against `max_running`
+        self.started = set()
+
+        # Latest known status of each task, by description
+        self.tasks = {}
+        self._listed_at = None
+
+    def refresh(self, full=False):
+        """update the cached task statuses"""
+        stale = self._listed_at is None or time.time() - self._listed_at > self.ttl
+        if full or stale:
+            # The task list is newest first, so keep
+            # the first task seen for each description
+            latest = {}
+            with metrics.span('ee_task_list'):
+                tasks = self.data.getTaskList()
+            for t in tasks:
+                latest.setdefault(t['description'], t)
+            self.tasks.update(latest)
+            self._listed_at = time.time()
+        else:
+            active = {self.tasks[d]['id']: d for d in self.started if self.tasks[d]['state'] in ACTIVE_STATES}
+            if active:
+                with metrics.span('ee_task_status'):
+                    statuses = self.data.getTaskStatus(list(active))
+                for status in statuses:
+                    desc = active[status['id']]
+                    self.tasks[desc] = dict(self.tasks[desc], **status)
+        return self.tasks
+
+    def is_duplicate(self, description):
+        if self._listed_at is None:
+            self.refresh()
+        t = self.tasks.get(description)
+        return description in self.queued or \
+            (t is not None and t['state'] in DUPLICATE_STATES)
+
+    def n_running(self):
+        """the number of unfinished tasks this scheduler started"""
+        return sum(1 for d in self.started if self.tasks[d]['state'] in ACTIVE_STATES)
+
+    def submit(self, description, start):
+        """Queue a task, unless it already exists.
+        Returns whether or not it was queued"""
+        if self.is_duplicate(description):
+            return False
+        self.queue.append((description, start))
+        self.queued.add(description)
+        self.step()
+        return True
+
+    def step(self):
+        """start queued tasks while under the cap. If a task
+        fails to start, the error is raised and it stays queued"""
+        n_running = self.n_running()
+        while self.queue and n_running < self.max_running:
+            # Only dequeued once it's started, so a task
+            # that fails to start (e.g. over quota) isn't lost
+            description, start = self.queue[0]
+            id = start()
+            self.queue.popleft()
+            self.queued.discard(description)
+            self.started.add(description)
+            self.tasks[description] = {'id': id, 'description': description, 'state': 'READY'}
+            n_running += 1
+
+    def run(self, progress=True):
+        """Block until every queued task has been started and
+        has finished. The poll interval doubles while nothing
+        changes and resets when something does"""
+        interval = self.poll_interval
+        total = len(self.queue) + self.n_running()
+        with tqdm(total=total, desc='Exporting', disable=not progress) as bar:
+            while self.queue or self.n_running():
+                self.sleep(interval)
+                before = {d: t['state'] for d, t in self.tasks.items()}
+                self.refresh()
+                self.step()
+                after = {d: t['state'] for d, t in self.tasks.items()}
+                if after != before:
+                    interval = self.poll_interval
+                else:
+                    interval = min(interval*2, self.max_poll_interval)
+                bar.n = total - len(self.queue) - self.n_running()
+                bar.refresh()
+        return self.tasks
+
+    def cancel_all(self, workers=16):
+        """Cancel all ready or running tasks on the account.
+        Cancelling is network-bound, so threads do the job"""
+        self.queue.clear()
+        self.queued.clear()
+        tasks = [t for t in self.data.getTaskList() if t['state'] in ['READY', 'RUNNING']]
+        with ThreadPoolExecutor(workers) as pool:
+            for _ in tqdm(pool.map(lambda t: self.data.cancelTask(t['id']), tasks),
+                          total=len(tasks), desc='Cancelling tasks'):
+                pass
+
+        # Force a full refresh next time
+        self._listed_at = None
@@ -0,0 +1,176 @@
+"""
+Spatial indexing for bounding boxes, to go along with
+`util.get_bounds` and `util.intersects` when there are many of them.
+
+Boxes are `(xmin, ymin, xmax, ymax)` rows of NumPy arrays.
+
+    boxes = bounds_array([feat['geometry']['coordinates'] for feat in concessions])
+    tree = RTree(boxes)
+    query_idx, item_idx = tree.query_many(scene_footprints)
+"""
+
+import heapq
+import numpy as np
+from itertools import chain
+
+
+def bounds_array(polygons):
+    """Vectorized `util.get_bounds` for many polygons.
+    Each polygon is a list of rings (lists of `(x, y)` coords);
+    returns an `(n, 4)` array of boxes"""
+    # Flatten everything into one array in one go;
+    # converting ring by ring is slower than the plain loop
+    lengths = [sum(len(ring) for ring in rings) for rings in polygons]
+    coords = chain.from_iterable(chain.from_iterable(chain.from_iterable(polygons)))
+    coords = np.fromiter(coords, dtype='float64', count=2*sum(lengths)).reshape(-1, 2)
+    return bounds_from_coords(coords, lengths)
+
+
+def bounds_from_coords(coords, lengths):
+    """Bounds for polygons whose coordinates are already
+    packed into one `(n_coords, 2)` array, with the number
+    of coordinates of each polygon in `lengths`.
+    Each polygon needs at least one coordinate"""
+    if not len(lengths):
+        return np.empty((0, 4))
+    starts = np.r_[0, np.cumsum(lengths)[:-1]]
+    mins = np.minimum.reduceat(coords, starts, axis=0)
+    maxs = np.maximum.reduceat(coords, starts, axis=0)
+    return np.hstack([mins, maxs])
+
+
+def intersects(boxes_a, boxes_b):
+    """Element-wise (broadcasting) `util.intersects`"""
+    return (boxes_a[..., 2] >= boxes_b[..., 0]) & (boxes_b[..., 2] >= boxes_a[..., 0]) & \
+        (boxes_a[..., 3] >= boxes_b[..., 1]) & (boxes_b[..., 3] >= boxes_a[..., 1])
+
+
+def contains(boxes_a, boxes_b):
+    """Element-wise (broadcasting) test of `boxes_a` containing `boxes_b`"""
+    return (boxes_a[..., 0] <= boxes_b[..., 0]) & (boxes_a[..., 1] <= boxes_b[..., 1]) & \
+        (boxes_a[..., 2] >= boxes_b[..., 2]) & (boxes_a[..., 3] >= boxes_b[..., 3])
+
+
+PREDICATES = {
+    'intersects': lambda items, queries: intersects(items, queries),
+    'contains': lambda items, queries: contains(items, queries),
+    'within': lambda items, queries: contains(queries, items),
+}
+
+
+def box_distance(boxes, points):
+    """Element-wise (broadcasting) distance from points
+    to boxes; zero for points inside the box"""
+    dx = np.maximum(np.maximum(boxes[..., 0] - points[..., 0], 0), points[..., 0] - boxes[..., 2])
+    dy = np.maximum(np.maximum(boxes[..., 1] - points[..., 1], 0), points[..., 1] - boxes[..., 3])
+    return np.hypot(dx, dy)
+
+
+def _children(nodes, node_size, n_below):
+    """Expand node indices into the indices of their children,
+    returning `(parent positions, child indices)`"""
+    starts = nodes * node_size
+    counts = np.minimum(starts + node_size, n_below) - starts
+    parents = np.repeat(np.arange(len(nodes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return parents, np.repeat(starts, counts) + offsets
+
+
+class RTree:
+    """Static R-tree, bulk-loaded with Sort-Tile-Recursive packing
+    and stored as one array of boxes per level, so queries
+    (including batches of queries) run as array operations."""
+    def __init__(self, boxes, node_size=16):
+        boxes = np.asarray(boxes, dtype='float64').reshape(-1, 4)
+        self.node_size = node_size
+        self.order = self._str_order(boxes)
+
+        # levels[0] are the items themselves (in packed order),
+        # each following level groups `node_size` entries of the last
+        self.levels = [boxes[self.order]]
+        while len(self.levels[-1]) > 1:
+            below = self.levels[-1]
+            starts = np.arange(0, len(below), node_size)
+            self.levels.append(np.hstack([
+                np.minimum.reduceat(below[:, :2], starts, axis=0),
+                np.maximum.reduceat(below[:, 2:], starts, axis=0)]))
+
+    def __len__(self):
+        return len(self.order)
+
+    def _str_order(self, boxes):
+        n = len(boxes)
+        if n == 0:
+            return np.zeros(0, dtype='int64')
+        n_leaves = -(-n // self.node_size)
+        n_slices = int(np.ceil(np.sqrt(n_leaves)))
+        cx = (boxes[:, 0] + boxes[:, 2]) / 2
+        cy = (boxes[:, 1] + boxes[:, 3]) / 2
+
+        # Vertical slices by x, then sorted by y within each
+        by_x = np.argsort(cx, kind='stable')
+        slices = np.empty(n, dtype='int64')
+        slices[by_x] = np.arange(n) // (n_slices * self.node_size)
+        return np.lexsort((cy, slices))
+
+    def query(self, box, predicate='intersects'):
+        """Indices of items matching `box`"""
+        _, items = self.query_many(np.asarray(box, dtype='float64').reshape(1, 4), predicate)
+        return items
+
+    def query_many(self, boxes, predicate='intersects'):
+        """Match many query boxes at once. `predicate` is one of
+        `intersects`, `contains` (item contains query) or `within`
+        (item within query). Returns `(query indices, item indices)`"""
+        boxes = np.asarray(boxes, dtype='float64').reshape(-1, 4)
+        if len(self) == 0:
+            empty = np.zeros(0, dtype='int64')
+            return empty, empty
+
+        top = len(self.levels) - 1
+        queries = np.arange(len(boxes))
+        nodes = np.zeros(len(boxes), dtype='int64')
+        # With a single item, the root is the leaf level
+        test = PREDICATES[predicate] if top == 0 else intersects
+        keep = test(self.levels[top][nodes], boxes[queries])
+        queries, nodes = queries[keep], nodes[keep]
+
+        for level in range(top - 1, -1, -1):
+            parents, nodes = _children(nodes, self.node_size, len(self.levels[level]))
+            queries = queries[parents]
+            if level == 0:
+                keep = PREDICATES[predicate](self.levels[0][nodes], boxes[queries])
+            else:
+                keep = intersects(self.levels[level][nodes], boxes[queries])
+            queries, nodes = queries[keep], nodes[keep]
+
+        return queries, self.order[nodes]
+
+    def nearest(self, points, k=1):
+        """The `k` nearest items (by box distance) to each point.
+        Returns `(items, distances)`, each `(n_points, k)`;
+        missing neighbours (if there are fewer than `k` items)
+        are -1 with infinite distance"""
+        points = np.asarray(points, dtype='float64').reshape(-1, 2)
+        items = np.full((len(points), k), -1, dtype='int64')
+        dists = np.full((len(points), k), np.inf)
+        if len(self) == 0:
+            return items, dists
+
+        top = len(self.levels) - 1
+        for i, point in enumerate(points):
+            # Best-first search over (distance, level, index)
+            heap = [(0., top, 0)]
+            found = 0
+            while heap and found < k:
+                dist, level, idx = heapq.heappop(heap)
+                if level == 0:
+                    items[i, found] = self.order[idx]
+                    dists[i, found] = dist
+                    found += 1
+                    continue
+                _, children = _children(np.array([idx]), self.node_size, len(self.levels[level-1]))
+                child_dists = box_distance(self.levels[level-1][children], point)
+                for d, c in zip(child_dists.tolist(), children.tolist()):
+                    heapq.heappush(heap, (d, level-1, c))
+        return items, dists
@@ -1,15 +1,9 @@
-import ee
-from tqdm import tqdm
-from multiprocessing import Pool
-
-ee.Initialize()
+from .client import default_client
+from .scheduler import TaskScheduler
 
 def cancel(t):
     if t['state'] in ['READY', 'RUNNING']:
-        ee.data.cancelTask(t['id'])
+        default_client.ee.data.cancelTask(t['id'])
 
-def cancel_all():
-    tasks = ee.data.getTaskList()
-    with Pool() as p:
-        for _ in tqdm(p.imap(cancel, tasks), total=len(tasks), desc='Cancelling tasks'):
-            pass
\ No newline at end of file
+def cancel_all(workers=16):
+    TaskScheduler().cancel_all(workers=workers)
\ No newline at end of file
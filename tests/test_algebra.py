@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from ..algebra import Algebra, Expression
+
+
+def test_band_used_as_bitmask_and_number():
+    qa = np.array([[0, 8], [9, 16]], dtype='uint16')
+    out = Algebra({'v': 'qa * 2'}, mask='(qa & 8) == 0')({'qa': qa})
+    assert np.array_equal(out[0], [[0, np.nan], [np.nan, 32]], equal_nan=True)
+
+
+def test_bitmasks_keep_integer_precision():
+    # Not exactly representable as float32
+    qa = np.array([(1 << 30) + 1, 1 << 30], dtype='uint32')
+    out = Algebra({'odd': 'bit(qa, 0)', 'scaled': 'qa / 2', 'low': 'qa & 1'})({'qa': qa})
+    assert out[0].tolist() == [1, 0]
+    assert out[2].tolist() == [1, 0]
+
+
+def test_results_used_as_bitmasks():
+    qa = np.array([1, 2, 3], dtype='uint8')
+    out = Algebra({'m': 'qa & 1', 'n': 'm | 2'})({'qa': qa})
+    assert out[1].tolist() == [3, 2, 3]
+
+
+def test_rejects_unsafe_expressions():
+    for source in ['__import__("os")', 'qa.real', '[x for x in qa]', 'lambda: 1', 'qa[0]']:
+        with pytest.raises(ValueError):
+            Expression(source)
+
+
+def test_results_used_as_numbers_are_float():
+    qa = np.array([0, 1, 2, 3], dtype='uint8')
+    out = Algebra({'m': 'qa & 1', 'n': 'm - 5'})({'qa': qa})
+    assert out[1].tolist() == [-5, -4, -5, -4]
+
+
+def test_inverted_bitmasks():
+    qa = np.array([0, 8, 9], dtype='uint16')
+    out = Algebra({'v': '(~qa & 8) != 0', 'w': 'qa * 2'})({'qa': qa})
+    assert out[0].tolist() == [1, 0, 0]
+    assert out[1].tolist() == [0, 16, 18]
+
+
+def test_integer_dtype_gets_nodata_for_nan():
+    a = np.array([1., 0., 2.])
+    out = Algebra({'v': '4 / a'})({'a': a}, dtype='int16', nodata=-1)
+    assert out[0].tolist() == [4, -1, 2]
+    with pytest.raises(ValueError):
+        Algebra({'v': '4 / a'})({'a': a}, dtype='int16')
@@ -0,0 +1,36 @@
+import os
+import threading
+from ..cache import Cache
+
+
+def test_evicted_copy_is_a_miss(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'))
+    cache.put_json('ab12', {'a': 1})
+
+    def read(path):
+        os.remove(path) # As if another process evicted it
+        raise FileNotFoundError(path)
+
+    assert cache.load('ab12', read, '.json') is None
+    assert cache.stats['hits'] == 0
+    assert cache.stats['misses'] == 1
+    assert cache.copy('ab12', str(tmp_path / 'out.json'), '.json') is None
+    assert cache.stats['misses'] == 2
+
+
+def test_stats_across_threads(tmp_path):
+    cache = Cache(str(tmp_path / 'cache'))
+    cache.put_json('ab12', {'a': 1})
+
+    def work():
+        for _ in range(500):
+            cache.get_json('ab12')
+            cache.get_json('cd34')
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.stats['hits'] == cache.stats['misses'] == 4000
+    assert cache.hit_rate() == 0.5
@@ -0,0 +1,32 @@
+import numpy as np
+from rasterio.windows import Window
+from ..chunks import ChunkCache
+from ..raster import GeoTIFF
+from ..bench.fixtures import make_geotiff
+
+
+def test_reads_match_uncached_reads(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 512)
+    chunks = ChunkCache(str(tmp_path / 'chunks'), chunk_size=100)
+    cached, plain = GeoTIFF(path, chunk_cache=chunks), GeoTIFF(path)
+
+    windows = [Window(0, 0, 512, 512), Window(150, 90, 230, 17), Window(499, 480, 13, 32), None]
+    for _ in range(2):
+        for window in windows:
+            for indexes in [None, 2, [1, 2], [3, 1]]:
+                expected = plain.read(indexes, window=window)
+                assert np.array_equal(cached.read(indexes, window=window), expected)
+
+    # Every chunk was decoded once, then served from the cache
+    assert chunks.cache.stats['writes'] == 6*6
+    assert chunks.cache.stats['hits'] > 0
+
+    # Fractional windows aren't cached, but still read
+    window = Window(10.5, 10, 20, 20)
+    assert np.array_equal(cached.read(1, window=window), plain.read(1, window=window))
+
+    assert np.array_equal(cached.stats(block_size=128), plain.stats(block_size=128))
+    rng = np.random.default_rng(0)
+    rows, cols = rng.integers(-10, 520, 200), rng.integers(-10, 520, 200)
+    values, expected = cached.sample(rows, cols), plain.sample(rows, cols)
+    assert np.array_equal(values.data, expected.data) and np.array_equal(values.mask, expected.mask)
@@ -0,0 +1,30 @@
+import os
+import numpy as np
+from ..clips import clip_names, extract_clips, group_windows
+from ..bench.fixtures import make_geotiff
+
+
+def test_clip_names_stay_in_outdir():
+    assert clip_names(['a', '../../etc/passwd', '/abs', 'a', 'x y', '', 3]) == \
+        ['a', '_.._etc_passwd', '_abs', 'a-3', 'x_y', '_', '3']
+
+
+def test_groups_are_under_twice_group_size():
+    rng = np.random.default_rng(0)
+    corners = rng.integers(0, 4000, (500, 2))
+    windows = np.hstack([corners, corners + rng.integers(1, 65, (500, 2))])
+    for group in group_windows(windows, 64):
+        union = windows[group]
+        assert union[:, 2].max() - union[:, 0].min() < 128
+        assert union[:, 3].max() - union[:, 1].min() < 128
+
+
+def test_writes_clips_named_by_id(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 256)
+    x0, y1 = -5000000 + 30*100, 1000000 - 30*100
+    geom = {'type': 'Polygon', 'coordinates': [[(x0, y1), (x0+600, y1), (x0+600, y1-600), (x0, y1)]]}
+    outdir = str(tmp_path / 'clips')
+    paths = extract_clips(path, [{'id': '../escape', 'geometry': geom}], outdir=outdir, processes=1)
+    assert paths == [os.path.join(outdir, '_escape.tif')]
+    assert os.listdir(outdir) == ['_escape.tif']
+    assert not os.path.exists(str(tmp_path / 'escape.tif'))
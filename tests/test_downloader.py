@@ -0,0 +1,49 @@
+import os
+import requests
+from ..downloader import Downloader
+from ..bench.fixtures import FakeEEServer
+
+
+def test_retries_transient_errors(tmp_path):
+    with FakeEEServer() as server:
+        downloader = Downloader(workers=2, retries=3, backoff=0, progress=False)
+        jobs = [(server.url('flaky/16'), str(tmp_path / '{}.zip'.format(i))) for i in range(4)]
+        results = downloader.download_all(jobs)
+
+    assert results == [path for _, path in jobs]
+    assert all(os.path.getsize(path) for path in results)
+    assert downloader.retried
+    assert all(isinstance(e, requests.HTTPError) for _, e in downloader.retried)
+    assert downloader.errors == []
+
+
+def test_collects_failed_jobs(tmp_path):
+    with FakeEEServer() as server:
+        downloader = Downloader(workers=1, retries=0, progress=False)
+        results = downloader.download_all([(server.url('flaky/16'), str(tmp_path / 'a.zip'))])
+
+    # The first request to the flaky route fails, and isn't retried
+    assert isinstance(results[0], requests.HTTPError)
+    assert [(i, type(e)) for i, e in downloader.errors] == [(0, requests.HTTPError)]
+
+
+def test_limits_requests_per_host(tmp_path):
+    with FakeEEServer(delay=0.1) as server:
+        downloader = Downloader(workers=8, per_host=2, progress=False)
+        jobs = [(server.url('slow/16'), str(tmp_path / '{}.zip'.format(i))) for i in range(8)]
+        results = downloader.download_all(jobs)
+
+    assert results == [path for _, path in jobs]
+    assert server.max_active == 2
+
+
+def test_fails_fast_on_other_errors():
+    calls = []
+    def fn():
+        calls.append(1)
+        raise KeyError('download.red.tif')
+
+    downloader = Downloader(workers=1, retries=5, progress=False)
+    results = downloader.run(fn, [()])
+    assert isinstance(results[0], KeyError)
+    assert len(calls) == 1 and downloader.retried == []
@@ -0,0 +1,100 @@
+import os
+import pytest
+from ..earth import EarthWeb, CapturePool
+from ..bench.fixtures import FakeEEServer
+
+
+class FakeBrowser:
+    def visit(self, url):
+        pass
+
+    def load_cookies(self, path):
+        pass
+
+
+def test_sleep_is_a_deprecated_timeout():
+    with pytest.warns(DeprecationWarning):
+        earth = EarthWeb('cookies.txt', False, 10, browser=FakeBrowser())
+    assert earth.timeout == 10
+    assert EarthWeb('cookies.txt', timeout=5, browser=FakeBrowser()).timeout == 5
+
+
+class LoadingBrowser(FakeBrowser):
+    """Shows its loading indicator for the first `loading` checks"""
+    def __init__(self, loading):
+        self.loading = loading
+        self.shots = 0
+
+    def execute_script(self, script):
+        self.loading -= 1
+        return self.loading < 0
+
+    def screenshot(self, fname):
+        assert self.loading < 0, 'screenshot taken while loading'
+        self.shots += 1
+        with open(fname, 'wb') as f:
+            f.write(b'rendered')
+
+
+def test_render_waits_for_loading(tmp_path):
+    browser = LoadingBrowser(loading=3)
+    earth = EarthWeb('cookies.txt', browser=browser, interval=0, settle=2)
+    earth.wait_for_render(str(tmp_path / 'a.png'))
+    assert browser.shots == 2
+
+    earth = EarthWeb('cookies.txt', browser=LoadingBrowser(loading=10**9), interval=0.01, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        earth.wait_for_render(str(tmp_path / 'b.png'))
+
+
+class FailingBrowser(FakeBrowser):
+    def __init__(self):
+        self.closed = False
+
+    def visit(self, url):
+        if url != 'home':
+            raise RuntimeError('page crashed')
+
+    def quit(self):
+        self.closed = True
+
+
+def test_pool_collects_errors(tmp_path):
+    browsers = []
+    def make_browser():
+        browsers.append(FailingBrowser())
+        return browsers[-1]
+    pool = CapturePool('cookies.txt', workers=1, retries=1, make_browser=make_browser, home='home')
+    results = pool.run([({'lat': 0, 'lng': 0}, 1000, str(tmp_path / 'a.png'))], progress=False)
+    assert isinstance(results[0], RuntimeError)
+    assert pool.errors == [(0, results[0])]
+    assert len(browsers) == 2 and all(b.closed for b in browsers)
+
+
+def real_browser():
+    """A browser for `earth.EarthWeb`, or `None` if there isn't one here"""
+    try:
+        from browser import Browser
+        browser = Browser(virtual_display=False)
+    except Exception:
+        return None
+    return browser
+
+
+def test_pool_captures_rendered_page(tmp_path):
+    browser = real_browser()
+    if browser is None:
+        pytest.skip('no browser available')
+    browser.quit()
+
+    cookies = tmp_path / 'cookies.txt'
+    cookies.write_text('')
+    with FakeEEServer() as server:
+        pool = CapturePool(str(cookies), workers=2, make_browser=real_browser,
+                           home=server.url('earth'), timeout=20, interval=0.2,
+                           url_tmpl=server.url('earth?lat={lat}&lng={lng}&alt={alt}&render_ms=500'))
+        jobs = [({'lat': i, 'lng': i}, 1000, str(tmp_path / '{}.png'.format(i))) for i in range(3)]
+        paths = pool.run(jobs, progress=False)
+    assert pool.errors == []
+    assert paths == [fname for _, _, fname in jobs]
+    assert all(os.path.getsize(path) for path in paths)
@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+from ..history import EarthHistory, file_state
+
+JPEG = b'\xff\xd8' + b'\x00' * 64 + b'\xff\xd9'
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.
+        self.callbacks = {}
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        for at in [at for at in self.callbacks if at <= self.now]:
+            self.callbacks.pop(at)()
+
+
+def earth(time):
+    return EarthHistory(None, None, grab=lambda bbox: None, sleep=time.sleep, clock=time.clock, timeout=5)
+
+
+def test_waits_for_a_new_file_over_a_stale_one(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(JPEG)
+    previous = file_state(str(path))
+    time = FakeTime()
+
+    def save():
+        path.unlink()
+        path.write_bytes(JPEG + JPEG)
+    time.callbacks[1.] = save
+
+    assert earth(time).wait_for_file(str(path), previous=previous) == str(path)
+    assert time.now >= 1.
+
+
+def test_times_out_if_the_file_never_changes(tmp_path):
+    path = tmp_path / 'a.jpg'
+    path.write_bytes(JPEG)
+    time = FakeTime()
+    with pytest.raises(TimeoutError):
+        earth(time).wait_for_file(str(path), previous=file_state(str(path)))
+
+
+class FakeXdo:
+    def get_window_size(self, win_id):
+        return type('Size', (), {'width': 1280, 'height': 800})
+
+
+def watching(time, screens):
+    """`EarthHistory` whose grabs show `screens()` (one value for the whole screen)"""
+    grab = lambda bbox: np.full((bbox[3] - bbox[1], bbox[2] - bbox[0]), screens(), dtype='uint8')
+    return EarthHistory(FakeXdo(), None, grab=grab, sleep=time.sleep, clock=time.clock)
+
+
+def test_settles_once_the_screen_stops_changing():
+    time = FakeTime()
+    history = watching(time, lambda: 0)
+    frames, settled = history.wait_until_settled(interval=0.1, settle=3)
+    assert settled
+    assert time.now == pytest.approx(0.3)
+
+    # It has to change from what it was before first
+    frames, settled = history.wait_until_settled(changed_from=frames, timeout=1)
+    assert not settled
+    assert time.now >= 1.3
+
+
+def test_times_out_if_the_screen_keeps_changing():
+    time = FakeTime()
+    screens = iter(range(0, 256, 5))
+    frames, settled = watching(time, lambda: next(screens)).wait_until_settled(timeout=2)
+    assert not settled
+    assert time.now >= 2
@@ -0,0 +1,24 @@
+import os
+from ..mosaic import Progress, area_grid
+
+
+def test_progress_resumes_from_another_directory(tmp_path, monkeypatch):
+    grid = area_grid((0, 0, 0.1, 0.1), scale=30, tile_size=256)
+    piece = grid['pieces'][0]
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('area.tif.pieces')
+    open('area.tif.pieces/0_0.png', 'wb').close()
+    Progress('area.tif.progress.json', grid).mark(piece, 'area.tif.pieces/0_0.png')
+
+    # Resumed with a different working directory
+    other = tmp_path / 'other'
+    other.mkdir()
+    monkeypatch.chdir(other)
+    progress = Progress(str(tmp_path / 'area.tif.progress.json'), grid)
+    assert progress.is_done(piece)
+    assert progress.piece_path(piece) == str(tmp_path / 'area.tif.pieces' / '0_0.png')
+    assert not progress.is_done(grid['pieces'][1])
+
+    # A piece whose file has gone has to be fetched again
+    os.remove(progress.piece_path(piece))
+    assert not progress.is_done(piece)
@@ -0,0 +1,148 @@
+import os
+import pytest
+import rasterio
+import rasterio.warp
+import rasterio.features
+import numpy as np
+from affine import Affine
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.windows import Window
+from ..raster import GeoTIFF, to_rgba
+from ..bench.fixtures import make_geotiff, make_mask
+
+
+def test_stats_ignore_nodata(tmp_path):
+    geotiff = GeoTIFF(make_geotiff(str(tmp_path / 'a.tif'), 256))
+    mn, mx = geotiff.stats()
+    data = geotiff.dataset.read()
+    valid = data[:, data[0] != 0]
+    assert (mn == valid.min(axis=1)).all() and (mn > 0).all()
+    assert (mx == valid.max(axis=1)).all()
+
+
+def test_block_readers_are_closed(tmp_path):
+    geotiff = GeoTIFF(make_geotiff(str(tmp_path / 'a.tif'), 512))
+    assert np.array_equal(geotiff.stats(block_size=128, workers=4), geotiff.stats())
+
+    with geotiff._readers() as reader:
+        with ThreadPoolExecutor(4) as pool:
+            handles = list(pool.map(lambda _: reader(), range(16)))
+        assert not any(handle.closed for handle in handles)
+    assert all(handle.closed for handle in handles)
+
+
+def test_to_rgba_fills_missing_channels():
+    data = np.stack([np.zeros((4, 4)), np.full((4, 4), 10)], axis=-1)
+    out = np.full((4, 4, 4), 123, dtype='uint8') # As a reused buffer would be
+    rgba = to_rgba(data, [0, 0], [10, 10], out=out)
+    assert rgba is out
+    assert (rgba[..., 0] == 0).all() and (rgba[..., 1] == 255).all()
+    assert (rgba[..., 2] == 0).all() and (rgba[..., 3] == 255).all()
+
+
+def test_fused_apply_matches_step_by_step(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 512)
+
+    # Pixels (40, 30) to (200, 230), by their centers in EPSG:3857
+    x0, y0 = -5000000 + 40*30 + 15, 1000000 - 30*30 - 15
+    x1, y1 = -5000000 + 200*30 + 15, 1000000 - 230*30 - 15
+    square = {'type': 'Polygon', 'coordinates': [[
+        (x0 + 900, y0 - 900), (x0 + 3000, y0 - 900), (x0 + 3000, y0 - 3000),
+        (x0 + 900, y0 - 3000), (x0 + 900, y0 - 900)]]}
+
+    geotiff = GeoTIFF(path)
+    geotiff.apply_bounds((x0, y0, x1, y1), from_proj='epsg:3857')
+    geotiff.apply_scale(0.5, Resampling.nearest)
+    geotiff.apply_features_mask([{'geometry': square}])
+    assert geotiff.shape == (100, 80)
+    data = geotiff.dataset.read()
+
+    # One operation at a time, as each `apply_*` used to do
+    with rasterio.open(path) as src:
+        window = Window(40, 30, 160, 200)
+        cropped = src.read(window=window)
+        transform = src.window_transform(window)
+        with MemoryFile() as mem:
+            with mem.open(**dict(src.meta, width=160, height=200, transform=transform)) as dst:
+                dst.write(cropped)
+            with mem.open() as dst:
+                scaled = dst.read(out_shape=(3, 100, 80), resampling=Resampling.nearest)
+    transform = transform * Affine.scale(2)
+    scaled[:, geometry_mask([square], (100, 80), transform)] = 0
+
+    assert geotiff.transform.almost_equals(transform)
+    assert np.array_equal(data, scaled)
+
+
+def test_points_to_indices_matches_point_by_point(tmp_path):
+    from pyproj import Transformer
+    geotiff = GeoTIFF(make_geotiff(str(tmp_path / 'a.tif'), 512))
+
+    # Points in and around the raster
+    rng = np.random.default_rng(0)
+    xs = rng.uniform(-5000000 - 1000, -5000000 + 512*30 + 1000, 500)
+    ys = rng.uniform(1000000 - 512*30 - 1000, 1000000 + 1000, 500)
+    lons, lats = Transformer.from_crs('EPSG:3857', 'EPSG:4326', always_xy=True).transform(xs, ys)
+
+    rows, cols, valid, values = geotiff.points_to_indices(lats, lons, sample=True)
+    assert 0 < valid.sum() < len(valid)
+    for lat, lon, row, col, ok in zip(lats, lons, rows, cols, valid):
+        assert (row, col) == geotiff.point_to_index((lat, lon))
+        assert ok == (0 <= row < 512 and 0 <= col < 512)
+
+    data = geotiff.dataset.read()
+    assert np.array_equal(values.mask, np.broadcast_to(~valid, values.shape))
+    assert np.array_equal(values[:, valid], data[:, rows[valid], cols[valid]])
+
+
+@pytest.mark.parametrize('min_area', [None, 200])
+def test_batched_features_match_per_shape_reprojection(tmp_path, min_area):
+    from shapely.geometry import shape
+    geotiff = GeoTIFF(make_mask(str(tmp_path / 'a.tif'), 512))
+
+    # Each shape reprojected on its own, as `to_features` used to,
+    # keeping those of at least `min_area` pixels
+    dataset = geotiff.dataset
+    mask = dataset.dataset_mask()
+    expected = []
+    for (geom, val), (pixels, _) in zip(rasterio.features.shapes(mask, transform=dataset.transform),
+                                        rasterio.features.shapes(mask)):
+        if min_area is None or shape(pixels).area >= min_area:
+            expected.append((rasterio.warp.transform_geom(dataset.crs, 'EPSG:4326', geom, precision=6), val))
+
+    feats = list(geotiff.iter_features(min_area=min_area, batch_size=500, with_values=True))
+    assert len(feats) == len(expected)
+    if min_area is not None:
+        assert len(feats) < len(list(rasterio.features.shapes(mask)))
+    for (geom, val), (other, other_val) in zip(feats, expected):
+        assert val == other_val
+        assert len(geom['coordinates']) == len(other['coordinates'])
+        for ring, other_ring in zip(geom['coordinates'], other['coordinates']):
+            assert np.allclose(ring, other_ring, rtol=0, atol=2e-6)
+
+
+def test_scaled_reads_from_overviews_match_full_reads(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 1024)
+    st = os.stat(path)
+    geotiff = GeoTIFF(path)
+    assert geotiff.overview_level(0.25) is None
+    assert geotiff.build_overviews(external=True) == [2, 4]
+    assert geotiff.build_overviews(external=True) == []
+    assert os.path.exists(path + '.ovr') and os.stat(path).st_mtime_ns == st.st_mtime_ns
+    assert geotiff.overviews() == [2, 4]
+    assert [geotiff.overview_level(s) for s in [1, 0.6, 0.5, 0.3, 0.25, 0.1]] == [None, None, 0, 0, 1, 1]
+
+    # As `data_for_scale` used to read (GDAL picks
+    # the overview itself), and straight from the overview
+    for scale, level in [(0.5, 0), (0.25, 1)]:
+        data, transform = geotiff.data_for_scale(scale, Resampling.average)
+        size = int(1024 * scale)
+        with rasterio.open(path) as src:
+            expected = src.read(out_shape=(3, size, size), resampling=Resampling.average)
+            assert transform.almost_equals(src.transform * Affine.scale(1 / scale))
+        with rasterio.open(path, overview_level=level) as src:
+            assert np.array_equal(src.read(), expected)
+        assert np.array_equal(data, expected)
@@ -0,0 +1,53 @@
+import sys
+import importlib
+import pytest
+from ..bench.fixtures import fake_ee
+from ..client import Client
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Satellite over a fake `ee` that counts round trips"""
+    def make(**kwargs):
+        ee = fake_ee(**kwargs)
+        monkeypatch.setitem(sys.modules, 'ee', ee)
+        satellite = importlib.import_module(__package__.rpartition('.')[0] + '.satellite')
+        monkeypatch.setattr(satellite, 'ee', ee)
+        return ee, satellite.Satellite(client=Client())
+    return make
+
+
+@pytest.mark.parametrize('n_features', [10, 100])
+def test_feature_images_round_trips_are_fixed(fake, n_features):
+    ee, sat = fake(n_features=n_features)
+    before = dict(ee.calls)
+    images = sat.get_feature_images(ee.FeatureCollection('features'), chunk_size=100)
+    calls = {k: v - before.get(k, 0) for k, v in ee.calls.items() if v != before.get(k, 0)}
+
+    # The collection's size, then one chunk of geometries
+    assert len(images) == n_features
+    assert calls == {'getInfo': 2}
+
+
+def test_feature_images_round_trips_per_chunk(fake):
+    ee, sat = fake(n_features=100)
+    before = ee.calls.get('getInfo', 0)
+    sat.get_feature_images(ee.FeatureCollection('features'), chunk_size=25, prefetch=2)
+    assert ee.calls['getInfo'] - before == 1 + 4
+
+
+def test_time_series_checks_an_existing_cube(fake, tmp_path):
+    ee, sat = fake()
+    cube = importlib.import_module(__package__.rpartition('.')[0] + '.cube')
+    feat = {'type': 'Point', 'coordinates': [-60, -10]}
+    meta = sat.download_time_series(feat, [], str(tmp_path / 'a')).meta
+    assert sat.download_time_series(feat, [], str(tmp_path / 'a')).meta == meta
+
+    # Same size, but other bands or a shifted grid
+    res, _, x0, _, _, y0 = meta['transform']
+    for name, bands, transform in [('b', ['nir', 'red', 'green'], meta['transform']),
+                                   ('c', meta['bands'], [res, 0, x0 + res, 0, -res, y0])]:
+        path = str(tmp_path / name)
+        cube.Cube.create(path, bands, meta['height'], meta['width'], transform=transform)
+        with pytest.raises(ValueError):
+            sat.download_time_series(feat, [], path)
@@ -0,0 +1,60 @@
+import pytest
+from ..scheduler import TaskScheduler
+from ..bench.fixtures import fake_ee
+
+
+def starter(ee, description, log):
+    def start():
+        id = ee.data.newTaskId()[0]
+        ee.batch.data.exportImage(id, {'description': description})
+        log.append(sum(1 for t in ee.data.getTaskList()
+                       if t['description'].startswith('job') and t['state'] == 'READY'))
+        return id
+    return start
+
+
+def test_caps_running_tasks_and_finishes():
+    ee = fake_ee()
+    # Someone else's task, which never finishes
+    ee.batch.data.exportImage('other', {'description': 'other'})
+
+    log = []
+    scheduler = TaskScheduler(max_running=3, data=ee.data, sleep=lambda s: None)
+    for i in range(10):
+        assert scheduler.submit('job{}'.format(i), starter(ee, 'job{}'.format(i), log))
+    assert ee.calls['exportImage'] == 1 + 3
+
+    tasks = scheduler.run(progress=False)
+    assert ee.calls['exportImage'] == 1 + 10
+    assert max(log) <= 3
+    assert all(tasks['job{}'.format(i)]['state'] == 'COMPLETED' for i in range(10))
+    assert tasks['other']['state'] == 'READY'
+
+
+def test_skips_duplicates():
+    ee = fake_ee()
+    ee.batch.data.exportImage('old', {'description': 'job0'})
+    scheduler = TaskScheduler(max_running=1, data=ee.data, sleep=lambda s: None)
+    assert not scheduler.submit('job0', starter(ee, 'job0', []))
+    assert scheduler.submit('job1', starter(ee, 'job1', []))
+    assert scheduler.submit('job2', starter(ee, 'job2', []))
+    assert not scheduler.submit('job2', starter(ee, 'job2', []))
+    scheduler.run(progress=False)
+    assert ee.calls['exportImage'] == 1 + 2
+
+
+def test_keeps_tasks_that_fail_to_start():
+    ee = fake_ee()
+    scheduler = TaskScheduler(max_running=1, data=ee.data, sleep=lambda s: None)
+    failures = [RuntimeError('Too many tasks')]
+
+    def start():
+        if failures:
+            raise failures.pop()
+        return starter(ee, 'job0', [])()
+
+    with pytest.raises(RuntimeError):
+        scheduler.submit('job0', start)
+    assert list(scheduler.queued) == ['job0']
+    scheduler.run(progress=False)
+    assert scheduler.tasks['job0']['state'] == 'COMPLETED'
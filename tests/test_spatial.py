@@ -0,0 +1,38 @@
+import numpy as np
+from ..spatial import RTree, bounds_array
+
+
+def brute_force(items, queries, predicate):
+    test = {
+        'intersects': lambda a, b: a[2] >= b[0] and b[2] >= a[0] and a[3] >= b[1] and b[3] >= a[1],
+        'contains': lambda a, b: a[0] <= b[0] and a[1] <= b[1] and a[2] >= b[2] and a[3] >= b[3],
+        'within': lambda a, b: b[0] <= a[0] and b[1] <= a[1] and b[2] >= a[2] and b[3] >= a[3],
+    }[predicate]
+    return sorted((q, i) for q, query in enumerate(queries)
+                  for i, item in enumerate(items) if test(item, query))
+
+
+def test_single_item_applies_predicate():
+    tree = RTree([[0, 0, 10, 10]])
+    queries, items = tree.query_many([[5, 5, 20, 20]], 'contains')
+    assert len(queries) == len(items) == 0
+    assert tree.query([2, 2, 8, 8], 'contains').tolist() == [0]
+    assert tree.query([5, 5, 20, 20], 'intersects').tolist() == [0]
+    assert tree.query([-1, -1, 20, 20], 'within').tolist() == [0]
+
+
+def test_matches_brute_force():
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 100, (300, 2))
+    items = np.hstack([xy, xy + rng.uniform(0, 10, (300, 2))])
+    xy = rng.uniform(0, 100, (40, 2))
+    queries = np.hstack([xy, xy + rng.uniform(0, 30, (40, 2))])
+    tree = RTree(items, node_size=8)
+    for predicate in ['intersects', 'contains', 'within']:
+        q, i = tree.query_many(queries, predicate)
+        assert sorted(zip(q.tolist(), i.tolist())) == brute_force(items, queries, predicate)
+
+
+def test_bounds_of_no_polygons():
+    assert bounds_array([]).shape == (0, 4)
+    assert len(RTree(bounds_array([])).query([0, 0, 1, 1])) == 0
@@ -0,0 +1,20 @@
+import os
+from ..tiles import generate_tiles, MANIFEST
+from ..bench.fixtures import make_geotiff
+
+
+def tile_files(outdir):
+    return {os.path.relpath(os.path.join(root, f), outdir)
+            for root, _, files in os.walk(outdir) for f in files if f != MANIFEST}
+
+
+def test_removes_tiles_outside_new_zooms(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 512)
+    outdir = str(tmp_path / 'tiles')
+    assert generate_tiles(path, outdir, processes=1) == (0, 1)
+    assert any(f.startswith('1' + os.sep) for f in tile_files(outdir))
+
+    # Changes the settings, so the manifest is reset
+    assert generate_tiles(path, outdir, zooms=(0, 0), processes=1) == (0, 0)
+    assert tile_files(outdir) == {os.path.join('0', '0', '0.png')}
+    assert not os.path.exists(os.path.join(outdir, '1'))
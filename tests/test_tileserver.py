@@ -0,0 +1,55 @@
+import io
+import asyncio
+import numpy as np
+from PIL import Image
+from ..cache import Cache
+from ..tiles import generate_tiles, tile_path
+from ..tileserver import TileServer
+from ..bench.fixtures import make_geotiff
+
+
+def test_renders_like_pregenerated_tiles(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 512)
+    outdir = str(tmp_path / 'tiles')
+    _, z_max = generate_tiles(path, outdir, processes=1)
+
+    stats_cache = Cache(str(tmp_path / 'cache'))
+    server = TileServer(path, processes=1, stats_cache=stats_cache)
+    try:
+        assert server.z_max == z_max
+        for z, x, y in [(z_max, 0, 0), (z_max, 1, 1), (z_max - 1, 0, 0)]:
+            png = asyncio.run(server.tile(z, x, y))
+            with Image.open(io.BytesIO(png)) as served, Image.open(tile_path(outdir, z, x, y)) as tile:
+                assert np.array_equal(np.asarray(served), np.asarray(tile))
+    finally:
+        server.close()
+
+    # The limits were cached, so a restart doesn't recompute them
+    server = TileServer(path, processes=1, stats_cache=stats_cache)
+    server.close()
+    assert stats_cache.stats['hits'] == 1
+
+
+def test_reports_render_errors(tmp_path):
+    path = make_geotiff(str(tmp_path / 'a.tif'), 256)
+    server = TileServer(path, processes=1)
+
+    async def fail(z, x, y):
+        raise ValueError('bad tile')
+    server.tile = fail
+
+    async def get(target):
+        listener = await server.start(port=0)
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.1\r\nConnection: close\r\n\r\n'.format(target).encode('latin1'))
+            response = await reader.read()
+            writer.close()
+            return response
+    try:
+        response = asyncio.run(get('/0/0/0.png'))
+    finally:
+        server.close()
+    assert response.startswith(b'HTTP/1.1 500 ')
+    assert response.endswith(b"Failed to render /0/0/0.png: ValueError('bad tile')")
@@ -0,0 +1,61 @@
+import os
+import pytest
+import zipfile
+import requests
+from ..util import download_ee_image, fetch_zip, should_retry
+from ..bench.fixtures import FakeEEServer
+
+
+def test_retries_transient_statuses(tmp_path):
+    with FakeEEServer() as server:
+        # The first request fails with a 503
+        path = download_ee_image(server.url('flaky/16'), 'a', str(tmp_path / 'a.png'),
+                                 working_dir=str(tmp_path), retries=1)
+    assert path == str(tmp_path / 'a.png')
+
+
+def test_gives_up_after_retries(tmp_path):
+    with FakeEEServer() as server:
+        with pytest.raises(requests.HTTPError):
+            fetch_zip(server.url('flaky/16'), 'a', working_dir=str(tmp_path), retries=0)
+
+
+def test_only_retries_transient_errors():
+    def http_error(status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.HTTPError(response=response)
+
+    assert should_retry(requests.ConnectionError())
+    assert should_retry(requests.Timeout())
+    assert should_retry(zipfile.BadZipFile())
+    assert should_retry(http_error(503)) and should_retry(http_error(429))
+    assert not should_retry(http_error(400))
+    assert not should_retry(KeyError('download.red.tif'))
+    assert not should_retry(ValueError())
+
+
+def test_saves_cog(tmp_path):
+    import rasterio
+    from rasterio.enums import ColorInterp
+    path = str(tmp_path / 'a.tif')
+    with FakeEEServer() as server:
+        download_ee_image(server.url('zip/600'), 'a', path, working_dir=str(tmp_path), cog=True)
+    with rasterio.open(path) as src:
+        assert (src.count, src.width, src.height) == (3, 600, 600)
+        assert src.descriptions == ('red', 'green', 'blue')
+        assert src.colorinterp == (ColorInterp.red, ColorInterp.green, ColorInterp.blue)
+        assert src.overviews(1) and src.crs is not None
+    assert os.listdir(str(tmp_path)) == ['a.tif']
+
+
+def test_measures_peak_memory(tmp_path):
+    import tracemalloc
+    stats = {}
+    with FakeEEServer() as server:
+        download_ee_image(server.url('zip/600'), 'a', str(tmp_path / 'a.png'),
+                          working_dir=str(tmp_path), stats=stats)
+    # At least the zip, which is held in memory
+    assert stats['peak_memory_bytes'] >= stats['download_bytes'] > 0
+    assert stats['estimated_peak_memory_bytes'] > 0
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,236 @@
+"""
+Render a tile pyramid for the Leaflet + rastercoords viewer (see the `tiles` folder),
+in the same `z/x/y.png` layout as `gdal2tiles.py -l -p raster`.
+
+The most detailed zoom level is rendered straight from the source;
+every other level is built by downsampling the four tiles below it.
+Tiles that are entirely nodata aren't written, and a manifest of tile hashes
+lets re-runs skip tiles whose source data hasn't changed.
+
+Usage:
+
+    python -m peng.tiles img/concessions/src/BRA.tif tiles/brazil
+"""
+
+import os
+import json
+import math
+import hashlib
+import rasterio
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from multiprocessing import Pool
+from rasterio.windows import Window
+from rasterio.enums import Resampling
+from .raster import GeoTIFF, to_rgba
+
+TILE_SIZE = 256
+MANIFEST = 'manifest.json'
+
+# Per-process state for the pool workers
+_worker = {}
+
+
+def max_zoom(width, height, tile_size=TILE_SIZE):
+    """zoom level at which the raster is at native resolution"""
+    return max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+
+
+def tile_path(outdir, z, x, y):
+    return os.path.join(outdir, str(z), str(x), '{}.png'.format(y))
+
+
+def remove_tile(outdir, z, x, y):
+    """remove a tile, and its folders if they're left empty"""
+    path = tile_path(outdir, z, x, y)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    for folder in [os.path.dirname(path), os.path.join(outdir, str(z))]:
+        try:
+            os.rmdir(folder)
+        except OSError:
+            break # Not empty
+
+
+def _init_worker(path, outdir, mn, mx, colormap, tile_size, factor, settings):
+    _worker.update({
+        'dataset': rasterio.open(path),
+        'outdir': outdir,
+        'mn': mn,
+        'mx': mx,
+        'colormap': colormap,
+        'tile_size': tile_size,
+        'factor': factor,
+        'settings': settings,
+    })
+
+
+def read_tile(dataset, x, y, factor, tile_size=TILE_SIZE, resampling=Resampling.nearest):
+    """`(data, mask)` for tile `(x, y)` of the level that covers
+    `factor` source pixels per tile pixel, or `(None, None)`
+    if the tile is outside the raster or entirely nodata"""
+    col, row = x*tile_size*factor, y*tile_size*factor
+    if col >= dataset.width or row >= dataset.height:
+        return None, None
+    window = Window(col, row, min(tile_size*factor, dataset.width - col),
+                    min(tile_size*factor, dataset.height - row))
+    out_shape = (math.ceil(window.height / factor), math.ceil(window.width / factor))
+
+    mask = dataset.dataset_mask(window=window, out_shape=out_shape)
+    if not mask.any():
+        return None, None
+    data = dataset.read(window=window, out_shape=(dataset.count,) + out_shape, resampling=resampling)
+    return data, mask
+
+
+def render_tile(data, mask, mn, mx, colormap=None, tile_size=TILE_SIZE):
+    """RGBA tile array for data from `read_tile`,
+    transparent where the data is nodata or missing"""
+    # Rendered straight into the tile
+    tile = np.zeros((tile_size, tile_size, 4), dtype='uint8')
+    height, width = mask.shape
+    rgba = to_rgba(np.moveaxis(data, 0, -1), mn, mx, colormap,
+                   out=tile[:height, :width])
+    np.minimum(rgba[..., 3], mask, out=rgba[..., 3])
+    return tile
+
+
+def _render_base_tile(job):
+    """render a tile of the most detailed level from the source,
+    which covers `factor` source pixels per tile pixel"""
+    (z, x, y), prev_hash = job
+    ts = _worker['tile_size']
+    data, mask = read_tile(_worker['dataset'], x, y, _worker['factor'], ts)
+    if data is None:
+        return (z, x, y), None
+
+    hsh = hashlib.sha1(data.tobytes() + mask.tobytes() + _worker['settings']).hexdigest()
+    path = tile_path(_worker['outdir'], z, x, y)
+    if hsh == prev_hash and os.path.exists(path):
+        return (z, x, y), hsh
+
+    tile = render_tile(data, mask, _worker['mn'], _worker['mx'], _worker['colormap'], ts)
+    _save(tile, path)
+    return (z, x, y), hsh
+
+
+def merge_children(children, tile_size=TILE_SIZE):
+    """A tile downsampled from its four children (PIL images, or
+    `None` where missing), in `(0, 0), (1, 0), (0, 1), (1, 1)` order"""
+    canvas = Image.new('RGBA', (tile_size*2, tile_size*2))
+    for child, (dx, dy) in zip(children, [(0, 0), (1, 0), (0, 1), (1, 1)]):
+        if child is not None:
+            canvas.paste(child, (dx*tile_size, dy*tile_size))
+    return canvas.reduce(2)
+
+
+def _render_parent_tile(job):
+    """render a tile by downsampling its four children"""
+    (z, x, y), child_hashes, prev_hash = job
+    if not any(child_hashes):
+        return (z, x, y), None
+
+    hsh = hashlib.sha1(''.join(h or '-' for h in child_hashes).encode('utf8')).hexdigest()
+    path = tile_path(_worker['outdir'], z, x, y)
+    if hsh == prev_hash and os.path.exists(path):
+        return (z, x, y), hsh
+
+    children = []
+    for child_hash, (dx, dy) in zip(child_hashes, [(0, 0), (1, 0), (0, 1), (1, 1)]):
+        if child_hash is None:
+            children.append(None)
+        else:
+            with Image.open(tile_path(_worker['outdir'], z+1, 2*x+dx, 2*y+dy)) as child:
+                child.load()
+                children.append(child)
+    _save(merge_children(children, _worker['tile_size']), path)
+    return (z, x, y), hsh
+
+
+def _save(tile, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if isinstance(tile, np.ndarray):
+        tile = Image.fromarray(tile, 'RGBA')
+    tile.save(path)
+
+
+def generate_tiles(path, outdir, zooms=None, colormap=None, tile_size=TILE_SIZE, processes=None):
+    """Render the tile pyramid for the GeoTIFF at `path` into `outdir`.
+    `zooms` is an optional `(min, max)` range, by default from 0 to
+    the zoom at native resolution. Returns the `(min, max)` zooms rendered"""
+    geotiff = GeoTIFF(path)
+    width, height = geotiff.dataset.width, geotiff.dataset.height
+    z_max = max_zoom(width, height, tile_size)
+    z_min = 0 if zooms is None else zooms[0]
+    if zooms is not None:
+        z_max = min(z_max, zooms[1])
+
+    # Normalize with whole-raster stats
+    # so tiles are consistent with each other
+    mn, mx = geotiff.stats()
+
+    manifest_path = os.path.join(outdir, MANIFEST)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    # Anything that changes how tiles are rendered
+    # has to invalidate them
+    settings = json.dumps([mn.tolist(), mx.tolist(), colormap, tile_size, z_max]).encode('utf8')
+    written = manifest.get('tiles', {})
+    if manifest.get('settings') != settings.decode('utf8'):
+        manifest = {}
+    hashes = manifest.get('tiles', {})
+    key = lambda z, x, y: '{}/{}/{}'.format(z, x, y)
+
+    # Levels below native resolution cover
+    # several source pixels per tile pixel
+    factor = 2**(max_zoom(width, height, tile_size) - z_max)
+
+    n_cols = math.ceil(width / (tile_size * factor))
+    n_rows = math.ceil(height / (tile_size * factor))
+    results = {}
+    args = (path, outdir, mn, mx, colormap, tile_size, factor, settings)
+    with Pool(processes, initializer=_init_worker, initargs=args) as p:
+        jobs = [((z_max, x, y), hashes.get(key(z_max, x, y)))
+                for x in range(n_cols) for y in range(n_rows)]
+        for tile, hsh in tqdm(p.imap_unordered(_render_base_tile, jobs, chunksize=16),
+                              total=len(jobs), desc='Zoom {}'.format(z_max)):
+            results[tile] = hsh
+
+        for z in range(z_max-1, z_min-1, -1):
+            n_cols, n_rows = math.ceil(n_cols / 2), math.ceil(n_rows / 2)
+            jobs = []
+            for x in range(n_cols):
+                for y in range(n_rows):
+                    children = [results.get((z+1, 2*x+dx, 2*y+dy))
+                                for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]]
+                    jobs.append(((z, x, y), children, hashes.get(key(z, x, y))))
+            for tile, hsh in tqdm(p.imap_unordered(_render_parent_tile, jobs, chunksize=16),
+                                  total=len(jobs), desc='Zoom {}'.format(z)):
+                results[tile] = hsh
+
+    # Remove tiles that have become empty, or that are
+    # no longer in the zoom range (or grid) at all
+    tiles = {key(*tile): hsh for tile, hsh in results.items() if hsh is not None}
+    for stale in set(written) - set(tiles):
+        z, x, y = stale.split('/')
+        remove_tile(outdir, z, x, y)
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'settings': settings.decode('utf8'),
+            'tiles': tiles
+        }, f)
+    return z_min, z_max
+
+
+if __name__ == '__main__':
+    import sys
+    generate_tiles(sys.argv[1], sys.argv[2])
@@ -0,0 +1,336 @@
+"""
+Serve `z/x/y.png` tiles for the Leaflet + rastercoords viewer (see the `tiles` folder),
+rendered on demand from a GeoTIFF rather than pre-rendered with `tiles.py`.
+
+Tiles use the same layout and rendering as `tiles.py` (including its
+normalization by whole-raster `GeoTIFF.stats`, unless `percentiles` or
+`max_pixels` ask for a quicker `GeoTIFF.stretch` instead), rendered across a
+process pool. As with `tiles.py`, the most detailed level is read straight from
+the source and every other level is downsampled from the four tiles below it
+(rendered, and cached, in turn), so served tiles match pre-rendered ones. With
+`match_tiles=False`, zoomed-out levels are instead read straight from the source,
+averaged (and from overviews, where there are any), which is much cheaper far
+from the most detailed level but won't exactly match pre-rendered tiles. Rendered tiles are kept in an in-memory LRU, concurrent requests
+for the same tile share one render, and responses carry an `ETag` (derived from
+the source file and render settings, so a revalidation doesn't render anything)
+and a `Cache-Control` max age.
+
+Usage:
+
+    python -m peng.tileserver img/concessions/src/BRA.tif --port 8000
+
+then point the viewer's tile layer at `http://localhost:8000/{z}/{x}/{y}.png`.
+Restart the server after the source changes.
+"""
+
+import io
+import os
+import re
+import asyncio
+import rasterio
+import numpy as np
+from time import perf_counter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from rasterio.enums import Resampling
+from .raster import GeoTIFF
+from .cache import request_key
+from .metrics import metrics
+from .tiles import TILE_SIZE, max_zoom, read_tile, render_tile, merge_children
+
+TILE_PATH = re.compile(r'^/(\d+)/(\d+)/(\d+)\.png$')
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# Per-process state for the pool workers
+_worker = {}
+
+
+def _init_worker(path, mn, mx, colormap, tile_size):
+    _worker.update({
+        'dataset': rasterio.open(path),
+        'mn': mn,
+        'mx': mx,
+        'colormap': colormap,
+        'tile_size': tile_size,
+    })
+
+
+def _render(x, y, factor):
+    """PNG bytes for a tile, or `None` if it's empty"""
+    ts = _worker['tile_size']
+    data, mask = read_tile(_worker['dataset'], x, y, factor, ts, Resampling.average)
+    if data is None:
+        return None
+    tile = render_tile(data, mask, _worker['mn'], _worker['mx'], _worker['colormap'], ts)
+    return _png(Image.fromarray(tile, 'RGBA'))
+
+
+def _merge(children):
+    """PNG bytes for a tile downsampled from its
+    children's PNG bytes, or `None` if they're all empty"""
+    if not any(children):
+        return None
+    images = [Image.open(io.BytesIO(png)) if png is not None else None for png in children]
+    return _png(merge_children(images, _worker['tile_size']))
+
+
+def _png(image):
+    buf = io.BytesIO()
+    image.save(buf, 'png')
+    return buf.getvalue()
+
+
+def render_limits(geotiff, percentiles=None, max_pixels=None, cache=None):
+    """Per-band `(min, max)` to normalize tiles by: as `tiles.py`,
+    `geotiff.stats()` or, with `percentiles` or `max_pixels`,
+    `geotiff.stretch`. Kept in `cache` (a `cache.Cache`), if given,
+    until the file changes"""
+    if percentiles is None and max_pixels is None:
+        compute = lambda: geotiff.stats()
+    else:
+        compute = lambda: geotiff.stretch(percentiles, max_pixels or 1<<22)
+    if cache is None:
+        return compute()
+
+    path = geotiff.dataset.name
+    st = os.stat(path)
+    key = request_key('render_limits', os.path.abspath(path), st.st_size, st.st_mtime_ns,
+                      percentiles, max_pixels)
+    limits = cache.get_json(key)
+    if limits is None:
+        mn, mx = compute()
+        limits = [mn.tolist(), mx.tolist()]
+        cache.put_json(key, limits)
+    return np.array(limits[0]), np.array(limits[1])
+
+
+class LRU:
+    """In-memory least-recently-used cache,
+    bounded by the total size of its (bytes) values"""
+    MISSING = object()
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    def put(self, key, value):
+        if key in self.items:
+            self.size -= len(self.items.pop(key) or b'')
+        self.items[key] = value
+        self.size += len(value or b'')
+        while self.size > self.max_bytes and len(self.items) > 1:
+            _, evicted = self.items.popitem(last=False)
+            self.size -= len(evicted or b'')
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TileServer:
+    def __init__(self, path, colormap=None, percentiles=None, processes=None,
+                 cache_bytes=256<<20, max_age=3600, tile_size=TILE_SIZE, overviews=False,
+                 max_pixels=None, stats_cache=None, match_tiles=True):
+        """Tiles are normalized as `tiles.py` does, by the whole-raster min
+        and max, which takes a pass over the raster on startup. Give a
+        `cache.Cache` as `stats_cache` to keep them across restarts.
+        Alternatively, with `percentiles` or `max_pixels`, they're normalized
+        by `GeoTIFF.stretch` limits of a decimated read of at most `max_pixels`
+        (default 4M) pixels, which is much quicker to start but won't exactly
+        match pre-rendered tiles. Likewise with `match_tiles=False`, zoomed-out
+        tiles are read straight from the source rather than downsampled from
+        the tiles below them (see above). With `overviews`, any missing overviews
+        are built (into a `.ovr` sidecar) first, which makes those reads
+        much cheaper"""
+        geotiff = GeoTIFF(path)
+        if overviews:
+            geotiff.build_overviews(external=True)
+        self.width, self.height = geotiff.dataset.width, geotiff.dataset.height
+        self.z_max = max_zoom(self.width, self.height, tile_size)
+        mn, mx = render_limits(geotiff, percentiles, max_pixels, stats_cache)
+        geotiff.dataset.close()
+
+        # Anything that changes how tiles are rendered changes their ETags
+        st = os.stat(path)
+        self.version = request_key(os.path.abspath(path), st.st_size, st.st_mtime_ns,
+                                   mn.tolist(), mx.tolist(), colormap, tile_size)[:16]
+
+        self.max_age = max_age
+        self.tile_size = tile_size
+        self.match_tiles = match_tiles
+        self.cache = LRU(cache_bytes)
+        self.inflight = {}
+        self.stats = {'requests': 0, 'hits': 0, 'renders': 0, 'shared': 0, 'not_modified': 0}
+        self.pool = ProcessPoolExecutor(processes, initializer=_init_worker,
+                                        initargs=(path, mn, mx, colormap, tile_size))
+
+        # Start the workers now: forked later, they'd
+        # inherit (and hold open) client connections
+        self.pool.submit(int).result()
+
+    def etag(self, z, x, y):
+        return '"{}-{}-{}-{}"'.format(self.version, z, x, y)
+
+    async def tile(self, z, x, y):
+        """PNG bytes for a tile, or `None` if it's empty"""
+        key = (z, x, y)
+        png = self.cache.get(key)
+        if png is not LRU.MISSING:
+            self.stats['hits'] += 1
+            return png
+
+        # Requests for a tile that's already being rendered wait on
+        # that render. It's shielded so one client disconnecting
+        # doesn't cancel it for the others
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.ensure_future(self._render(key))
+        else:
+            self.stats['shared'] += 1
+        return await asyncio.shield(task)
+
+    async def _render(self, key):
+        z, x, y = key
+        self.stats['renders'] += 1
+        loop = asyncio.get_running_loop()
+        try:
+            if z < self.z_max and self.match_tiles:
+                children = await asyncio.gather(*[self.tile(z+1, 2*x+dx, 2*y+dy)
+                                                  for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]])
+                with metrics.span('tile_render', z=z):
+                    png = await loop.run_in_executor(self.pool, _merge, children)
+            else:
+                with metrics.span('tile_render', z=z):
+                    png = await loop.run_in_executor(self.pool, _render, x, y, 2**(self.z_max - z))
+            self.cache.put(key, png)
+            return png
+        finally:
+            del self.inflight[key]
+
+    async def respond(self, method, target, headers):
+        """`(status, headers, body)` for a request"""
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b''
+        match = TILE_PATH.match(target.split('?', 1)[0])
+        if match is None:
+            return 404, {}, b''
+        z, x, y = [int(v) for v in match.groups()]
+        if z > self.z_max:
+            return 404, {}, b''
+
+        etag = self.etag(z, x, y)
+        cache_headers = {
+            'ETag': etag,
+            'Cache-Control': 'public, max-age={}'.format(self.max_age),
+        }
+        if etag in headers.get('if-none-match', ''):
+            self.stats['not_modified'] += 1
+            return 304, cache_headers, b''
+
+        png = await self.tile(z, x, y)
+        if png is None:
+            # Empty tiles are left out, as with pre-rendered tiles
+            return 404, cache_headers, b''
+        return 200, dict(cache_headers, **{'Content-Type': 'image/png'}), png
+
+    async def handle(self, reader, writer):
+        """Serve HTTP/1.1 requests on a (keep-alive) connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin1').split()
+                except ValueError:
+                    await self._write(writer, 400, {'Connection': 'close'}, b'')
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                start = perf_counter()
+                self.stats['requests'] += 1
+                try:
+                    status, resp_headers, body = await self.respond(method, target, headers)
+                except Exception as e:
+                    status, resp_headers = 500, {'Content-Type': 'text/plain; charset=utf-8'}
+                    body = 'Failed to render {}: {!r}'.format(target, e).encode('utf8')
+                if not keep_alive:
+                    resp_headers['Connection'] = 'close'
+                await self._write(writer, status, resp_headers, b'' if method == 'HEAD' else body, len(body))
+                metrics.count('tile_requests', status=status)
+                metrics.observe('tile_request_seconds', perf_counter() - start)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _write(self, writer, status, headers, body, length=None):
+        headers = dict(headers, **{
+            'Content-Length': str(len(body) if length is None else length),
+            'Access-Control-Allow-Origin': '*',
+        })
+        head = 'HTTP/1.1 {} {}\r\n'.format(status, REASONS[status])
+        head += ''.join('{}: {}\r\n'.format(k, v) for k, v in headers.items())
+        writer.write(head.encode('latin1') + b'\r\n' + body)
+        await writer.drain()
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """Start listening, returning the `asyncio` server"""
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host='127.0.0.1', port=8000):
+        server = await self.start(host, port)
+        print('Serving {}x{} tiles (zoom 0-{}) on http://{}:{}/{{z}}/{{x}}/{{y}}.png'.format(
+            self.tile_size, self.tile_size, self.z_max, host, port))
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--colormap', default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-mb', type=int, default=256)
+    parser.add_argument('--overviews', action='store_true', help='build missing overviews first')
+    parser.add_argument('--no-match-tiles', dest='match_tiles', action='store_false',
+                        help='read zoomed-out tiles from the source rather than downsampling (quicker)')
+    parser.add_argument('--max-pixels', type=int, default=None,
+                        help='normalize by a decimated read of this many pixels (quicker to start)')
+    args = parser.parse_args()
+
+    server = TileServer(args.path, colormap=args.colormap, processes=args.processes,
+                        cache_bytes=args.cache_mb<<20, overviews=args.overviews,
+                        max_pixels=args.max_pixels, match_tiles=args.match_tiles)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
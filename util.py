@@ -1,62 +1,254 @@
+import io
 import os
+import shutil
+import random
 import zipfile
+import tempfile
+import time
 import requests
 from PIL import Image
 from uuid import uuid1
+from requests.adapters import HTTPAdapter
+from .metrics import metrics, traced_peak
 
 
-def download(url, outfile):
-    """download a file"""
-    fname = url.split('/')[-1]
-    with requests.get(url, stream=True) as r:
+# Server-side statuses worth trying again;
+# anything else (e.g. 400, 404) won't fix itself
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def backoff_delay(attempt, base=0.5, cap=30.):
+    """exponential backoff with "full jitter",
+    so that many workers that fail together
+    don't all retry together"""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def should_retry(e):
+    """Only errors that may go away by themselves are worth retrying:
+    dropped connections, timeouts, truncated zips and HTTP errors with
+    a transient status. Anything else (e.g. a missing band in a zip,
+    or bad request parameters) would just fail again"""
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code in RETRY_STATUSES
+    return isinstance(e, (requests.ConnectionError, requests.Timeout, zipfile.BadZipFile))
+
+
+def make_session(pool_size=10):
+    """create a session that keeps a pool of
+    keep-alive connections open per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def stream(url, f, session=None, chunk_size=1<<20, timeout=None):
+    """stream a url into an open file;
+    returns the number of bytes written"""
+    get = session.get if session is not None else requests.get
+    n_bytes = 0
+    with metrics.span('http_get') as span, get(url, stream=True, timeout=timeout) as r:
+        span.set(status=r.status_code)
         if r.status_code != 200:
-            print(r.json())
+            print(r.text)
             r.raise_for_status()
-        with open(outfile, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk: # filter out keep-alive new chunks
-                    f.write(chunk)
-                    # f.flush()
+        for chunk in r.iter_content(chunk_size=chunk_size):
+            if chunk: # filter out keep-alive new chunks
+                f.write(chunk)
+                n_bytes += len(chunk)
+    metrics.count('download_bytes', n_bytes)
+    return n_bytes
+
+
+def download(url, outfile, session=None, chunk_size=1<<20, timeout=None):
+    """download a file"""
+    with open(outfile, 'wb') as f:
+        stream(url, f, session=session, chunk_size=chunk_size, timeout=timeout)
     return outfile
 
 
-def download_ee_image(url, id, impath, working_dir='/tmp', keep_files=False):
+EE_CHANNELS = ['red', 'green', 'blue']
+
+def fetch_zip(url, id, working_dir='/tmp', session=None, timeout=None, retries=2, spool_size=64<<20,
+              backoff=0.5):
+    """Download a zip into a spooled temp file (in memory up to
+    `spool_size` bytes), retrying up to `retries` times (as
+    `Downloader` does) if it's corrupt or the request fails
+    transiently (see `should_retry`).
+    Returns `(file, zipfile, n_bytes)`; close both when done"""
     if not os.path.exists(working_dir):
         os.makedirs(working_dir)
-    outdir = os.path.join(working_dir, id)
-
-    # Download zip
-    zipf = '/tmp/{}.zip'.format(id)
 
-    ok = False
-    while not ok:
-        download(url, zipf)
+    for attempt in range(retries + 1):
+        buf = tempfile.SpooledTemporaryFile(max_size=spool_size, dir=working_dir)
         try:
-            zfile = zipfile.ZipFile(zipf)
-        except zipfile.BadZipFile:
-            print('Bad zip (retrying):', zipf, url)
-            continue
-        zfile.extractall(outdir)
-        ok = True
-
-    # Merge RGB images
-    chans = [
-        os.path.join(outdir, 'download.vis-{}.tif'.format(chan))
-        for chan in ['red', 'green', 'blue']
-    ]
-
-    rgb = [Image.open(ch) for ch in chans]
-    im = Image.merge('RGB', rgb)
-    im.save(impath, optimize=False, compress_level=0)
-
-    if not keep_files:
-        # Clean up zipfile
-        os.remove(zipf)
-        for ch in chans:
-            os.remove(ch)
+            n_bytes = stream(url, buf, session=session, timeout=timeout)
+            return buf, zipfile.ZipFile(buf), n_bytes
+        except BaseException as e:
+            buf.close()
+            if isinstance(e, zipfile.BadZipFile):
+                metrics.count('bad_zips')
+            if attempt == retries or not should_retry(e):
+                raise
+            metrics.count('retries', error=type(e).__name__)
+            time.sleep(backoff_delay(attempt, backoff))
+
+
+def download_ee_bands(url, bands, working_dir='/tmp', session=None, timeout=None,
+                      retries=2, spool_size=64<<20):
+    """Download an Earth Engine zip (one TIFF per band, as
+    `download.<band>.tif`) and decode the given `bands`,
+    without writing them out. Returns a list of 2D arrays"""
+    import numpy as np
+    buf, zfile, _ = fetch_zip(url, url, working_dir, session, timeout, retries, spool_size)
+    arrays = []
+    with buf, zfile, metrics.span('unzip_bands'):
+        for band in bands:
+            with Image.open(io.BytesIO(zfile.read('download.{}.tif'.format(band)))) as im:
+                arrays.append(np.asarray(im))
+    return arrays
+
+def download_ee_image(url, id, impath, working_dir='/tmp', keep_files=False,
+                      session=None, timeout=None, retries=2, spool_size=64<<20, stats=None,
+                      cog=False):
+    """Download an Earth Engine visualization zip and merge
+    its red/green/blue bands into `impath`.
+
+    The zip is kept in memory and only spooled to `working_dir`
+    if it's larger than `spool_size` bytes; the band TIFFs
+    are decoded straight from it. Pass a dict as `stats` to get
+    the bytes downloaded, disk I/O and peak memory: measured with
+    `metrics.traced_peak` (which doesn't see PIL's image buffers)
+    as `peak_memory_bytes`, and estimated from the zip and image
+    sizes as `estimated_peak_memory_bytes`.
+
+    By default the bands are saved as an uncompressed RGB image
+    (in whatever format `impath`'s extension says). With `cog`,
+    they're saved as a Cloud-Optimized GeoTIFF instead (see `save_cog`),
+    which keeps the georeferencing and supports partial reads."""
+    args = (url, id, impath, working_dir, keep_files, session, timeout, retries, spool_size, cog)
+    if stats is None:
+        _download_ee_image(*args)
+        return impath
+
+    # Tracing memory slows things down, so only when asked for
+    with traced_peak() as traced:
+        n_bytes, disk_bytes, width, height, max_member = _download_ee_image(*args)
+
+    # Bands are 8-bit, otherwise they couldn't be merged as RGB
+    spooled = n_bytes > spool_size
+    band_bytes = 3*width*height
+    zip_bytes = 0 if spooled else n_bytes
+    stats.update({
+        'download_bytes': n_bytes,
+        'spooled': spooled,
+        'disk_bytes': disk_bytes + os.path.getsize(impath),
+        'peak_memory_bytes': traced['peak_bytes'],
+        'estimated_peak_memory_bytes': max(
+            zip_bytes + band_bytes + max_member,
+            band_bytes + width*height*3),
+    })
     return impath
 
 
+def _download_ee_image(url, id, impath, working_dir, keep_files, session, timeout, retries,
+                       spool_size, cog):
+    """Returns `(n_bytes, disk_bytes, width, height, max_member)`"""
+    buf, zfile, n_bytes = fetch_zip(url, id, working_dir, session, timeout, retries, spool_size)
+
+    # Anything over the spool size was written to
+    # and read back from disk
+    spooled = n_bytes > spool_size
+    disk_bytes = 2*n_bytes if spooled else 0
+
+    with buf, zfile, metrics.span('unzip_bands'):
+        names = ['download.vis-{}.tif'.format(chan) for chan in EE_CHANNELS]
+        rgb, max_member = [], 0
+        for name in names:
+            raw = zfile.read(name)
+            max_member = max(max_member, len(raw))
+            if cog:
+                # Decoded when saving, to keep the georeferencing
+                rgb.append(raw)
+            else:
+                ch = Image.open(io.BytesIO(raw))
+                ch.load()
+                rgb.append(ch)
+
+        if keep_files:
+            outdir = os.path.join(working_dir, id)
+            zfile.extractall(outdir)
+            buf.seek(0)
+            with open(os.path.join(working_dir, '{}.zip'.format(id)), 'wb') as f:
+                shutil.copyfileobj(buf, f)
+            disk_bytes += 2*n_bytes
+
+    with metrics.span('save_image', format='cog' if cog else 'image'):
+        if cog:
+            width, height = save_cog(rgb, impath, names=EE_CHANNELS)
+        else:
+            # Merge RGB images
+            im = Image.merge('RGB', rgb)
+            im.save(impath, optimize=False, compress_level=0)
+            width, height = im.size
+    if spooled:
+        metrics.count('spooled_downloads')
+    return n_bytes, disk_bytes, width, height, max_member
+
+
+def save_cog(bands, path, blocksize=512, compress='deflate', names=None):
+    """Save single-band GeoTIFFs (as bytes, e.g. the bands of
+    an EE download) as the bands of one Cloud-Optimized GeoTIFF:
+    internally tiled, compressed and with overviews, keeping
+    the CRS and transform of the first band. `names` are saved
+    as the band descriptions (see `algebra.band_names`).
+    Returns the `(width, height)` of the image"""
+    # Only needed here, and slow to import
+    import rasterio
+    import rasterio.shutil
+    from rasterio.io import MemoryFile
+    from rasterio.enums import ColorInterp
+
+    with MemoryFile(bands[0]) as mem, mem.open() as src:
+        profile = {
+            'driver': 'GTiff',
+            'width': src.width,
+            'height': src.height,
+            'count': len(bands),
+            'dtype': src.dtypes[0],
+            'crs': src.crs,
+            'transform': src.transform,
+            'nodata': src.nodata,
+            'tiled': True,
+            'blockxsize': blocksize,
+            'blockysize': blocksize,
+        }
+
+    # The COG driver can only copy an existing dataset, so the
+    # bands are assembled in a temporary GeoTIFF first, one at a
+    # time, so only one decoded band is in memory at once
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-', suffix='.tif')
+    os.close(fd)
+    try:
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            for i, raw in enumerate(bands):
+                with MemoryFile(raw) as mem, mem.open() as src:
+                    dst.write(src.read(1), i+1)
+            if len(bands) == 3:
+                dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue]
+            if names is not None:
+                dst.descriptions = tuple(names)
+        with rasterio.open(tmp) as src:
+            rasterio.shutil.copy(src, path, driver='COG', blocksize=blocksize,
+                                 compress=compress, predictor=2,
+                                 overview_resampling='average')
+    finally:
+        os.remove(tmp)
+    return profile['width'], profile['height']
+
+
 def get_bounds(polygons):
     xmin, ymin, xmax, ymax = None, None, None, None
     for coords in polygons: